@@ -16,6 +16,7 @@ from stable_baselines.common.vec_env import DummyVecEnv, VecNormalize
 from stable_baselines.common.evaluation import evaluate_policy
 from stable_baselines import results_plotter
 from stable_baselines.bench import Monitor
+from metrics import MonitorTailer
 
 best_mean_reward, n_steps = -np.inf, 0
 
@@ -28,11 +29,11 @@ def callback(_locals, _globals):
     global n_steps, best_mean_reward
     # Print stats every 1000 calls
     if (n_steps + 1) % 1000 == 0:
-        # Evaluate policy training performance
-        x, y = ts2xy(load_results(log_dir), 'timesteps')
-        if len(x) > 0:
-            mean_reward = np.mean(y[-100:])
-            print(x[-1], 'timesteps')
+        # Evaluate policy training performance, only the episodes logged since the last call are read
+        monitor.update()
+        if monitor.metrics.episodes > 0:
+            mean_reward = monitor.metrics.mean_return()
+            print(monitor.metrics.steps, 'timesteps')
             print("Best mean reward: {:.2f} - Last mean reward per episode: {:.2f}".format(best_mean_reward, mean_reward))
 
             # New best model, you could save the agent here
@@ -48,10 +49,11 @@ def callback(_locals, _globals):
 # Create log dir
 log_dir = "tmp/"
 os.makedirs(log_dir, exist_ok=True)
+monitor = MonitorTailer(os.path.join(log_dir, 'monitor.csv'))
 
 # Create and wrap the environment
 env = gym.make('PickUpEnv-v0')
-env = Monitor(env, log_dir)
+env = Monitor(env, log_dir, info_keywords=('reset reason',))
 # Automatically normalize the input features
 # env = VecNormalize(env, norm_obs=True, norm_reward=False, clip_obs=10.)
 
@@ -14,6 +14,7 @@ import time
 import numpy as np
 import math
 from LLC import pid
+from log_sink import DEBUG, get_sink
 from matplotlib import pyplot as plt
 
 from src.EpisodeManager import *
@@ -113,6 +114,7 @@ class LLCEnv:
 
     def __init__(self, L):
         self._output_folder = os.getcwd()
+        self.log = get_sink()  # subsystem 'llc'
 
         self.world_state = {}
         self.simOn = False
@@ -196,11 +198,11 @@ class LLCEnv:
         current_lift = self.world_state['ArmHeight'].item(0)
         current_pitch = quatToEuler(self.world_state['BladeOrien'])[1]
         # print(quatToEuler(self.world_state['BladeOrien']))
-        print('lift = ', current_lift, 'pitch = ', current_pitch)
+        self.log.debug('llc', 'lift = %s pitch = %s', current_lift, current_pitch)
 
         # check if done
         if current_lift == self.lift_pid.SetPoint and current_pitch == self.pitch_pid.SetPoint:
-            print('Success!')
+            self.log.info('llc', 'Success!')
             stop = True
 
         # pid update
@@ -225,11 +227,12 @@ class LLCEnv:
         except FileNotFoundError:
             os.makedirs(plot_folder)
         self.fig.savefig('{}/{}.png'.format(plot_folder, self._kp_kd))
-        print('figure saved!')
+        self.log.info('llc', 'figure saved!')
 
 
 if __name__ == '__main__':
     L = 100
+    get_sink().set_level('llc', DEBUG)  # every step
     LLC = LLCEnv(L)
     for i in range(L):
         stop = LLC.step(i)
@@ -237,4 +240,5 @@ if __name__ == '__main__':
             LLC.save_plot()
         if stop:
             break
+    get_sink().close()
 
@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+# SAC with env stepping and training decoupled: actor processes step their own env with the latest published
+# policy weights and stream the transitions through shared memory rings to the learner, which trains
+# continuously instead of waiting on every env step. In train_agent.py set n_actors, or standalone e.g.
+# python actor_learner.py PushStonesEnv --backend standin --actors 8 --timesteps 200000
+
+import argparse
+import json
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import gym
+import numpy as np
+
+from log_sink import get_sink
+
+COUNTER_BYTES = 64  # head and tail counters on their own cache lines
+# env attributes the replay buffers are built from, copied to the SpacesEnv of the learner
+ENV_ATTRIBUTES = ['hist_size', 'numStones', 'reduced_state_space']
+
+
+def env_attributes(env):
+    return {name: getattr(env, name) for name in ENV_ATTRIBUTES if hasattr(env, name)}
+
+
+def transition_width(obs_dim, action_dim):
+    # float32 values per transition row: obs, action, reward, next_obs, done
+    return 2 * obs_dim + action_dim + 2
+
+
+def split_transitions(rows, obs_dim, action_dim):
+    """
+    :param rows: (np.ndarray) (n, transition_width) transition rows
+    :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) obs, actions, rewards, next_obs, dones
+    """
+    o, a = obs_dim, action_dim
+    return rows[:, :o], rows[:, o:o + a], rows[:, o + a], rows[:, o + a + 1:-1], rows[:, -1]
+
+
+def pack_arrays(arrays):
+    """
+    Flatten actor arrays (frozen_policy.actor_arrays) for a shared memory block or a socket.
+
+    :return: (dict, np.ndarray) json-able layout and the float32 values
+    """
+    spec = {'activation': str(arrays['activation']),
+            'arrays': [[key, list(np.shape(array))] for key, array in sorted(arrays.items()) if key != 'activation']}
+    return spec, np.concatenate([np.ravel(arrays[key]) for key, _ in spec['arrays']]).astype(np.float32)
+
+
+def unpack_arrays(spec, values):
+    arrays = {'activation': np.array(spec['activation'])}
+    start = 0
+    for key, shape in spec['arrays']:
+        size = int(np.prod(shape))
+        arrays[key] = values[start:start + size].reshape(shape)
+        start += size
+    return arrays
+
+
+class TransitionRing:
+    """
+    Single producer, single consumer ring of float32 transitions in shared memory, without locks: the
+    producer writes slots past head and then advances head, the consumer reads slots before head and then
+    advances tail. Each counter has one writer and only grows. The slot is written before the counter in
+    program order, which the other process sees in that order on x86 (total store order).
+
+    :param capacity: (int) transitions
+    :param obs_dim: (int)
+    :param action_dim: (int)
+    :param name: (str) shared memory block of an existing ring to attach to, a new one if None
+    """
+
+    def __init__(self, capacity, obs_dim, action_dim, name=None):
+        self.capacity = capacity
+        self.obs_dim = obs_dim
+        self.action_dim = action_dim
+        self.width = transition_width(obs_dim, action_dim)
+
+        size = 2 * COUNTER_BYTES + 4 * capacity * self.width
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._shm.buf[:2 * COUNTER_BYTES] = bytes(2 * COUNTER_BYTES)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+
+        self._head = np.ndarray(1, dtype=np.int64, buffer=self._shm.buf, offset=0)
+        self._tail = np.ndarray(1, dtype=np.int64, buffer=self._shm.buf, offset=COUNTER_BYTES)
+        self._slots = np.ndarray((capacity, self.width), dtype=np.float32, buffer=self._shm.buf,
+                                 offset=2 * COUNTER_BYTES)
+
+    def __len__(self):
+        return int(self._head[0] - self._tail[0])
+
+    def put(self, obs, action, reward, next_obs, done):
+        """
+        Producer side.
+
+        :return: (bool) False when the ring is full, the transition was not added
+        """
+        head = int(self._head[0])
+        if head - int(self._tail[0]) >= self.capacity:
+            return False
+
+        slot = self._slots[head % self.capacity]
+        o, a = self.obs_dim, self.action_dim
+        slot[:o] = obs
+        slot[o:o + a] = action
+        slot[o + a] = reward
+        slot[o + a + 1:-1] = next_obs
+        slot[-1] = done
+        self._head[0] = head + 1
+        return True
+
+    def get(self, max_n):
+        """
+        Consumer side, the oldest transitions in the ring.
+
+        :param max_n: (int)
+        :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) copies of obs, actions, rewards,
+            next_obs, dones, of up to max_n transitions in the order they were put
+        """
+        tail = int(self._tail[0])
+        n = min(int(self._head[0]) - tail, max_n)
+        rows = self._slots[(tail + np.arange(n)) % self.capacity]
+        self._tail[0] = tail + n
+
+        return split_transitions(rows, self.obs_dim, self.action_dim)
+
+    def close(self, unlink=False):
+        del self._head, self._tail, self._slots
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+class SharedPolicyWeights:
+    """
+    Actor weights (frozen_policy.actor_arrays) published by the learner and read by the actors without
+    locks, as a seqlock: the version is odd while the learner writes, a reader keeps its copy only when the
+    version was even and the same before and after copying.
+
+    :param name: (str) shared memory block
+    :param arrays: (dict) to create the block with their layout and publish them, None to attach
+    """
+
+    def __init__(self, name, arrays=None):
+        if arrays is None:
+            self._shm = shared_memory.SharedMemory(name=name)
+            version, spec_size = np.ndarray(2, dtype=np.int64, buffer=self._shm.buf)
+            if version == 0:  # created, the layout is not written yet
+                self._shm.close()
+                raise FileNotFoundError(name)
+            spec_size = int(spec_size)
+            self.spec = json.loads(bytes(self._shm.buf[16:16 + spec_size]).decode())
+        else:
+            self.spec, values = pack_arrays(arrays)
+            spec = json.dumps(self.spec).encode()
+            spec_size = len(spec)
+            n_values = len(values)
+            self._shm = shared_memory.SharedMemory(name=name, create=True,
+                                                   size=16 + 8 * (spec_size // 8 + 1) + 4 * n_values)
+            np.ndarray(2, dtype=np.int64, buffer=self._shm.buf)[:] = [0, spec_size]
+            self._shm.buf[16:16 + spec_size] = spec
+
+        self._version = np.ndarray(1, dtype=np.int64, buffer=self._shm.buf)
+        n_values = sum(int(np.prod(shape)) for _, shape in self.spec['arrays'])
+        self._values = np.ndarray(n_values, dtype=np.float32, buffer=self._shm.buf,
+                                  offset=16 + 8 * (spec_size // 8 + 1))
+        if arrays is not None:
+            self.publish(arrays)
+
+    @property
+    def version(self):
+        return int(self._version[0])
+
+    def publish(self, arrays):
+        version = self.version
+        self._version[0] = version + 1
+        self._values[:] = pack_arrays(arrays)[1]
+        self._version[0] = version + 2
+
+    def read(self, known_version=0):
+        """
+        :param known_version: (int) version of the caller's copy
+        :return: (int, dict) version and arrays, or known_version and None when there is no newer consistent copy
+        """
+        version = self.version
+        if version == known_version or version % 2:
+            return known_version, None
+        values = self._values.copy()
+        if self.version != version:  # published while copying
+            return known_version, None
+
+        return version, unpack_arrays(self.spec, values)
+
+    def close(self, unlink=False):
+        del self._version, self._values
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+class SpacesEnv(gym.Env):
+    """
+    The spaces of the actors' envs, for building the model in the learner process. Never stepped.
+
+    :param observation_space: (gym.spaces.Box)
+    :param action_space: (gym.spaces.Box)
+    :param hist_size: (int) frames per observation
+    :param attributes: the other ENV_ATTRIBUTES of the actors' envs, e.g. numStones
+    """
+
+    def __init__(self, observation_space, action_space, hist_size=1, **attributes):
+        self.observation_space = observation_space
+        self.action_space = action_space
+        self.hist_size = hist_size
+        for name, value in attributes.items():
+            setattr(self, name, value)
+        self.metrics = None
+
+    def reset(self):
+        raise NotImplementedError('the envs are stepped by the actor processes')
+
+    def step(self, action):
+        raise NotImplementedError('the envs are stepped by the actor processes')
+
+
+class EnvActor:
+    """
+    Steps an env with a NumpyPolicy sampling its actions, uniformly random actions until it has weights.
+
+    :param env: (gym.Env)
+    :param seed: (int) of the env, the random actions and the policy, None for unseeded
+    """
+
+    def __init__(self, env, seed=None):
+        self.env = env
+        self.seed = seed
+        if seed is not None:
+            env.seed(seed)
+            env.action_space.seed(seed)
+        self.policy = None
+        self.obs = env.reset()
+        self.episode_return, self.length = 0., 0
+
+    def set_arrays(self, arrays):
+        from frozen_policy import NumpyPolicy
+
+        if self.policy is None:
+            self.policy = NumpyPolicy.from_arrays(arrays)
+            if self.seed is not None:
+                self.policy.set_random_seed(self.seed)
+        else:
+            self.policy.set_arrays(arrays)
+
+    def step(self):
+        """
+        :return: (tuple, tuple) the transition obs, action, reward, next_obs, done with the action scaled to
+            [-1, 1] as SAC stores it, and the return, length and reset reason of the episode when it ended
+            or None
+        """
+        env = self.env
+        if self.policy is None:
+            action = env.action_space.sample()
+        else:
+            action, _ = self.policy.predict(self.obs, deterministic=False)
+        new_obs, reward, done, info = env.step(action)
+        low, high = env.action_space.low, env.action_space.high
+        transition = (self.obs, 2. * (action - low) / (high - low) - 1., reward, new_obs, done)
+
+        self.episode_return += reward
+        self.length += 1
+        self.obs = new_obs
+        episode = None
+        if done:
+            episode = (self.episode_return, self.length, info.get('reset reason'))
+            self.obs = env.reset()
+            self.episode_return, self.length = 0., 0
+
+        return transition, episode
+
+
+def run_actor(index, mission, backend, num_stones, ring_capacity, weights_name, poll_interval, seed, messages,
+              stop):
+    """
+    Actor process: steps its env with the latest published weights (EnvActor) and puts every transition in
+    its ring, waiting while the ring is full. Episode ends are reported on messages.
+    """
+    from standin_env import make_env
+
+    env = make_env(mission, backend, num_stones)
+    actor = EnvActor(env, None if seed is None else seed + index)
+    ring = TransitionRing(ring_capacity, env.observation_space.shape[0], env.action_space.shape[0])
+    messages.put(('hello', index, ring.name, env.observation_space, env.action_space, env_attributes(env)))
+
+    weights, version, steps = None, 0, 0
+    try:
+        while not stop.is_set():
+            if steps % poll_interval == 0:
+                if weights is None:
+                    try:
+                        weights = SharedPolicyWeights(weights_name)
+                    except FileNotFoundError:  # nothing published yet
+                        pass
+                if weights is not None:
+                    version, arrays = weights.read(version)
+                    if arrays is not None:
+                        actor.set_arrays(arrays)
+
+            transition, episode = actor.step()
+            steps += 1
+            while not ring.put(*transition):
+                if stop.is_set():
+                    return
+                time.sleep(0.001)
+            if episode is not None:
+                messages.put(('episode', index) + episode)
+    finally:
+        if weights is not None:
+            weights.close()
+        ring.close(unlink=True)
+
+
+class ContinuousLearner:
+    """
+    Base of the learners that train while other processes step the envs. Subclasses implement collect, to
+    move the transitions of their workers to the replay buffer, and publish, to send the workers the
+    current actor weights. learn runs gradient steps as fast as it can, with SAC's learning rate schedule
+    and target updates, and publishes the actor weights every sync_interval gradient steps. Workers act
+    uniformly at random until the model's learning_starts transitions were collected.
+
+    The transitions of each worker are staged and written to the replay buffer up to the end of its last
+    finished episode, so the episodes of different workers are not interleaved (a FrameReplayBuffer
+    stores every episode as one run of frames, a HindsightReplayBuffer relabels within it). Longer
+    unfinished runs are written once MAX_STAGED transitions are staged.
+
+    :param sync_interval: (int) gradient steps between weight publications
+    :param max_updates_per_step: (float) cap on gradient steps per collected transition, None for no cap
+    """
+
+    def __init__(self, sync_interval=1000, max_updates_per_step=None):
+        self.sync_interval = sync_interval
+        self.max_updates_per_step = max_updates_per_step
+        self.log = get_sink()
+        self._staged = {}  # worker -> transitions of its unfinished episode
+
+    def collect(self, model, callback=None, metrics=None):
+        """
+        Move the transitions received since the last call to model.replay_buffer, see add_transitions.
+
+        :return: (int, bool) transitions added, False when the callback asked to stop
+        """
+        raise NotImplementedError
+
+    def publish(self, model):
+        raise NotImplementedError
+
+    @staticmethod
+    def model_arrays(model):
+        from frozen_policy import actor_arrays
+
+        return actor_arrays(model.get_parameters(), model.policy_kwargs, model.action_space.low,
+                            model.action_space.high)
+
+    MAX_STAGED = 10000
+
+    def add_transitions(self, model, worker, obs, actions, rewards, next_obs, dones):
+        """
+        Stage consecutive transitions of one worker and write its finished episodes to model.replay_buffer.
+        model.num_timesteps counts the staged transitions too.
+
+        :param worker: (hashable) the worker the transitions come from
+        """
+        staged = self._staged.pop(worker, []) + [(obs, actions, rewards, next_obs, dones)]
+        transitions = [np.concatenate(arrays) for arrays in zip(*staged)] if len(staged) > 1 else staged[0]
+        ends = np.flatnonzero(transitions[-1])
+        n_write = len(transitions[0]) if len(transitions[0]) >= self.MAX_STAGED else \
+            (ends[-1] + 1 if len(ends) else 0)
+
+        if n_write:
+            replay_buffer = model.replay_buffer
+            if hasattr(replay_buffer, 'add_batch'):
+                replay_buffer.add_batch(*(array[:n_write] for array in transitions))
+            else:
+                for transition in zip(*(array[:n_write] for array in transitions)):
+                    replay_buffer.add(*transition)
+        if n_write < len(transitions[0]):
+            self._staged[worker] = [tuple(array[n_write:] for array in transitions)]
+        model.num_timesteps += len(obs)
+
+    @staticmethod
+    def record(model, n_added, episodes, callback=None, metrics=None):
+        """
+        :param n_added: (int) transitions added
+        :param episodes: ([(float, int, str)]) return, length and reset reason of the episodes that ended
+        :return: (bool) False when the callback asked to stop
+        """
+        if metrics is not None:
+            metrics.add_step(n_added)
+            for episode_return, length, reason in episodes:
+                metrics.end_episode(episode_return, length, reason)
+
+        if callback is not None:
+            # once per transition, as model.learn calls it once per env step
+            for _ in range(n_added):
+                if callback({'self': model}, {}) is False:
+                    return False
+        return True
+
+    def learn(self, model, total_timesteps, callback=None, metrics=None, log_interval=10000):
+        """
+        Train until total_timesteps transitions were collected.
+
+        :param model: (SAC) built with the env returned by start
+        :param total_timesteps: (int)
+        :param callback: (callable) called with ({'self': model}, {}) once per transition, stops the
+            training when it returns False
+        :param metrics: (TrainingMetrics) fed with the workers' steps and episodes
+        :param log_interval: (int) transitions between progress lines of the 'train' log
+        """
+        from stable_baselines.common.schedules import get_schedule_fn
+
+        learning_rate = get_schedule_fn(model.learning_rate)
+        start_steps = model.num_timesteps
+        n_updates = 0
+        if model.num_timesteps >= model.learning_starts:  # resumed model
+            self.publish(model)
+
+        next_log = log_interval
+        start = time.time()
+        while model.num_timesteps - start_steps < total_timesteps:
+            n_added, keep_going = self.collect(model, callback, metrics)
+            if not keep_going:
+                break
+            steps = model.num_timesteps - start_steps
+
+            can_train = model.num_timesteps >= model.learning_starts and \
+                model.replay_buffer.can_sample(model.batch_size)
+            if self.max_updates_per_step is not None and n_updates >= self.max_updates_per_step * steps:
+                can_train = False
+            if not can_train:
+                if not n_added:
+                    time.sleep(0.001)
+                continue
+
+            model._train_step(model.num_timesteps, None, learning_rate(1.0 - steps / total_timesteps))
+            n_updates += 1
+            if n_updates % model.target_update_interval == 0:
+                model.sess.run(model.target_update_op)
+            if n_updates == 1 or n_updates % self.sync_interval == 0:
+                self.publish(model)
+
+            if steps >= next_log:
+                next_log += log_interval
+                self.log.info('train', '%d transitions, %d gradient steps, %.0f transitions/s, %.2f updates per step',
+                              steps, n_updates, steps / (time.time() - start), n_updates / max(steps, 1))
+
+        return model
+
+
+class ActorLearner(ContinuousLearner):
+    """
+    SAC training with the env stepping in n_actors actor processes, see ContinuousLearner. The learner
+    (this process) drains the actors' rings and publishes the weights in shared memory.
+
+    The simulation runs one env per machine (a ROS node and a Unity instance), use backend 'sim' with
+    n_actors=1 there and 'standin' for several.
+
+    :param mission: (str) e.g. 'PushStonesEnv'
+    :param backend: (str) 'sim' or 'standin', see standin_env.make_env
+    :param n_actors: (int) actor processes
+    :param num_stones: (int)
+    :param ring_capacity: (int) transitions per actor ring, an actor waits while its ring is full
+    :param sync_interval: (int) gradient steps between weight publications
+    :param poll_interval: (int) env steps between the actors' checks for new weights
+    :param max_updates_per_step: (float) cap on gradient steps per collected transition, None for no cap
+    :param seed: (int) actor k seeds its env and policy with seed + k
+    """
+
+    def __init__(self, mission, backend='sim', n_actors=1, num_stones=1, ring_capacity=10000, sync_interval=1000,
+                 poll_interval=100, max_updates_per_step=None, seed=None):
+        super(ActorLearner, self).__init__(sync_interval, max_updates_per_step)
+        self.mission = mission
+        self.backend = backend
+        self.n_actors = n_actors
+        self.num_stones = num_stones
+        self.ring_capacity = ring_capacity
+        self.poll_interval = poll_interval
+        self.seed = seed
+
+        self.weights_name = 'actor_learner_{}_{}'.format(multiprocessing.current_process().pid, id(self))
+        self.weights = None
+        self.rings = []
+        self.processes = []
+        self._episodes = []  # reported before the learner started collecting
+
+        context = multiprocessing.get_context('spawn')  # a forked TF session is not usable in the children
+        self._messages = context.Queue()
+        self._stop = context.Event()
+        self._context = context
+
+    def start(self, timeout=120.):
+        """
+        Start the actors and wait until each created its env and ring.
+
+        :param timeout: (float) seconds to wait for all the actors
+        :return: (SpacesEnv) the spaces of the actors' envs, to build the model with
+        """
+        for index in range(self.n_actors):
+            process = self._context.Process(
+                target=run_actor, name='actor-{}'.format(index), daemon=True,
+                args=(index, self.mission, self.backend, self.num_stones, self.ring_capacity, self.weights_name,
+                      self.poll_interval, self.seed, self._messages, self._stop))
+            process.start()
+            self.processes.append(process)
+
+        rings = {}
+        deadline = time.time() + timeout
+        while len(rings) < self.n_actors:
+            try:
+                message = self._messages.get(timeout=1.)
+            except queue.Empty:
+                self._check_actors()
+                if time.time() > deadline:
+                    raise TimeoutError('{} of {} actors started in {} s'.format(len(rings), self.n_actors, timeout))
+                continue
+            if message[0] == 'episode':  # of an actor that is already running
+                self._episodes.append(message)
+                continue
+            _, index, ring_name, observation_space, action_space, attributes = message
+            rings[index] = TransitionRing(self.ring_capacity, observation_space.shape[0], action_space.shape[0],
+                                          name=ring_name)
+        self.rings = [rings[index] for index in range(self.n_actors)]
+        self.log.info('train', '%d actors started', self.n_actors)
+
+        return SpacesEnv(observation_space, action_space, **attributes)
+
+    def publish(self, model):
+        arrays = self.model_arrays(model)
+        if self.weights is None:
+            self.weights = SharedPolicyWeights(self.weights_name, arrays)
+        else:
+            self.weights.publish(arrays)
+
+    def _check_actors(self):
+        # an actor whose env crashed stops filling its ring, the training would wait for it forever
+        for index, process in enumerate(self.processes):
+            if not process.is_alive() and not self._stop.is_set():
+                raise RuntimeError('actor {} exited with code {}'.format(index, process.exitcode))
+
+    def collect(self, model, callback=None, metrics=None, max_n=1000):
+        self._check_actors()
+        n_added = 0
+        for index, ring in enumerate(self.rings):
+            transitions = ring.get(max_n)
+            if len(transitions[0]):
+                self.add_transitions(model, index, *transitions)
+                n_added += len(transitions[0])
+
+        while True:
+            try:
+                self._episodes.append(self._messages.get_nowait())
+            except queue.Empty:
+                break
+        episodes, self._episodes = [message[2:] for message in self._episodes], []
+
+        return n_added, self.record(model, n_added, episodes, callback, metrics)
+
+    def close(self, timeout=10.):
+        self._stop.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for ring in self.rings:
+            ring.close()
+        if self.weights is not None:
+            self.weights.close(unlink=True)
+        self.rings, self.processes, self.weights = [], [], None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train SAC with actor processes and a continuous learner')
+    parser.add_argument('mission', help="env name without '-v0', e.g. PushStonesEnv")
+    parser.add_argument('--backend', choices=['sim', 'standin'], default='standin')
+    parser.add_argument('--actors', type=int, default=4)
+    parser.add_argument('--num-stones', type=int, default=1)
+    parser.add_argument('--timesteps', type=int, default=100000)
+    parser.add_argument('--sync-interval', type=int, default=1000, help='gradient steps between weight updates')
+    parser.add_argument('--max-updates-per-step', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--save', help='model file written at the end')
+    args = parser.parse_args()
+
+    from stable_baselines import SAC
+    from stable_baselines.sac.policies import MlpPolicy
+
+    from metrics import TrainingMetrics
+    from replay_buffers import FrameReplayBuffer
+
+    actor_learner = ActorLearner(args.mission, args.backend, args.actors, args.num_stones,
+                                 sync_interval=args.sync_interval, max_updates_per_step=args.max_updates_per_step,
+                                 seed=args.seed)
+    env = actor_learner.start()
+    env.metrics = TrainingMetrics(window=100)
+    model = SAC(MlpPolicy, env, learning_rate=1e-4, buffer_size=50000, learning_starts=3000, batch_size=64,
+                tau=0.01, policy_kwargs=dict(layers=[64, 64, 64]), verbose=1)
+    model.replay_buffer = FrameReplayBuffer.from_env(env, size=model.buffer_size)
+    try:
+        actor_learner.learn(model, args.timesteps, metrics=env.metrics)
+    finally:
+        actor_learner.close()
+    print(env.metrics.summary())
+    if args.save:
+        model.save(args.save)
+    get_sink().flush()
@@ -0,0 +1,295 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+from stable_baselines.common.base_class import BaseRLModel
+
+from replay_buffers import replay_buffer_arrays, write_replay_buffer
+
+
+def checkpoint_file(path):
+    # file name written by model.save(path): '.zip' is only added when path has no extension,
+    # so 'test_3_rew_65.4' is saved as is
+    return path if os.path.splitext(path)[1] else path + '.zip'
+
+
+def snapshot(model):
+    """
+    Class attributes and parameter values of a model, as model.save would write them.
+    The parameters are read from the TF session into new numpy arrays, so training can go on.
+
+    :param model: (BaseRLModel)
+    :return: (dict, OrderedDict) data, params
+    """
+    captured = {}
+
+    def capture(save_path, data=None, params=None, cloudpickle=False):
+        captured.update(data=data, params=params)
+
+    # model.save serializes through self._save_to_file, shadow it on the instance to keep the arrays
+    model._save_to_file = capture
+    try:
+        model.save('snapshot')
+    finally:
+        del model._save_to_file
+
+    return captured['data'], captured['params']
+
+
+class CheckpointWriter:
+    """
+    Saves models on a background thread. save() only snapshots the parameters, the serialization and
+    the disk writes are done by the writer thread, which then prunes old checkpoints:
+    the last keep_last checkpoints and the keep_best best ones by reward are kept.
+    Replay buffer snapshots are copied by save_replay_buffer and written by the same thread.
+
+    :param keep_last: (int) latest checkpoints to keep, None to keep all
+    :param keep_best: (int) best checkpoints to keep, None to keep all
+    :param manifest: (CheckpointManifest) records the written and pruned checkpoints
+    :param run: (int) run id in the manifest
+    """
+
+    def __init__(self, keep_last=5, keep_best=3, manifest=None, run=None):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.manifest = manifest
+        self.run = run
+        self.last = []  # written file names, oldest first
+        self.best = []  # (reward, file name), best first
+        self.error = None
+        self.lock = threading.Lock()
+        self._buffer_pending = False
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save(self, model, path, reward=None, best=False):
+        """
+        Queue a checkpoint of model.
+
+        :param model: (BaseRLModel)
+        :param path: (str) as for model.save
+        :param reward: (float) mean reward of the model
+        :param best: (bool) a best checkpoint, pruned by reward, else a latest checkpoint, pruned by age
+        """
+        self._raise()
+        data, params = snapshot(model)
+        self._queue.put((self._write, (checkpoint_file(path), data, params, reward, best, model.num_timesteps,
+                                       time.time())))
+
+    def save_replay_buffer(self, replay_buffer, path):
+        """
+        Queue a snapshot of a replay buffer, as replay_buffers.save_replay_buffer. The buffer arrays are
+        copied, training can go on while they are written. Skipped while the previous snapshot is still
+        queued, so at most one copy is held.
+
+        :param replay_buffer: (ReplayBuffer)
+        :param path: (str) snapshot directory
+        :return: (bool) the snapshot was queued
+        """
+        self._raise()
+        with self.lock:
+            if self._buffer_pending:
+                return False
+            self._buffer_pending = True
+        self._queue.put((self._write_replay_buffer, (replay_buffer_arrays(replay_buffer, copy=True), path)))
+        return True
+
+    def flush(self):
+        # wait for all queued checkpoints to be written
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint writer failed') from error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                write, args = item
+                write(*args)
+            except Exception as error:
+                self.error = error
+            finally:
+                self._queue.task_done()
+
+    def _write_replay_buffer(self, arrays, path):
+        try:
+            write_replay_buffer(arrays, path)
+        finally:
+            with self.lock:
+                self._buffer_pending = False
+
+    def _write(self, file_name, data, params, reward, best, step, wall_time):
+        # written next to the final name and renamed, a checkpoint file is always complete
+        tmp_name = file_name + '.tmp'
+        with open(tmp_name, 'wb') as file_:
+            BaseRLModel._save_to_file(file_, data=data, params=params)
+        os.replace(tmp_name, file_name)
+        if self.manifest is not None:
+            self.manifest.add(file_name, self.run, step, reward, wall_time)
+
+        with self.lock:
+            if not best:
+                self.last.append(file_name)
+                pruned = self.last[:max(len(self.last) - self.keep_last, 0)] if self.keep_last is not None else []
+                self.last = self.last[len(pruned):]
+            else:
+                self.best.append((reward, file_name))
+                self.best.sort(key=lambda item: -item[0])
+                pruned = [name for _, name in self.best[self.keep_best:]] if self.keep_best is not None else []
+                self.best = self.best[:len(self.best) - len(pruned)]
+
+        for name in pruned:
+            if os.path.exists(name):
+                os.remove(name)
+            if self.manifest is not None:
+                self.manifest.remove(name)
+
+
+# model_dir/sac file names from before the manifest: test_<run>_rew_<mean reward> for best models,
+# test_<run>_<day>_<hour>_<min>.zip for the latest ones
+BEST_NAME = re.compile(r'^test_(\d+)_rew_(-?\d+(?:\.\d+)?)(?:\.zip)?$')
+LATEST_NAME = re.compile(r'^test_(\d+)_(\d+)_(\d+)_(\d+)\.zip$')
+
+
+class CheckpointManifest:
+    """
+    Append-only index of the checkpoints in a model directory, manifest.jsonl, one JSON entry per line:
+    {"run", "step", "time", "reward", "path"} for a written checkpoint, {"removed": path} for a pruned one.
+    The best, latest and best per run entries are kept up to date on every add, queries are O(1).
+    A new manifest imports the checkpoints already in the directory from their file names.
+
+    :param model_dir: (str)
+    """
+
+    FILE_NAME = 'manifest.jsonl'
+
+    def __init__(self, model_dir):
+        self.model_dir = model_dir
+        self.path = os.path.join(model_dir, self.FILE_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}  # path -> entry, live checkpoints
+        self.runs = set()
+        self._best = None
+        self._latest = None
+        self._best_of_run = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as file_:
+                for line in file_:
+                    if line.strip():
+                        self._apply(json.loads(line))
+        else:
+            os.makedirs(model_dir, exist_ok=True)
+            self.import_existing()
+
+    def add(self, path, run, step=None, reward=None, wall_time=None):
+        """
+        Record a written checkpoint.
+
+        :param path: (str) checkpoint file, stored relative to model_dir
+        :param run: (int) run id
+        :param step: (int) training step, None if unknown
+        :param reward: (float) mean reward, None if unknown
+        :param wall_time: (float) time.time() of the checkpoint, default now
+        """
+        entry = {'run': run, 'step': step, 'time': time.time() if wall_time is None else wall_time,
+                 'reward': None if reward is None else float(reward),
+                 'path': os.path.relpath(path, self.model_dir)}
+        self._append(entry)
+
+    def remove(self, path):
+        self._append({'removed': os.path.relpath(path, self.model_dir)})
+
+    def _append(self, entry):
+        with self.lock:
+            with open(self.path, 'a') as file_:
+                file_.write(json.dumps(entry) + '\n')
+            self._apply(entry)
+
+    def _apply(self, entry):
+        if 'removed' in entry:
+            removed = self.entries.pop(entry['removed'], None)
+            if removed is not None and removed in [self._best, self._latest, self._best_of_run.get(removed['run'])]:
+                self._reindex()
+            return
+
+        self.entries[entry['path']] = entry
+        self.runs.add(entry['run'])
+        self._index(entry)
+
+    def _index(self, entry):
+        if entry['reward'] is not None:
+            if self._best is None or entry['reward'] > self._best['reward']:
+                self._best = entry
+            run_best = self._best_of_run.get(entry['run'])
+            if run_best is None or entry['reward'] > run_best['reward']:
+                self._best_of_run[entry['run']] = entry
+        if self._latest is None or entry['time'] >= self._latest['time']:
+            self._latest = entry
+
+    def _reindex(self):
+        # only when an indexed checkpoint is pruned
+        self._best, self._latest, self._best_of_run = None, None, {}
+        for entry in self.entries.values():
+            self._index(entry)
+
+    def _file(self, entry):
+        return None if entry is None else os.path.join(self.model_dir, entry['path'])
+
+    def best(self):
+        # file of the checkpoint with the highest mean reward, None if there is none
+        return self._file(self._best)
+
+    def latest(self):
+        return self._file(self._latest)
+
+    def best_of_run(self, run):
+        return self._file(self._best_of_run.get(run))
+
+    def entry(self, path):
+        return self.entries.get(os.path.relpath(path, self.model_dir))
+
+    def next_run(self):
+        return max(self.runs) + 1 if self.runs else 0
+
+    def import_existing(self):
+        """
+        One time import of the checkpoints in model_dir named by the old save_fn, oldest first: by run, then
+        by the day, hour and minute in the latest checkpoint names (best checkpoint names have none, their
+        modification time gives them), then by modification time. Copies reset the modification times, so
+        they only break ties. Their step is unknown and the wall time is the modification time, raised where
+        needed to keep the import order.
+        """
+        found = []
+        for name in os.listdir(self.model_dir):
+            best, latest = BEST_NAME.match(name), LATEST_NAME.match(name)
+            if best or latest:
+                mtime = os.path.getmtime(os.path.join(self.model_dir, name))
+                if latest:
+                    stamp = tuple(int(value) for value in latest.group(2, 3, 4))
+                else:
+                    local = time.localtime(mtime)
+                    stamp = (local.tm_mday, local.tm_hour, local.tm_min)
+                found.append(((int((best or latest).group(1)),) + stamp + (mtime,), name,
+                              float(best.group(2)) if best else None))
+
+        wall_time = -float('inf')
+        for key, name, reward in sorted(found):
+            wall_time = max(wall_time, key[-1])
+            self.add(os.path.join(self.model_dir, name), key[0], reward=reward, wall_time=wall_time)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# convert a recording to the frame format: each unique frame of the hist_size observation stacks is stored
+# once, in float32 or quantized, e.g.
+# python convert_recording.py saved_experts/PickUp_40_episodes saved_experts/PickUp_40_episodes_frames --quantize uint16
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from expert_data import EpisodeIndex, load_trajectories
+from recorder import NpyAppender
+
+CHUNK_SIZE = 65536  # rows copied at a time
+
+
+def episode_frames(obs, hist_size):
+    # unique frames of one episode, consecutive stacks must overlap by hist_size - 1 frames
+    frame_dim = obs.shape[1] // hist_size
+    if hist_size > 1 and not np.array_equal(obs[1:, :-frame_dim], obs[:-1, frame_dim:]):
+        raise ValueError('observations are not {} frame stacks, try a smaller hist_size'.format(hist_size))
+
+    return np.concatenate((obs[0].reshape(hist_size, frame_dim), obs[1:, -frame_dim:]))
+
+
+def convert_recording(path, out_path, hist_size=3, quantize=None):
+    """
+    Convert a recording directory to the frame format loaded by expert_data.load_trajectories.
+
+    :param path: (str) recording directory
+    :param out_path: (str) output directory
+    :param hist_size: (int) frames per observation, BaseEnv.hist_size at recording time
+    :param quantize: (str) None for float32 frames, 'uint8' or 'uint16' for per dimension linear quantization
+    """
+    data = load_trajectories(path)
+    index = EpisodeIndex.build(data)
+    obs = data['obs']
+    if obs.shape[1] % hist_size:
+        raise ValueError('observation size {} is not a multiple of hist_size {}'.format(obs.shape[1], hist_size))
+    frame_dim = obs.shape[1] // hist_size
+
+    os.makedirs(out_path, exist_ok=True)
+
+    frame_min, frame_scale = None, None
+    if quantize:
+        levels = np.iinfo(quantize).max
+        frame_min = np.full(frame_dim, np.inf)
+        frame_max = np.full(frame_dim, -np.inf)
+        for start in range(0, len(obs), CHUNK_SIZE):
+            chunk = np.asarray(obs[start:start + CHUNK_SIZE]).reshape(-1, frame_dim)
+            frame_min = np.minimum(frame_min, chunk.min(axis=0))
+            frame_max = np.maximum(frame_max, chunk.max(axis=0))
+        frame_scale = np.maximum(frame_max - frame_min, 1e-12) / levels
+        np.save(os.path.join(out_path, 'frame_min.npy'), frame_min.astype(np.float32))
+        np.save(os.path.join(out_path, 'frame_scale.npy'), frame_scale.astype(np.float32))
+
+    n_frames = len(obs) + len(index) * (hist_size - 1)
+    index_dtype = np.int32 if n_frames < np.iinfo(np.int32).max else np.int64
+    frames = NpyAppender(os.path.join(out_path, 'frames.npy'), (frame_dim,), quantize or np.float32)
+    frame_index = NpyAppender(os.path.join(out_path, 'frame_index.npy'), (), index_dtype)
+
+    for start, end in zip(index.starts, index.ends):
+        ep_frames = episode_frames(np.asarray(obs[start:end]), hist_size)
+        if quantize:
+            ep_frames = np.round((ep_frames - frame_min) / frame_scale)
+        frame_index.append(frames.rows + np.arange(end - start))
+        frames.append(ep_frames)
+
+    for appender in (frames, frame_index):
+        appender.commit()
+        appender.close()
+
+    dtypes = {'actions': np.float32, 'rewards': np.float64, 'episode_starts': np.bool_, 'episode_returns': np.float64}
+    for key, dtype in dtypes.items():
+        out = NpyAppender(os.path.join(out_path, key + '.npy'), data[key].shape[1:], dtype)
+        for start in range(0, len(data[key]), CHUNK_SIZE):
+            out.append(data[key][start:start + CHUNK_SIZE])
+        out.commit()
+        out.close()
+
+    with open(os.path.join(out_path, 'frames.json'), 'w') as f:
+        json.dump({'hist_size': hist_size, 'quantize': quantize}, f)
+
+    old_size = sum(data[key].nbytes for key in ['obs', 'actions'])
+    new_size = sum(os.path.getsize(os.path.join(out_path, name)) for name in ['frames.npy', 'frame_index.npy',
+                                                                                  'actions.npy'])
+    print('obs + actions: {:.1f} MB -> {:.1f} MB'.format(old_size / 1e6, new_size / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a recording to deduplicated, reduced precision frames')
+    parser.add_argument('path', help='recording directory')
+    parser.add_argument('out_path', help='output directory')
+    parser.add_argument('--hist-size', type=int, default=3, help='frames per observation')
+    parser.add_argument('--quantize', choices=['uint8', 'uint16'], default=None, help='quantize frames')
+    args = parser.parse_args()
+
+    convert_recording(args.path, args.out_path, args.hist_size, args.quantize)
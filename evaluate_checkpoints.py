@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# rank checkpoints by running the same seeded episodes with each of them on a pool of env workers, e.g.
+# python evaluate_checkpoints.py PushStonesEnv --model-dir stable_bl/PushStonesEnv/model_dir/sac --query all \
+#     --backend standin --episodes 20 --workers 8
+
+import argparse
+import csv
+import multiprocessing
+import os
+
+import numpy as np
+from scipy import stats
+
+# per worker process, set by init_worker
+_env = None
+_models = {}
+
+
+def checkpoint_paths(model_dir, query):
+    """
+    Checkpoint files from the manifest of model_dir.
+
+    :param model_dir: (str)
+    :param query: (str) 'best', 'latest', 'run:<k>' for the best of run k, or 'all'
+    :return: ([str])
+    """
+    from checkpoints import CheckpointManifest
+
+    manifest = CheckpointManifest(model_dir)
+    if query == 'all':
+        paths = [os.path.join(model_dir, path) for path in manifest.entries]
+    elif query.startswith('run:'):
+        paths = [manifest.best_of_run(int(query[len('run:'):]))]
+    else:
+        paths = [{'best': manifest.best, 'latest': manifest.latest}[query]()]
+
+    return [path for path in paths if path is not None]
+
+
+def init_worker(mission, backend, num_stones):
+    global _env
+    from standin_env import make_env
+
+    _env = make_env(mission, backend, num_stones)
+
+
+def worker_env():
+    return _env
+
+
+def load_model(path):
+    from inference_service import InferenceClient, load_policy
+
+    # one model per worker at a time, the tasks are whole checkpoints
+    if path not in _models:
+        _models.clear()
+        if path.startswith('unix:'):  # an inference_service.py server, batching all the workers
+            _models[path] = InferenceClient(path[len('unix:'):])
+        else:
+            _models[path] = load_policy(path)
+    return _models[path]
+
+
+def run_episodes(task):
+    """
+    :param task: (str, [int], bool) checkpoint file, episode seeds, deterministic actions
+    :return: (str, np.ndarray) checkpoint file, (n_episodes, 3) return, length, success per episode
+    """
+    path, seeds, deterministic = task
+    model = load_model(path)
+
+    results = []
+    for seed in seeds:
+        # the Unity scene is not seeded, the stand-in env and a stochastic policy are
+        _env.seed(seed)
+        model.set_random_seed(seed)
+        obs = _env.reset()
+        done, episode_return, length, info = False, 0., 0, {}
+        while not done:
+            action, _ = model.predict(obs, deterministic=deterministic)
+            obs, reward, done, info = _env.step(action)
+            episode_return += reward
+            length += 1
+        results.append((episode_return, length, info.get('reset reason') == 'sim success'))
+
+    return path, np.array(results, dtype=np.float64)
+
+
+def mean_ci(values, confidence=0.95):
+    # mean and half width of its t confidence interval
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        return float(np.mean(values)), float('nan')
+    half_width = stats.t.ppf(0.5 + confidence / 2, len(values) - 1) * stats.sem(values)
+    return float(np.mean(values)), float(half_width)
+
+
+def wilson_ci(successes, n, confidence=0.95):
+    # Wilson score interval of a success rate, undefined without episodes
+    if n == 0:
+        return np.nan, np.nan
+    z = stats.norm.ppf(0.5 + confidence / 2)
+    rate = successes / n
+    center = (rate + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    half_width = z * np.sqrt(rate * (1 - rate) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return center - half_width, center + half_width
+
+
+def pool_size(backend, workers=None):
+    """
+    Worker processes for a backend: the simulation runs one env per machine, the stand-in one per worker.
+
+    :param backend: (str) 'sim' or 'standin'
+    :param workers: (int) requested processes, default 1 for 'sim' and one per cpu for 'standin'
+    :return: (int)
+    """
+    if backend == 'sim':
+        if workers not in [None, 1]:
+            raise ValueError('the simulation runs one env per machine, use workers=1 with backend sim')
+        return 1
+    return workers or os.cpu_count()
+
+
+def evaluate_checkpoints(paths, mission, backend='sim', num_stones=1, n_episodes=10, seed=0, workers=None,
+                         deterministic=True):
+    """
+    Run the same n_episodes seeded episodes with every checkpoint on a process pool, one env per worker.
+
+    :param paths: ([str]) checkpoint files
+    :param mission: (str) e.g. 'PushStonesEnv'
+    :param backend: (str) 'sim' or 'standin', see standin_env.make_env
+    :param num_stones: (int)
+    :param n_episodes: (int) episodes per checkpoint
+    :param seed: (int) the episode seeds are seed, seed + 1, ...
+    :param workers: (int) processes, see pool_size
+    :param deterministic: (bool) deterministic policy actions
+    :return: ([dict]) per checkpoint: path, episodes, return, return_ci, success, success_low,
+        success_high, length, length_ci, sorted by mean return
+    """
+    seeds = list(range(seed, seed + n_episodes))
+    tasks = [(path, seeds, deterministic) for path in paths]
+
+    # spawn: a forked TF session is not usable in the children
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(pool_size(backend, workers), initializer=init_worker, initargs=(mission, backend, num_stones)) as pool:
+        results = dict(pool.imap_unordered(run_episodes, tasks))
+
+    table = []
+    for path in paths:
+        returns, lengths, successes = results[path].T
+        mean_return, return_ci = mean_ci(returns)
+        mean_length, length_ci = mean_ci(lengths)
+        success_low, success_high = wilson_ci(successes.sum(), len(successes))
+        table.append({'path': path, 'episodes': len(returns), 'return': mean_return, 'return_ci': return_ci,
+                      'success': float(successes.mean()), 'success_low': success_low,
+                      'success_high': success_high, 'length': mean_length, 'length_ci': length_ci})
+
+    return sorted(table, key=lambda row: -row['return'])
+
+
+def print_table(table):
+    print('{:<40}{:>22}{:>22}{:>18}'.format('checkpoint', 'return', 'success', 'length'))
+    for row in table:
+        print('{:<40}{:>12.1f} ± {:<7.1f}{:>8.2f} [{:.2f}, {:.2f}]{:>10.1f} ± {:<5.1f}'.format(
+            os.path.basename(row['path']), row['return'], row['return_ci'], row['success'], row['success_low'],
+            row['success_high'], row['length'], row['length_ci']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate checkpoints on a pool of env workers')
+    parser.add_argument('mission', help="env name without '-v0', e.g. PushStonesEnv")
+    parser.add_argument('--checkpoints', nargs='*', default=[], help='checkpoint files')
+    parser.add_argument('--model-dir', help='directory with a checkpoint manifest')
+    parser.add_argument('--query', default='all', help="manifest query: best, latest, run:<k> or all")
+    parser.add_argument('--backend', choices=['sim', 'standin'], default='sim')
+    parser.add_argument('--num-stones', type=int, default=1)
+    parser.add_argument('--episodes', type=int, default=10, help='episodes per checkpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='default 1 for sim, one per cpu for standin')
+    parser.add_argument('--stochastic', action='store_true', help='sample the policy actions')
+    parser.add_argument('--csv', help='also write the table to this file')
+    args = parser.parse_args()
+
+    paths = list(args.checkpoints)
+    if args.model_dir:
+        paths += checkpoint_paths(args.model_dir, args.query)
+
+    table = evaluate_checkpoints(paths, args.mission, args.backend, args.num_stones, args.episodes, args.seed,
+                                 args.workers, not args.stochastic)
+    print_table(table)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(table[0]) if table else ['path'])
+            writer.writeheader()
+            writer.writerows(table)
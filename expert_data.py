@@ -0,0 +1,410 @@
+import json
+import os
+
+import numpy as np
+
+from recorder import KEYS
+
+# file names used by older recordings (data_saver)
+LEGACY_NAMES = {'obs': 'obs', 'actions': 'act', 'rewards': 'rew', 'episode_starts': 'ep_str',
+                'episode_returns': 'ep_ret'}
+
+
+class ConcatArray:
+    """
+    Read-only concatenation of arrays along the first axis, without copying them.
+    Slices inside a single part return a view, index arrays gather only the requested rows.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+        self.shape = (int(self.offsets[-1]),) + parts[0].shape[1:]
+        self.dtype = parts[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _locate(self, index):
+        part = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        return part, index - self.offsets[part]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            rows = self[index[0]]
+            if isinstance(index[0], (int, np.integer)):
+                return rows[index[1:]]
+            return rows[(slice(None),) + index[1:]]
+
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('index {} is out of bounds for size {}'.format(index, len(self)))
+            part, ind = self._locate(index)
+            return self.parts[part][ind]
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1 and start < stop:
+                first, _ = self._locate(start)
+                last, _ = self._locate(stop - 1)
+                parts = [self.parts[part][max(start - self.offsets[part], 0):stop - self.offsets[part]]
+                         for part in range(first, last + 1)]
+                return parts[0] if len(parts) == 1 else ConcatArray(parts)
+            index = np.arange(start, stop, step)
+
+        index = np.asarray(index)
+        if index.dtype == np.bool_:
+            index = np.flatnonzero(index)
+        index = np.where(index < 0, index + len(self), index)
+
+        parts = np.searchsorted(self.offsets, index, side='right') - 1
+        out = np.empty(index.shape + self.shape[1:], dtype=self.dtype)
+        for part in np.unique(parts):
+            mask = parts == part
+            out[mask] = self.parts[part][index[mask] - self.offsets[part]]
+
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        # explicit full copy, e.g. np.asarray(data['obs'])
+        out = np.concatenate(self.parts)
+        return out if dtype is None else out.astype(dtype)
+
+
+class StackedObs:
+    """
+    Observations of a frame recording (see convert_recording.py), rebuilt on access from the unique frames:
+    obs[t] = frames[frame_index[t]:frame_index[t] + hist_size].flatten(). Quantized frames are scaled back
+    to float32.
+
+    :param frames: (np.ndarray) (n_frames, frame_dim) unique frames
+    :param frame_index: (np.ndarray) first frame of each step's stack
+    :param hist_size: (int) frames per observation
+    :param frame_min: (np.ndarray) per dimension offset of quantized frames, None if not quantized
+    :param frame_scale: (np.ndarray) per dimension scale of quantized frames
+    """
+
+    def __init__(self, frames, frame_index, hist_size, frame_min=None, frame_scale=None):
+        self.frames = frames
+        self.frame_index = frame_index
+        self.hist_size = hist_size
+        self.frame_min = frame_min
+        self.frame_scale = frame_scale
+        self.shape = (len(frame_index), hist_size * frames.shape[1])
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            rows = self[index[0]]
+            if isinstance(index[0], (int, np.integer)):
+                return rows[index[1:]]
+            return rows[(slice(None),) + index[1:]]
+
+        if isinstance(index, slice):
+            # lazy view
+            return StackedObs(self.frames, self.frame_index[index], self.hist_size, self.frame_min, self.frame_scale)
+
+        first = np.asarray(self.frame_index[index])
+        stacks = self.frames[first[..., None] + np.arange(self.hist_size)]
+        if self.frame_min is None:
+            stacks = stacks.astype(np.float32)
+        else:
+            stacks = stacks * self.frame_scale + self.frame_min
+
+        return stacks.reshape(first.shape + self.shape[1:])
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[np.arange(len(self))]
+        return out if dtype is None else out.astype(dtype)
+
+
+def _load_frames(path, mmap_mode='r'):
+    with open(os.path.join(path, 'frames.json')) as f:
+        meta = json.load(f)
+    frame_min, frame_scale = None, None
+    if meta['quantize']:
+        frame_min = np.load(os.path.join(path, 'frame_min.npy'))
+        frame_scale = np.load(os.path.join(path, 'frame_scale.npy'))
+
+    return StackedObs(np.load(os.path.join(path, 'frames.npy'), mmap_mode=mmap_mode),
+                      np.load(os.path.join(path, 'frame_index.npy'), mmap_mode=mmap_mode),
+                      meta['hist_size'], frame_min, frame_scale)
+
+
+def _array_file(path, key):
+    # .npy file of a recording array, under its current or legacy name
+    file_path = os.path.join(path, key + '.npy')
+    if not os.path.exists(file_path):
+        file_path = os.path.join(path, LEGACY_NAMES[key] + '.npy')
+    return file_path
+
+
+def _load_dir(path, mmap_mode='r'):
+    arrays = {}
+    for key in KEYS:
+        if key == 'obs' and os.path.exists(os.path.join(path, 'frames.json')):
+            arrays[key] = _load_frames(path, mmap_mode)
+            continue
+        arrays[key] = np.load(_array_file(path, key), mmap_mode=mmap_mode)
+
+    # leave out steps of an unfinished last episode (interrupted ChunkedRecorder session)
+    n_episodes = len(arrays['episode_returns'])
+    start_ind = np.flatnonzero(arrays['episode_starts'])
+    if len(start_ind) > n_episodes:
+        for key in KEYS[:4]:
+            arrays[key] = arrays[key][:start_ind[n_episodes]]
+
+    return arrays
+
+
+def load_trajectories(paths, mmap_mode='r'):
+    """
+    Memory-map one or more recording directories (obs, actions, rewards, episode_starts, episode_returns)
+    as a single ExpertDataset traj_data dict. Nothing is read into memory until it is indexed.
+
+    :param paths: (str or [str]) recording directories, e.g. saved_experts/3_rocks_40_episodes
+    :param mmap_mode: (str) np.load mmap mode, None loads the arrays into memory
+    :return: (dict) key -> np.memmap, or ConcatArray for several directories
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    dirs = [_load_dir(path, mmap_mode) for path in paths]
+
+    if len(dirs) == 1:
+        return dirs[0]
+
+    for key in KEYS:
+        shapes = set(d[key].shape[1:] for d in dirs)
+        if len(shapes) > 1:
+            raise ValueError('{} shapes do not match between recordings: {}'.format(key, shapes))
+
+    return {key: ConcatArray([d[key] for d in dirs]) for key in KEYS}
+
+
+class MmapLoader:
+    """
+    Minibatch iterator over a subset of transition indices. Only the rows of each minibatch are read.
+
+    :param indices: (np.ndarray) transition indices of this split
+    :param observations: (np.ndarray or ConcatArray)
+    :param actions: (np.ndarray or ConcatArray)
+    :param batch_size: (int)
+    :param shuffle: (bool) reshuffle the indices every epoch
+    """
+
+    def __init__(self, indices, observations, actions, batch_size, shuffle=True):
+        self.indices = indices
+        self.observations = observations
+        self.actions = actions
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self._order = indices
+        self._batch = 0
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __iter__(self):
+        self._batch = 0
+        if self.shuffle:
+            self._order = np.random.permutation(self.indices)
+        return self
+
+    def __next__(self):
+        if self._batch >= len(self):
+            raise StopIteration
+        # sorted reads are sequential in the file
+        batch = np.sort(self._order[self._batch * self.batch_size:(self._batch + 1) * self.batch_size])
+        self._batch += 1
+        return self.observations[batch], self.actions[batch]
+
+
+class MmapExpertDataset:
+    """
+    Lazy drop-in for stable_baselines ExpertDataset (model.pretrain, GAIL), reading memory-mapped
+    recordings in place instead of an .npz copy loaded into RAM.
+
+    :param paths: (str or [str]) recording directories, loaded as one dataset
+    :param train_fraction: (float) the train/validation split (0 to 1)
+    :param batch_size: (int) minibatch size for behavior cloning
+    :param traj_limitation: (int) number of episodes to use (-1 for all)
+    :param randomize: (bool) shuffle the transitions
+    :param verbose: (int)
+    """
+
+    def __init__(self, paths, train_fraction=0.7, batch_size=64, traj_limitation=-1, randomize=True, verbose=1):
+        self.traj_data = load_trajectories(paths)
+
+        n_steps = len(self.traj_data['obs'])
+        self.returns = self.traj_data['episode_returns']
+        if traj_limitation > 0:
+            start_ind = np.flatnonzero(self.traj_data['episode_starts'][:])
+            if traj_limitation < len(start_ind):
+                n_steps = int(start_ind[traj_limitation])
+            self.returns = self.returns[:traj_limitation]
+
+        self.observations = self.traj_data['obs'][:n_steps]
+        self.actions = self.traj_data['actions'][:n_steps]
+        if self.actions.ndim == 1:
+            raise ValueError('discrete action recordings are not supported, actions must be (n_steps, action_dim)')
+
+        self.avg_ret = float(np.mean(self.returns[:]))
+        self.std_ret = float(np.std(self.returns[:]))
+        self.verbose = verbose
+        self.randomize = randomize
+
+        indices = np.random.permutation(n_steps) if randomize else np.arange(n_steps)
+        n_train = int(train_fraction * n_steps)
+        self.train_indices = np.sort(indices[:n_train])
+        self.val_indices = np.sort(indices[n_train:])
+
+        self.dataloader = None
+        self.train_loader = MmapLoader(self.train_indices, self.observations, self.actions, batch_size, randomize)
+        self.val_loader = MmapLoader(self.val_indices, self.observations, self.actions, batch_size, False)
+        self._iters = {}
+
+        if self.verbose >= 1:
+            self.log_info()
+
+    def init_dataloader(self, batch_size):
+        # used by GAIL, iterates over the whole dataset
+        self.dataloader = MmapLoader(np.arange(len(self.observations)), self.observations, self.actions,
+                                     batch_size, self.randomize)
+        self._iters.pop(None, None)
+
+    def log_info(self):
+        print("Total trajectories: {}".format(len(self.returns)))
+        print("Total transitions: {}".format(len(self.observations)))
+        print("Average returns: {}".format(self.avg_ret))
+        print("Std for returns: {}".format(self.std_ret))
+
+    def get_next_batch(self, split=None):
+        """
+        Get the batch from the dataset, restarting the loader at the end of an epoch.
+
+        :param split: (str) the type of data split (can be None, 'train', 'val')
+        :return: (np.ndarray, np.ndarray) inputs and labels
+        """
+        loader = {None: self.dataloader, 'train': self.train_loader, 'val': self.val_loader}[split]
+        if split not in self._iters:
+            self._iters[split] = iter(loader)
+        try:
+            return next(self._iters[split])
+        except StopIteration:
+            self._iters[split] = iter(loader)
+            return next(self._iters[split])
+
+
+class EpisodeIndex:
+    """
+    Episode start/end offsets, lengths and returns of a dataset, for O(1) episode access and sampling
+    without scanning episode_starts. Works on in-memory, memory-mapped and ConcatArray datasets.
+
+    :param starts: (np.ndarray) first step of each episode
+    :param ends: (np.ndarray) one past the last step of each episode
+    :param returns: (np.ndarray) episode returns
+    """
+
+    def __init__(self, starts, ends, returns):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.lengths = self.ends - self.starts
+        self.returns = np.asarray(returns, dtype=np.float64)
+
+        # return-weighted sampling, shifted to be positive
+        self._return_weights = self.returns - self.returns.min() + 1e-6 if len(self.returns) else self.returns
+        self._return_cdf = np.cumsum(self._return_weights)
+
+    @classmethod
+    def build(cls, traj_data):
+        starts = np.flatnonzero(traj_data['episode_starts'][:])
+        ends = np.append(starts[1:], len(traj_data['episode_starts']))
+        return cls(starts, ends, traj_data['episode_returns'][:])
+
+    @classmethod
+    def load(cls, paths):
+        """
+        Index of one or more recording directories, as one dataset (same order as load_trajectories).
+        Each directory index is cached in <dir>/episode_index.npz and rebuilt when the recording changed
+        (its size, or the modification time of the files the index is built from).
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+
+        indexes = []
+        offset = 0
+        for path in paths:
+            data = _load_dir(path)
+            n_steps = len(data['episode_starts'])
+            mtimes = np.array([os.path.getmtime(_array_file(path, key))
+                               for key in ['episode_starts', 'rewards', 'episode_returns']])
+            cache_path = os.path.join(path, 'episode_index.npz')
+            index = None
+            if os.path.exists(cache_path):
+                cache = np.load(cache_path)
+                if int(cache['n_steps']) == n_steps and len(cache['starts']) == len(data['episode_returns']) \
+                        and 'mtimes' in cache and np.array_equal(cache['mtimes'], mtimes):
+                    index = cls(cache['starts'], cache['ends'], cache['returns'])
+            if index is None:
+                index = cls.build(data)
+                np.savez(cache_path, starts=index.starts, ends=index.ends, returns=index.returns, n_steps=n_steps,
+                         mtimes=mtimes)
+            indexes.append((index, offset))
+            offset += n_steps
+
+        return cls(np.concatenate([index.starts + offset for index, offset in indexes]),
+                   np.concatenate([index.ends + offset for index, offset in indexes]),
+                   np.concatenate([index.returns for index, _ in indexes]))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def episode(self, traj_data, k):
+        # step arrays of episode k, views for in-memory and memory-mapped data
+        return {key: traj_data[key][self.starts[k]:self.ends[k]] for key in KEYS[:4]}
+
+    @staticmethod
+    def _sample_cdf(cdf, n):
+        # n indexes drawn proportional to the increments of an unnormalized cdf, never one of weight 0
+        # (side='right' skips their flat steps), clipped for a draw that rounds up to cdf[-1]
+        last = np.flatnonzero(np.diff(cdf, prepend=0.))[-1]
+        return np.minimum(np.searchsorted(cdf, np.random.random_sample(n) * cdf[-1], side='right'), last)
+
+    def sample_episodes(self, n, by_return=False):
+        if by_return:
+            return self._sample_cdf(self._return_cdf, n)
+        return np.random.randint(len(self), size=n)
+
+    def sample_windows(self, n, length, by_return=False):
+        """
+        Start steps of n windows of fixed length that lie inside a single episode.
+
+        :param n: (int) number of windows
+        :param length: (int) window length
+        :param by_return: (bool) sample episodes proportional to return, otherwise all windows are equally likely
+        :return: (np.ndarray) dataset index of the first step of each window
+        """
+        n_windows = np.maximum(self.lengths - length + 1, 0)
+        if not n_windows.any():
+            raise ValueError('no episode is at least {} steps long'.format(length))
+
+        if by_return:
+            # episodes too short for the window have weight 0
+            episodes = self._sample_cdf(np.cumsum(self._return_weights * (n_windows > 0)), n)
+        else:
+            cdf = np.cumsum(n_windows)
+            episodes = np.searchsorted(cdf, np.random.randint(cdf[-1], size=n), side='right')
+
+        return self.starts[episodes] + (np.random.random_sample(n) * n_windows[episodes]).astype(np.int64)
+
+    @staticmethod
+    def windows(array, window_starts, length):
+        # (n, length, ...) windows gathered from array, only the requested rows are read
+        return array[window_starts[:, None] + np.arange(length)]
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# export the actor of a stable-baselines SAC zip to a .npz and run it with numpy only, e.g.
+# python frozen_policy.py export stable_bl/PushStonesEnv/model_dir/sac/test_3_15_10_59.zip test_3.npz
+# python frozen_policy.py parity stable_bl/PushStonesEnv/model_dir/sac/test_3_15_10_59.zip test_3.npz saved_experts/...
+
+import argparse
+import io
+import json
+import re
+import time
+import zipfile
+
+import numpy as np
+
+ACTIVATIONS = {
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': lambda x: np.tanh(x, out=x),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+}
+
+# act_fun as stored in a SAC zip
+FUNCTION_REPR = re.compile(r'^<function ([\w.]+) at 0x[0-9a-fA-F]+>$')
+
+
+def _space_bounds(space):
+    # low / high of a Box are stored by data_to_json as their numpy string representation
+    return [np.array(space[key].strip('[]').split(), dtype=np.float32).reshape(space['shape'])
+            for key in ['low', 'high']]
+
+
+LOG_STD_MIN, LOG_STD_MAX = -20, 2  # as stable_baselines.sac.policies
+
+
+def activation_name(act_fun):
+    """
+    The ACTIVATIONS name of an act_fun policy kwarg.
+
+    :param act_fun: (callable or str) the function, its name, or its string representation as stored in a SAC
+        zip, e.g. '<function tanh at 0x7f...>'
+    :return: (str)
+    """
+    if callable(act_fun):
+        name = getattr(act_fun, '__name__', None)
+    else:
+        match = FUNCTION_REPR.match(str(act_fun))
+        name = match.group(1) if match else str(act_fun)
+    if name not in ACTIVATIONS:
+        raise ValueError('unsupported activation {}'.format(act_fun))
+    return name
+
+
+def actor_arrays(params, policy_kwargs, action_low, action_high):
+    """
+    The actor of a SAC model as the arrays of a NumpyPolicy: the weights and biases of the hidden layers,
+    of the mean and log std layers, the activation and the action bounds.
+
+    :param params: (dict) parameter name -> array, the 'parameters' of a SAC zip or model.get_parameters()
+    :param policy_kwargs: (dict) of the model, for the activation and layer normalization
+    :param action_low: (np.ndarray)
+    :param action_high: (np.ndarray)
+    :return: (dict) name -> np.ndarray
+    """
+    policy_kwargs = policy_kwargs or {}
+    if policy_kwargs.get('layer_norm') in [True, 'True']:
+        raise ValueError('layer normalization is not supported')
+    activation = 'relu'
+    if 'act_fun' in policy_kwargs:
+        activation = activation_name(policy_kwargs['act_fun'])
+
+    arrays = {}
+    i = 0
+    while 'model/pi/fc{}/kernel:0'.format(i) in params:
+        arrays['layer_{}'.format(2 * i)] = params['model/pi/fc{}/kernel:0'.format(i)]
+        arrays['layer_{}'.format(2 * i + 1)] = params['model/pi/fc{}/bias:0'.format(i)]
+        i += 1
+    arrays.update(mu_kernel=params['model/pi/dense/kernel:0'], mu_bias=params['model/pi/dense/bias:0'],
+                  log_std_kernel=params['model/pi/dense_1/kernel:0'], log_std_bias=params['model/pi/dense_1/bias:0'],
+                  action_low=action_low, action_high=action_high)
+    arrays = {key: np.asarray(array, dtype=np.float32) for key, array in arrays.items()}
+    arrays['activation'] = np.array(activation)
+
+    return arrays
+
+
+def export_policy(zip_path, out_path):
+    """
+    Write the actor of a SAC checkpoint as a .npz, see actor_arrays. Reads the zip directly,
+    without TensorFlow.
+
+    :param zip_path: (str) stable-baselines SAC zip
+    :param out_path: (str) .npz file
+    """
+    with zipfile.ZipFile(zip_path) as file_:
+        data = json.loads(file_.read('data').decode())
+        params = np.load(io.BytesIO(file_.read('parameters')))
+        param_names = json.loads(file_.read('parameter_list').decode())
+
+    low, high = _space_bounds(data['action_space'])
+    np.savez(out_path, **actor_arrays({name: params[name] for name in param_names}, data.get('policy_kwargs'),
+                                      low, high))
+
+
+class NumpyPolicy:
+    """
+    SAC policy of an exported .npz, scaled to the action space as SAC.predict does: tanh of the mean of
+    the actor MLP, or of a sample of its gaussian when not deterministic. Same predict signature as
+    stable-baselines models, batched or single.
+
+    :param path: (str) .npz written by export_policy, or None for from_arrays
+    """
+
+    def __init__(self, path):
+        self.rng = np.random.RandomState()
+        if path is not None:
+            with np.load(path) as file_:
+                self.set_arrays(dict(file_))
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # e.g. actor_arrays of a model in training
+        policy = cls(None)
+        policy.set_arrays(arrays)
+        return policy
+
+    def set_arrays(self, arrays):
+        n_layers = len([key for key in arrays if key.startswith('layer_')]) // 2
+        self.layers = [(arrays['layer_{}'.format(2 * k)], arrays['layer_{}'.format(2 * k + 1)])
+                       for k in range(n_layers)]
+        self.mu = (arrays['mu_kernel'], arrays['mu_bias'])
+        # exports without it are deterministic only
+        self.log_std = (arrays['log_std_kernel'], arrays['log_std_bias']) if 'log_std_kernel' in arrays else None
+        self.action_low, self.action_high = arrays['action_low'], arrays['action_high']
+        self.activation = ACTIVATIONS[str(arrays['activation'])]
+        self.obs_dim = (self.layers[0][0] if self.layers else self.mu[0]).shape[0]
+
+    def set_random_seed(self, seed):
+        self.rng = np.random.RandomState(seed)
+
+    def predict(self, observation, state=None, mask=None, deterministic=True):
+        observation = np.asarray(observation, dtype=np.float32)
+        single = observation.ndim == 1
+        h = observation.reshape(-1, self.obs_dim)
+        for kernel, bias in self.layers:
+            h = self.activation(h.dot(kernel) + bias)
+        actions = h.dot(self.mu[0]) + self.mu[1]
+        if not deterministic and self.log_std is not None:
+            log_std = np.clip(h.dot(self.log_std[0]) + self.log_std[1], LOG_STD_MIN, LOG_STD_MAX)
+            actions += np.exp(log_std) * self.rng.standard_normal(actions.shape)
+        actions = np.tanh(actions)
+        actions = self.action_low + 0.5 * (actions + 1.) * (self.action_high - self.action_low)
+
+        return (actions[0] if single else actions), None
+
+
+def check_parity(zip_path, npz_path, observations, atol=1e-4):
+    """
+    Compare NumpyPolicy to SAC.load(zip_path).predict, deterministic, on a batch of observations.
+
+    :param observations: (np.ndarray) e.g. recorded obs, same size as the model's observation space
+    :return: (float) largest absolute action difference
+    """
+    from stable_baselines import SAC
+
+    observations = np.asarray(observations, dtype=np.float32)
+    expected, _ = SAC.load(zip_path).predict(observations, deterministic=True)
+    actions, _ = NumpyPolicy(npz_path).predict(observations)
+    max_diff = float(np.max(np.abs(actions - expected)))
+    if max_diff > atol:
+        raise AssertionError('numpy policy differs from SAC.predict by {:.2e} > {:.0e}'.format(max_diff, atol))
+
+    return max_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a SAC actor to numpy and check it against the model')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('zip_path')
+    export_parser.add_argument('out_path')
+    parity_parser = subparsers.add_parser('parity')
+    parity_parser.add_argument('zip_path')
+    parity_parser.add_argument('npz_path')
+    parity_parser.add_argument('recordings', nargs='+', help='recording directories with observations to compare')
+    parity_parser.add_argument('--n-obs', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_policy(args.zip_path, args.out_path)
+        policy = NumpyPolicy(args.out_path)
+        obs = np.zeros(policy.obs_dim, dtype=np.float32)
+        start = time.time()
+        for _ in range(10000):
+            policy.predict(obs)
+        print('{}: {:.1f} us per single observation predict'.format(args.out_path, (time.time() - start) * 100))
+    elif args.command == 'parity':
+        from expert_data import load_trajectories
+
+        obs = np.asarray(load_trajectories(args.recordings)['obs'][:args.n_obs])
+        print('max action difference: {:.2e}'.format(check_parity(args.zip_path, args.npz_path, obs)))
+    else:
+        parser.print_help()
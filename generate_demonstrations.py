@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# roll out a trained checkpoint on a pool of env workers and record the episodes that pass the filters as
+# demonstrations, in the layout of the record job, e.g.
+# python generate_demonstrations.py PushStonesEnv stable_bl/PushStonesEnv/model_dir/sac/test_55_rew_65444.6 \
+#     saved_experts/PushStones_synthetic --backend standin --episodes 5000 --workers 8 --noise-std 0.1 --success-only
+
+import argparse
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from evaluate_checkpoints import init_worker, load_model, pool_size, worker_env
+from recorder import ChunkedRecorder
+
+SEED_FILE = 'generation.json'
+
+
+def load_next_seed(out_path, seed):
+    # first seed not rolled out yet by the runs recorded in out_path, seed for a new recording
+    seed_path = os.path.join(out_path, SEED_FILE)
+    if not os.path.exists(seed_path):
+        return seed
+    with open(seed_path) as file_:
+        return json.load(file_)['next_seed']
+
+
+def save_next_seed(out_path, next_seed):
+    # written next to the final name and renamed, the seed file is always complete
+    seed_path = os.path.join(out_path, SEED_FILE)
+    with open(seed_path + '.tmp', 'w') as file_:
+        json.dump({'next_seed': next_seed}, file_)
+    os.replace(seed_path + '.tmp', seed_path)
+
+
+def rollout(task):
+    """
+    One episode on the worker's env.
+
+    :param task: (str, int, bool, float) checkpoint file, seed, deterministic actions, std of the gaussian
+        noise added to the actions
+    :return: (dict) obs, actions, rewards, return, success, seed
+    """
+    path, seed, deterministic, noise_std = task
+    env, model = worker_env(), load_model(path)
+    env.seed(seed)
+    model.set_random_seed(seed)
+    rng = np.random.RandomState(seed)
+
+    obs_list, actions, rewards = [], [], []
+    obs = env.reset()
+    done, info = False, {}
+    while not done:
+        action, _ = model.predict(obs, deterministic=deterministic)
+        if noise_std > 0:
+            action = np.clip(action + noise_std * rng.standard_normal(action.shape),
+                             env.action_space.low, env.action_space.high)
+        new_obs, reward, done, info = env.step(action)
+        obs_list.append(obs)
+        actions.append(action)
+        rewards.append(reward)
+        obs = new_obs
+
+    return {'obs': np.array(obs_list), 'actions': np.array(actions), 'rewards': np.array(rewards),
+            'return': float(np.sum(rewards)), 'success': info.get('reset reason') == 'sim success', 'seed': seed}
+
+
+def generate_demonstrations(path, out_path, mission, n_episodes, backend='sim', num_stones=1, workers=None,
+                            seed=0, deterministic=True, noise_std=0., success_only=False, min_return=None,
+                            max_attempts=None):
+    """
+    Record n_episodes episodes of a checkpoint that pass the filters into out_path, the layout loaded by
+    expert_data.load_trajectories and ExpertDataset. Episodes are rolled out on a process pool and written
+    by this process only. The next seed is kept in out_path/generation.json, an interrupted run continues
+    from the episodes already in out_path with the seeds after the ones already rolled out.
+
+    :param path: (str) checkpoint file
+    :param out_path: (str) recording directory
+    :param mission: (str) e.g. 'PushStonesEnv'
+    :param n_episodes: (int) episodes to keep
+    :param backend: (str) 'sim' or 'standin', see standin_env.make_env
+    :param num_stones: (int)
+    :param workers: (int) processes, see evaluate_checkpoints.pool_size
+    :param seed: (int) episode k of a new recording uses seed + k
+    :param deterministic: (bool) deterministic policy actions, before the noise
+    :param noise_std: (float) std of the gaussian exploration noise on the actions
+    :param success_only: (bool) keep only 'sim success' episodes
+    :param min_return: (float) keep only episodes with at least this return
+    :param max_attempts: (int) stop after this many rollouts, default 10 * n_episodes
+    :return: (int, int) episodes kept, rollouts
+    """
+    recorder = ChunkedRecorder(out_path)
+    max_attempts = 10 * n_episodes if max_attempts is None else max_attempts
+    next_seed = load_next_seed(out_path, seed)
+    attempts, kept = 0, recorder.n_episodes
+    n_workers = pool_size(backend, workers)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(n_workers, initializer=init_worker, initargs=(mission, backend, num_stones)) as pool:
+        pending = []
+        while kept < n_episodes and (pending or attempts < max_attempts):
+            # a few episodes in flight per worker, the rest is submitted as they finish
+            while len(pending) < 2 * n_workers and attempts < max_attempts:
+                pending.append(pool.apply_async(rollout, ((path, next_seed, deterministic, noise_std),)))
+                next_seed += 1
+                attempts += 1
+
+            episode = pending.pop(0).get()
+            # in flight rollouts are dropped on an interrupt, their seeds are skipped on resume
+            save_next_seed(out_path, next_seed)
+            if success_only and not episode['success']:
+                continue
+            if min_return is not None and episode['return'] < min_return:
+                continue
+
+            for step in range(len(episode['rewards'])):
+                recorder.add(episode['obs'][step], episode['actions'][step], episode['rewards'][step],
+                             step == len(episode['rewards']) - 1)
+            kept += 1
+            print('episode {} / {}: return {:.1f}, seed {}, {} rollouts'.format(kept, n_episodes, episode['return'],
+                                                                               episode['seed'], attempts))
+        pool.terminate()
+
+    recorder.close()
+    return kept, attempts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record demonstrations of a trained checkpoint in parallel')
+    parser.add_argument('mission', help="env name without '-v0', e.g. PushStonesEnv")
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument('out_path', help='recording directory')
+    parser.add_argument('--episodes', type=int, default=100, help='episodes to keep')
+    parser.add_argument('--backend', choices=['sim', 'standin'], default='sim')
+    parser.add_argument('--num-stones', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None, help='default 1 for sim, one per cpu for standin')
+    parser.add_argument('--seed', type=int, default=0, help='first seed of a new recording')
+    parser.add_argument('--stochastic', action='store_true', help='sample the policy actions')
+    parser.add_argument('--noise-std', type=float, default=0., help='gaussian noise added to the actions')
+    parser.add_argument('--success-only', action='store_true', help="keep only 'sim success' episodes")
+    parser.add_argument('--min-return', type=float, default=None, help='keep only episodes with this return')
+    parser.add_argument('--max-attempts', type=int, default=None, help='rollouts, default 10 * episodes')
+    args = parser.parse_args()
+
+    kept, attempts = generate_demonstrations(args.checkpoint, args.out_path, args.mission, args.episodes,
+                                             args.backend, args.num_stones, args.workers, args.seed,
+                                             not args.stochastic, args.noise_std, args.success_only,
+                                             args.min_return, args.max_attempts)
+    print('kept {} of {} episodes'.format(kept, attempts))
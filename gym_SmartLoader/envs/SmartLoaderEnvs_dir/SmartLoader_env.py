@@ -4,6 +4,8 @@
 
 import sys
 import time
+import threading
+from collections import deque
 from src.EpisodeManager import *
 import src.Unity2RealWorld as urw
 import gym
@@ -19,6 +21,8 @@ from std_msgs.msg import String
 from sensor_msgs.msg import Joy
 from sensor_msgs.msg import Imu
 from geometry_msgs.msg import PoseStamped, TwistStamped
+from rewards import PICK_UP_REWARD, PUSH_STONES_REWARD, StepReward
+from log_sink import get_sink
 
 
 def quatToEuler(quat):
@@ -130,6 +134,8 @@ class BaseEnv(gym.Env):
 
     def joyCB(self, data):
         self.joycon = data.axes
+        self.joy_queue.append((time.time(), data.axes))
+        self.joy_event.set()
 
     def do_action(self, agent_action):
 
@@ -153,7 +159,9 @@ class BaseEnv(gym.Env):
     def __init__(self,numStones=1):
         super(BaseEnv, self).__init__()
 
-        print('environment created!')
+        # written on the sink's thread, subsystem 'env'
+        self.log = get_sink()
+        self.log.info('env', 'environment created!')
 
         self.world_state = {}
         self.stones = {}
@@ -165,6 +173,12 @@ class BaseEnv(gym.Env):
 
         self.hist_size = 3
 
+        # per step reward terms, set in sub envs
+        self.reward_evaluator = None
+
+        # metrics.TrainingMetrics, set by the training script
+        self.metrics = None
+
         # For time step
         self.current_time = time.time()
         self.last_time = self.current_time
@@ -172,6 +186,12 @@ class BaseEnv(gym.Env):
         self.last_obs = np.array([])
         self.TIME_STEP = 0.05 # 10 mili-seconds
 
+        # timestamped joystick samples, filled by joyCB at the joystick rate
+        JOY_QUEUE_SIZE = 1000
+        self.joycon = 'waiting'
+        self.joy_queue = deque(maxlen=JOY_QUEUE_SIZE)
+        self.joy_event = threading.Event()
+
         ## ROS messages
         rospy.init_node('slagent', anonymous=False)
         self.rate = rospy.Rate(10)  # 10hz
@@ -356,7 +376,13 @@ class BaseEnv(gym.Env):
 
         self.boarders = self.scene_boarders()
 
+        if self.reward_evaluator is not None:
+            self.reward_evaluator.reset()
+
+        # drop joystick messages from blade_down
         self.joycon = 'waiting'
+        self.joy_queue.clear()
+        self.joy_event.clear()
 
         return np.array(self.obs).flatten()
 
@@ -375,9 +401,9 @@ class BaseEnv(gym.Env):
         self.time_step.append(time_step)
         self.last_time = self.current_time
 
+        joy_samples = None
         if action == 'recording':
-            while self.joycon == 'waiting':  # get action from controller
-                time.sleep(0.1)
+            joy_samples = self.joy_samples()  # get action from controller
             joy_action = self.joycon
             action = self.JoyToAgentAction(joy_action)
         else:
@@ -400,15 +426,38 @@ class BaseEnv(gym.Env):
         step_reward = r_t + final_reward
         self.total_reward = self.total_reward + step_reward
 
+        if self.metrics is not None:
+            self.metrics.add_step()
+            if done:
+                self.metrics.end_episode(self.total_reward, self.steps, reset)
+
         if done:
             self.world_state = {}
             self.stones = {}
-            print('initial distance = ', self.init_dis, ' total reward = ', self.total_reward)
+            self.log.info('env', 'initial distance = %s total reward = %s', self.init_dis, self.total_reward)
+            # episode statistics, by training step when the env counts them
+            step = self.metrics.steps if self.metrics is not None else None
+            self.log.scalar('env', 'episode_return', self.total_reward, step)
+            self.log.scalar('env', 'episode_length', self.steps, step)
 
         info = {"state": self.obs, "action": action, "reward": self.total_reward, "step": self.steps, "reset reason": reset}
+        if joy_samples is not None:
+            info["joy_samples"] = joy_samples
 
         return np.array(self.obs).flatten(), step_reward, done, info
 
+    def joy_samples(self):
+        # wake on the first joystick input of the episode, return all (time, axes) samples since last step
+        while self.joycon == 'waiting':
+            self.joy_event.wait()
+            self.joy_event.clear()
+
+        samples = []
+        while self.joy_queue:
+            samples.append(self.joy_queue.popleft())
+
+        return samples
+
     def blade_down(self):
         # take blade down near ground at beginning of episode
             joymessage = Joy()
@@ -536,10 +585,6 @@ class PickUpEnv(BaseEnv):
 
         self.marker = False
 
-        self._prev_stone_height = 0
-        self._prev_orien = 0
-        self._prev_sqr_dis_blade_stone = 0
-
         self.min_action = np.array(4*[-1.])
         self.max_action = np.array(4*[ 1.])
 
@@ -549,44 +594,25 @@ class PickUpEnv(BaseEnv):
         self.keys = ['VehiclePos', 'VehicleOrien', 'VehicleLinearVel', 'VehicleAngularVel', 'VehicleLinearAccIMU',
                 'ArmHeight', 'BladeOrien']
 
+        # orientation is only observed in the reduced state space
+        self.reward_evaluator = StepReward([term for term in PICK_UP_REWARD
+                                            if self.reduced_state_space or 'orien' not in term.features])
+
     def reward_func(self):
-        # reward per step
-        reward = 0
+        # reward per step, terms declared in rewards.PICK_UP_REWARD
+        features = self.reward_features()
+        self.current_stone_height = features['stone_height']
 
-        # negative reward for blade further from stone
-        BLADE_CLOSER = 0.1
-        self.current_sqr_dis_blade_stone = np.mean(np.power(self.dis_blade_stone(), 2))
-        # if self.current_dis_blade_stone > self._prev_dis_blade_stone:
-        reward += BLADE_CLOSER * (self._prev_sqr_dis_blade_stone - self.current_sqr_dis_blade_stone)
+        return self.reward_evaluator(features)
 
-        # negative reward for orientation away from stone
+    def reward_features(self):
+        features = {'blade_stone_sqr_dis': np.mean(np.power(self.dis_blade_stone(), 2)),
+                    'stone_height': self.stones['StonePos1'][2],
+                    'arm_height': self.world_state['ArmHeight'][0]}
         if self.reduced_state_space:
-            ORIEN_CLOSER = 0.1
-            self.current_orien = abs(self.current_obs()[2])
-            # if self.current_orien > self._prev_orien:
-            reward += ORIEN_CLOSER * (self._prev_orien - self.current_orien)
-
-        # positive reward for lifting stone
-        STONE_UP = 1.0
-        self.current_stone_height = self.stones['StonePos1'][2]
-        reward += STONE_UP * (self.current_stone_height - self._prev_stone_height)
-
-        # negative reward for blade too high
-        BLADE_OVER_STONE = 1.0
-        MAX_BLADE_HEIGHT = 100
-        if self.world_state['ArmHeight'] > MAX_BLADE_HEIGHT:
-            reward -= BLADE_OVER_STONE
-
-        # negative reward for blade over stone
-        if self.stones['StonePos1'][2] < 30 and self.world_state['ArmHeight'] > 50: # for stone scale 0.25
-            reward -= BLADE_OVER_STONE
-
-        # update for next step
-        self._prev_sqr_dis_blade_stone = self.current_sqr_dis_blade_stone
-        self._prev_orien = self.current_orien
-        self._prev_stone_height = self.current_stone_height
+            features['orien'] = abs(self.obs[-1][2])
 
-        return reward
+        return features
 
     def end_of_episode(self):
         done = False
@@ -597,7 +623,7 @@ class PickUpEnv(BaseEnv):
         if self.out_of_boarders():
             done = True
             reset = 'out of boarders'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             final_reward = - FINAL_REWARD
             self.episode.killSimulation()
             self.simOn = False
@@ -606,7 +632,7 @@ class PickUpEnv(BaseEnv):
         if self.steps > MAX_STEPS:
             done = True
             reset = 'limit time steps'
-            print('----------------', reset ,'----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             self.episode.killSimulation()
             self.simOn = False
 
@@ -615,7 +641,7 @@ class PickUpEnv(BaseEnv):
         if self.current_stone_height >= HEIGHT_LIMIT:
             done = True
             reset = 'sim success'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             final_reward = FINAL_REWARD
             self.episode.killSimulation()
             self.simOn = False
@@ -711,12 +737,12 @@ class PutDownEnv(BaseEnv):
         if self.steps > MAX_STEPS:
             done = True
             reset = 'limit time steps'
-            print('----------------', reset ,'----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
 
         if all(self.stones_on_ground):
             done = True
             reset = 'sim success'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             final_reward = self.succ_reward()
 
         self.steps += 1
@@ -766,12 +792,12 @@ class MoveWithStonesEnv(BaseEnv):
         if self.steps > MAX_STEPS:
             done = True
             reset = 'limit time steps'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
 
         if self.got_to_desired_pose():
             done = True
             reset = 'sim success'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             final_reward = SUCC_REWARD
 
         self.steps += 1
@@ -797,10 +823,6 @@ class PushStonesEnv(BaseEnv):
 
         self.marker = True
 
-        # self._prev_mean_sqr_blade_dis = 9
-        self._prev_mean_sqr_stone_dis = 16
-        # self._prev_orien = 0
-
         self.min_action = np.array(3*[-1.])
         self.max_action = np.array(3*[ 1.])
 
@@ -812,90 +834,14 @@ class PushStonesEnv(BaseEnv):
         self.keys = ['VehiclePos', 'VehicleOrien', 'VehicleLinearVel', 'VehicleAngularVel', 'VehicleLinearAccIMU', 'ArmHeight'] ### reduced state space
         # self.keys = ['VehiclePos', 'VehicleOrien', 'VehicleLinearVel', 'VehicleAngularVel', 'ArmHeight']  ### reduced state space no accel
 
+        self.reward_evaluator = StepReward(PUSH_STONES_REWARD)
+
     def reward_func(self):
-        # reward per step
-        # reward = -0.01
-        reward = 0
-
-        # reward for getting the blade closer to stone
-        # BLADE_CLOSER = 0.1
-        # mean_sqr_blade_dis = np.mean(np.power(self.dis_blade_stone(), 2))
-        # # reward = BLADE_CLOSER / mean_sqr_blade_dis
-        # reward = BLADE_CLOSER * (self._prev_mean_sqr_blade_dis - mean_sqr_blade_dis)
-
-        # reward for getting the stone closer to target
-        STONE_CLOSER = 1
-        mean_sqr_stone_dis = np.mean(np.power(self.dis_stone_desired_pose(), 2))
-        # reward += STONE_CLOSER / mean_sqr_stone_dis
-        reward += STONE_CLOSER * (self._prev_mean_sqr_stone_dis - mean_sqr_stone_dis)
-
-        # negative reward for orientation away from reference
-        # if self.reduced_state_space:
-        #     ORIEN_CLOSER = 0.1
-        #     self.current_orien = abs(self.current_obs()[2])
-        #     # if self.current_orien > self._prev_orien:
-        #     # reward += ORIEN_CLOSER * (self._prev_orien - self.current_orien)
-        #     reward -= ORIEN_CLOSER * self.current_orien
-
-        # update prevs
-        # self._prev_mean_sqr_blade_dis = mean_sqr_blade_dis
-        self._prev_mean_sqr_stone_dis = mean_sqr_stone_dis
-        # self._prev_orien = self.current_orien
-
-        # STONE_CLOSER = 0.1
-        # diff_from_init_dis = self.init_dis_stone_desired_pose - np.mean(self.sqr_dis_stone_desired_pose())
-        # reward += STONE_CLOSER*diff_from_init_dis
-
-        # for number of stones = 1
-        # STONE_MIDDLE_BLADE = 0.5
-        # reward += STONE_MIDDLE_BLADE / self.sqr_dis_optimal_stone_pose()
-
-        # # positive reward if stone is closer to desired pose, negative if further away
-        # STONE_CLOSER = 10
-        # self.current_stone_dis = self.sqr_dis_stone_desired_pose()
-        # if bool(self.last_stone_dis): # don't enter first time when last_stone_dis is empty
-        #     diff = [curr - last for curr, last in zip(self.current_stone_dis, self.last_stone_dis)]
-        #     if any(item < 0 for item in diff): # stone closer
-        #         reward += STONE_CLOSER / np.mean(self.current_stone_dis)
-        #     # if any(item > 0 for item in diff): # stone further away
-        #     #     reward -= STONE_CLOSER / np.mean(self.current_stone_dis)
-        #     # reward -= STONE_CLOSER*np.mean(diff)
-        #
-        # self.last_stone_dis = self.current_stone_dis
-        # #
-        # #     # if any(True for curr, last in zip(self.current_stone_dis, self.last_stone_dis) if curr < last):
-        # #     #     reward += STONE_CLOSER
-        # #         # rospy.loginfo('---------------- STONE closer, positive reward +10 ! ----------------')
-        #
-        # # # positive reward if blade is closer to stone's current pose, negative if further away
-        # BLADE_CLOSER = 1
-        # self.current_blade_dis = self.sqr_dis_blade_stone()
-        # if bool(self.last_blade_dis): # don't enter first time when last_blade_dis is empty
-        #     diff = [curr - last for curr, last in zip(self.current_blade_dis, self.last_blade_dis)]
-        #     if any(item < 0 for item in diff): # blade closer
-        #         reward += BLADE_CLOSER / np.mean(self.current_blade_dis)
-        #     if any(item > 0 for item in diff): # blade further away
-        #         reward -= BLADE_CLOSER / np.mean(self.current_blade_dis)
-        #     # reward -= BLADE_CLOSER*np.mean(diff)
-        #
-        # self.last_blade_dis = self.current_blade_dis
-        # #
-        # #     if any(True for curr, last in zip(self.current_blade_dis, self.last_blade_dis) if curr < last):
-        # #         reward += BLADE_CLOSER
-        # #         # rospy.loginfo('----------------  BLADE closer, positive reward +1 ! ----------------')
-        #
-        # # for number of stones = 1
-        # STONE_MIDDLE_BLADE = 0.5
-        # self.current_stone_middle_blade_dis = self.sqr_dis_optimal_stone_pose()
-        # diff = self.current_stone_middle_blade_dis - self.last_stone_middle_blade_dis
-        # if diff < 0:
-        #     reward += STONE_MIDDLE_BLADE / self.current_stone_middle_blade_dis
-        # if diff > 0:
-        #     reward -= STONE_MIDDLE_BLADE / self.current_stone_middle_blade_dis
-        #
-        # self.last_stone_middle_blade_dis = self.current_stone_middle_blade_dis
+        # reward per step, terms declared in rewards.PUSH_STONES_REWARD
+        return self.reward_evaluator(self.reward_features())
 
-        return reward
+    def reward_features(self):
+        return {'stone_sqr_dis': np.mean(np.power(self.dis_stone_desired_pose(), 2))}
 
     def end_of_episode(self):
         done = False
@@ -906,7 +852,7 @@ class PushStonesEnv(BaseEnv):
         if self.out_of_boarders():
             done = True
             reset = 'out of boarders'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             final_reward = - FINAL_REWARD
             self.episode.killSimulation()
             self.simOn = False
@@ -915,7 +861,7 @@ class PushStonesEnv(BaseEnv):
         if self.steps > MAX_STEPS:
             done = True
             reset = 'limit time steps'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             # final_reward = - FINAL_REWARD
             self.episode.killSimulation()
             self.simOn = False
@@ -923,7 +869,7 @@ class PushStonesEnv(BaseEnv):
         if self.got_to_desired_pose():
             done = True
             reset = 'sim success'
-            print('----------------', reset, '----------------')
+            self.log.info('env', '---------------- %s ----------------', reset)
             final_reward = FINAL_REWARD*MAX_STEPS/self.steps
             # final_reward = FINAL_REWARD
             # print('----------------', str(final_reward), '----------------')
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# serve one policy to many envs: observations from all clients are gathered into batches and run in one
+# forward pass, e.g.
+# python inference_service.py stable_bl/PushStonesEnv/model_dir/sac/test_55_rew_65444.6 /tmp/policy.sock
+# and in the env processes: model = InferenceClient('/tmp/policy.sock'), or a checkpoint 'unix:/tmp/policy.sock'
+# for evaluate_checkpoints.py / generate_demonstrations.py
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+HEADER = struct.Struct('!I')  # size in bytes of the action that follows
+REQUEST = struct.Struct('!I?')  # size in bytes of the observation that follows, deterministic actions
+
+
+def load_policy(path):
+    # numpy policy for .npz exports, SAC otherwise
+    if path.endswith('.npz'):
+        from frozen_policy import NumpyPolicy
+
+        return NumpyPolicy.load(path)
+    from stable_baselines import SAC
+
+    return SAC.load(path)
+
+
+class _Request:
+    __slots__ = ['obs', 'deterministic', 'action', 'error', 'time', 'done']
+
+    def __init__(self, obs, deterministic):
+        self.obs = obs
+        self.deterministic = deterministic
+        self.action = None
+        self.error = None
+        self.time = time.time()
+        self.done = threading.Event()
+
+
+class BatchedPolicy:
+    """
+    In-process batching of policy.predict calls from many threads. A batcher thread waits for a request,
+    gathers more of the same deterministic mode for up to max_latency seconds or max_batch requests, runs one
+    batched predict and hands each caller its action. Requests still pending on close fail. Each request is
+    one observation, of the size of the policy's observations (of the first request if the policy has none).
+
+    :param policy: model with a batched predict(obs) -> (actions, state), e.g. SAC or NumpyPolicy
+    :param max_batch: (int)
+    :param max_latency: (float) seconds the first request of a batch waits for others
+    """
+
+    def __init__(self, policy, max_batch=64, max_latency=0.002):
+        self.policy = policy
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+
+        self._requests = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.obs_dim = getattr(policy, 'obs_dim', None)  # NumpyPolicy
+        if self.obs_dim is None and getattr(policy, 'observation_space', None) is not None:  # SAC
+            self.obs_dim = int(np.prod(policy.observation_space.shape))
+        self._stats_lock = threading.Lock()
+        self._waits = deque(maxlen=10000)
+        self._batch_sizes = Counter()
+        self._thread = threading.Thread(target=self._run, name='policy-batcher', daemon=True)
+        self._thread.start()
+
+    def predict(self, observation, state=None, mask=None, deterministic=True):
+        # blocks until the batch with this observation ran
+        observation = np.asarray(observation, dtype=np.float32)
+        if observation.ndim > 1:
+            raise ValueError('one observation per request, got shape {}'.format(observation.shape))
+        request = _Request(observation, bool(deterministic))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('batched policy is closed')
+            if self.obs_dim is None:
+                self.obs_dim = observation.size
+            # a wrong size would fail the whole batch it is stacked into
+            if observation.size != self.obs_dim:
+                raise ValueError('observation of size {}, expected {}'.format(observation.size, self.obs_dim))
+            self._requests.append(request)
+            self._cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError('batched predict failed') from request.error
+
+        return request.action, None
+
+    def set_random_seed(self, seed):
+        pass
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._requests and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return []
+            # a batch of the mode of the oldest request, the other mode waits for the next batch
+            deterministic = self._requests[0].deterministic
+            deadline = self._requests[0].time + self.max_latency
+            while time.time() < deadline and not self._closed and \
+                    sum(request.deterministic == deterministic for request in self._requests) < self.max_batch:
+                self._cond.wait(deadline - time.time())
+            if self._closed:
+                return []
+
+            batch, rest = [], deque()
+            for request in self._requests:
+                if request.deterministic == deterministic and len(batch) < self.max_batch:
+                    batch.append(request)
+                else:
+                    rest.append(request)
+            self._requests = rest
+            return batch
+
+    def _fail_pending(self):
+        with self._cond:
+            pending, self._requests = self._requests, deque()
+        for request in pending:
+            request.error = RuntimeError('batched policy closed')
+            request.done.set()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                self._fail_pending()
+                return
+
+            start = time.time()
+            try:
+                actions, _ = self.policy.predict(np.stack([request.obs for request in batch]),
+                                                 deterministic=batch[0].deterministic)
+            except Exception as error:  # fails its batch only
+                actions = [None] * len(batch)
+                for request in batch:
+                    request.error = error
+            for request, action in zip(batch, actions):
+                request.action = action
+                request.done.set()
+
+            with self._stats_lock:
+                self._waits.extend(start - request.time for request in batch)
+                self._batch_sizes[len(batch)] += 1
+
+    def stats(self):
+        """
+        :return: (dict) requests, batches, mean_batch, max_batch, and the queueing time of the last 10000
+            requests in ms: wait_mean_ms, wait_p95_ms
+        """
+        with self._stats_lock:
+            waits = np.array(self._waits) * 1e3
+            batches = sum(self._batch_sizes.values())
+            requests = sum(size * count for size, count in self._batch_sizes.items())
+            return {'requests': requests, 'batches': batches,
+                    'mean_batch': requests / batches if batches else 0.,
+                    'max_batch': max(self._batch_sizes) if batches else 0,
+                    'wait_mean_ms': float(waits.mean()) if len(waits) else 0.,
+                    'wait_p95_ms': float(np.percentile(waits, 95)) if len(waits) else 0.}
+
+
+def _recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+class InferenceServer:
+    """
+    BatchedPolicy over a Unix socket, one thread per connected env process. Requests are a REQUEST with the
+    size in bytes and the deterministic flag followed by the float32 observation, replies a HEADER with the
+    size in bytes followed by the float32 action.
+
+    :param policy: (BatchedPolicy)
+    :param path: (str) socket file
+    """
+
+    def __init__(self, policy, path):
+        self.policy = policy
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen()
+        self._thread = threading.Thread(target=self._accept, name='inference-server', daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:  # closed
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                while True:
+                    n_bytes, deterministic = REQUEST.unpack(_recv_exactly(conn, REQUEST.size))
+                    obs = np.frombuffer(_recv_exactly(conn, n_bytes), dtype=np.float32)
+                    try:
+                        action, _ = self.policy.predict(obs, deterministic=deterministic)
+                    except (RuntimeError, ValueError):
+                        action = np.zeros(0)  # an empty reply
+                    action = np.asarray(action, dtype=np.float32)
+                    conn.sendall(HEADER.pack(action.nbytes) + action.tobytes())
+            except ConnectionError:
+                pass
+
+    def close(self):
+        self._sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class InferenceClient:
+    """
+    Policy of an InferenceServer, with the predict signature of stable-baselines models for a single
+    (not vectorized) observation.
+
+    :param path: (str) socket file
+    """
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+
+    def predict(self, observation, state=None, mask=None, deterministic=True):
+        # one observation per call, the server batches the calls of all clients
+        obs = np.asarray(observation, dtype=np.float32)
+        if obs.ndim > 1:
+            raise ValueError('one observation per predict, got shape {}'.format(obs.shape))
+        self._sock.sendall(REQUEST.pack(obs.nbytes, bool(deterministic)) + obs.tobytes())
+        n_bytes, = HEADER.unpack(_recv_exactly(self._sock, HEADER.size))
+        if n_bytes == 0:
+            raise RuntimeError('inference server failed on this observation')
+
+        return np.frombuffer(_recv_exactly(self._sock, n_bytes), dtype=np.float32).copy(), None
+
+    def set_random_seed(self, seed):
+        pass
+
+    def close(self):
+        self._sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve batched policy inference over a Unix socket')
+    parser.add_argument('checkpoint', help='SAC zip or frozen_policy .npz')
+    parser.add_argument('socket', help='socket file')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=2.)
+    parser.add_argument('--stats-interval', type=float, default=10., help='seconds between stats lines')
+    args = parser.parse_args()
+
+    batched = BatchedPolicy(load_policy(args.checkpoint), args.max_batch, args.max_latency_ms / 1e3)
+    server = InferenceServer(batched, args.socket)
+    print('serving', args.checkpoint, 'on', args.socket)
+    try:
+        while True:
+            time.sleep(args.stats_interval)
+            print(batched.stats())
+    except KeyboardInterrupt:
+        server.close()
+        batched.close()
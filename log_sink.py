@@ -0,0 +1,210 @@
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    from stable_baselines.logger import KVWriter, SeqWriter
+except ImportError:  # the envs and LLC only use LogSink
+    class KVWriter:
+        pass
+
+    class SeqWriter:
+        pass
+
+# same values as stable_baselines.logger
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+DISABLED = 50
+
+
+class LogSink:
+    """
+    Logging off the training thread. Messages, scalars and histograms are put in a bounded queue,
+    formatted and written by a background thread every flush_interval seconds. Records of a subsystem
+    below its level are dropped before anything is formatted or queued, and when the queue is full
+    records are dropped and counted instead of blocking the caller.
+
+    :param flush_interval: (float) seconds between writes
+    :param max_queue: (int) records held between writes
+    :param level: (int) default level of the subsystems
+    :param stream: (file) text output, default sys.stdout
+    :param tensorboard_dir: (str) scalars and histograms are written there as TensorBoard events, if given
+    """
+
+    def __init__(self, flush_interval=1.0, max_queue=10000, level=INFO, stream=None, tensorboard_dir=None):
+        self.flush_interval = flush_interval
+        self.level = level
+        self.levels = {}
+        self.stream = sys.stdout if stream is None else stream
+        self.tensorboard_dir = tensorboard_dir
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer = None
+        self._closed = threading.Event()
+        self._close_lock = threading.Lock()  # nothing is flushed after the writer thread's last write
+        self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+        self._thread.start()
+
+    def set_level(self, subsystem, level):
+        # e.g. set_level('llc', DEBUG) to see every LLCEnv step
+        self.levels[subsystem] = level
+
+    def enabled(self, subsystem, level):
+        return level >= self.levels.get(subsystem, self.level)
+
+    def log(self, subsystem, level, msg, *args):
+        # msg % args is formatted on the writer thread, args should not be modified afterwards
+        if self.enabled(subsystem, level):
+            self._put(('text', subsystem, msg, args))
+
+    def debug(self, subsystem, msg, *args):
+        self.log(subsystem, DEBUG, msg, *args)
+
+    def info(self, subsystem, msg, *args):
+        self.log(subsystem, INFO, msg, *args)
+
+    def warn(self, subsystem, msg, *args):
+        self.log(subsystem, WARN, msg, *args)
+
+    def scalar(self, subsystem, key, value, step, level=INFO):
+        if self.enabled(subsystem, level):
+            self._put(('scalar', subsystem + '/' + key, float(value), step))
+
+    def histogram(self, subsystem, key, values, step, level=DEBUG):
+        if self.enabled(subsystem, level):
+            self._put(('histogram', subsystem + '/' + key, np.array(values, dtype=np.float64), step))
+
+    def call(self, function, *args):
+        # run function(*args) on the writer thread, in order with the other records,
+        # never dropped: blocks while the queue is full
+        self._queue.put(('call', function, args, None))
+
+    def flush(self):
+        # wait until everything queued so far is written, a no-op once closed (close wrote everything)
+        done = threading.Event()
+        with self._close_lock:
+            if self._closed.is_set():
+                return
+            self.call(done.set)
+        done.wait()
+
+    def close(self):
+        # idempotent
+        self.flush()
+        with self._close_lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+        self._thread.join()
+        if self._writer is not None:
+            self._writer.close()
+
+    def _put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while not self._closed.is_set():
+            start = time.time()
+            self._write()
+            self._closed.wait(max(self.flush_interval - (time.time() - start), 0.))
+        self._write()
+
+    def _write(self):
+        records = []
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        events = []
+        for kind, name, value, step in records:
+            try:
+                if kind == 'text':
+                    self.stream.write('[{}] {}\n'.format(name, value % step if step else value))
+                elif kind == 'call':
+                    name(*value)
+                elif self.tensorboard_dir is not None:
+                    events.append((kind, name, value, step))
+            except Exception as error:  # a bad record must not stop the writer thread
+                self.stream.write('[log_sink] {} record failed: {!r}\n'.format(kind, error))
+        self.stream.flush()
+
+        if events:
+            self._write_events(events)
+
+    def _write_events(self, events):
+        import tensorflow as tf
+
+        if self._writer is None:
+            self._writer = tf.summary.FileWriter(self.tensorboard_dir)
+
+        for kind, tag, value, step in events:
+            if kind == 'scalar':
+                summary_value = tf.Summary.Value(tag=tag, simple_value=value)
+            else:
+                counts, edges = np.histogram(value, bins=30)
+                histogram = tf.HistogramProto(min=float(value.min()), max=float(value.max()), num=len(value),
+                                              sum=float(value.sum()), sum_squares=float(np.sum(value ** 2)),
+                                              bucket_limit=edges[1:].tolist(), bucket=counts.tolist())
+                summary_value = tf.Summary.Value(tag=tag, histo=histogram)
+            self._writer.add_summary(tf.Summary(value=[summary_value]), step)
+        self._writer.flush()
+
+
+class AsyncOutputFormat(KVWriter, SeqWriter):
+    """
+    A stable-baselines logger output format written by a LogSink: writekvs only queues a copy of the
+    values, the wrapped format (stdout, csv, tensorboard, ...) writes them on the sink's thread.
+
+    :param output_format: (KVWriter)
+    :param sink: (LogSink)
+    """
+
+    def __init__(self, output_format, sink):
+        self.output_format = output_format
+        self.sink = sink
+
+    def writekvs(self, kvs):
+        if isinstance(self.output_format, KVWriter):
+            self.sink.call(self.output_format.writekvs, dict(kvs))
+
+    def writeseq(self, seq):
+        if isinstance(self.output_format, SeqWriter):
+            self.sink.call(self.output_format.writeseq, list(seq))
+
+    def close(self):
+        self.sink.call(self.output_format.close)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """
+    The process wide LogSink, created with the default settings on first use.
+
+    :return: (LogSink)
+    """
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = LogSink()
+        return _sink
+
+
+def set_sink(sink):
+    # replace the process wide LogSink, e.g. by one with a tensorboard_dir
+    global _sink
+    with _sink_lock:
+        _sink = sink
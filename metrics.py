@@ -0,0 +1,146 @@
+import csv
+import os
+import threading
+import time
+from collections import Counter, deque
+
+# reset reasons of BaseEnv.end_of_episode
+RESET_REASONS = ['sim success', 'out of boarders', 'limit time steps']
+
+
+class TrainingMetrics:
+    """
+    Rolling training statistics, updated in O(1) by the env and the callbacks and safe to read from
+    any thread: episode return and length over the last window episodes, the fraction of those
+    episodes ending with each reset reason and the steps per second over the same episodes.
+
+    :param window: (int) number of episodes
+    """
+
+    def __init__(self, window=100):
+        self.window = window
+        self.lock = threading.Lock()
+        self.steps = 0
+        self.episodes = 0
+        self._returns = deque(maxlen=window)
+        self._lengths = deque(maxlen=window)
+        self._reasons = deque(maxlen=window)
+        self._return_sum = 0.
+        self._length_sum = 0
+        self._reason_counts = Counter()
+        self._times = deque([(time.time(), 0)], maxlen=window + 1)  # (time, steps) at episode ends
+
+    def add_step(self, n=1):
+        with self.lock:
+            self.steps += n
+
+    def end_episode(self, episode_return, length, reason):
+        """
+        :param episode_return: (float) total reward of the episode
+        :param length: (int) steps
+        :param reason: (str) the env's reset reason, e.g. 'sim success'
+        """
+        with self.lock:
+            if len(self._returns) == self.window:
+                self._return_sum -= self._returns[0]
+                self._length_sum -= self._lengths[0]
+                self._reason_counts[self._reasons[0]] -= 1
+            self._returns.append(episode_return)
+            self._lengths.append(length)
+            self._reasons.append(reason)
+            self._return_sum += episode_return
+            self._length_sum += length
+            self._reason_counts[reason] += 1
+            self._times.append((time.time(), self.steps))
+            self.episodes += 1
+
+    def mean_return(self):
+        # nan before the first episode
+        with self.lock:
+            return self._return_sum / len(self._returns) if self._returns else float('nan')
+
+    def returns(self):
+        # returns of the last window episodes, oldest first
+        with self.lock:
+            return list(self._returns)
+
+    def summary(self):
+        """
+        :return: (dict) steps, episodes, mean_return, mean_length, steps_per_sec and rate/<reset reason>
+        """
+        with self.lock:
+            n = len(self._returns)
+            (start_time, start_steps), now = self._times[0], time.time()
+            stats = {'steps': self.steps,
+                     'episodes': self.episodes,
+                     'mean_return': self._return_sum / n if n else float('nan'),
+                     'mean_length': self._length_sum / n if n else float('nan'),
+                     'steps_per_sec': (self.steps - start_steps) / max(now - start_time, 1e-9)}
+            for reason, count in self._reason_counts.items():
+                stats['rate/' + reason] = count / n if n else 0.
+
+        return stats
+
+    def logkvs(self, logger):
+        # into the stable-baselines logger, written to its csv / tensorboard outputs on the next dumpkvs
+        for key, value in self.summary().items():
+            logger.logkv('metrics/' + key, value)
+
+    def write_csv(self, path):
+        """
+        Append the summary as a row of a csv file, with a rate column per reason of RESET_REASONS.
+
+        :param path: (str)
+        """
+        fields = ['steps', 'episodes', 'mean_return', 'mean_length', 'steps_per_sec'] + \
+                 ['rate/' + reason for reason in RESET_REASONS]
+        new_file = not os.path.exists(path)
+        with open(path, 'a', newline='') as file_:
+            writer = csv.DictWriter(file_, fieldnames=fields, restval=0., extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            writer.writerow(self.summary())
+
+
+class MonitorTailer:
+    """
+    Incremental reader of a stable-baselines Monitor csv file. Each update() parses only the rows
+    appended since the last one, from a kept file offset, and pushes them into a TrainingMetrics,
+    so its cost does not grow with the length of the run.
+
+    :param path: (str) monitor csv, e.g. log_dir/monitor.csv
+    :param metrics: (TrainingMetrics) default TrainingMetrics(window=100)
+    """
+
+    def __init__(self, path, metrics=None):
+        self.path = path
+        self.metrics = TrainingMetrics() if metrics is None else metrics
+        self._offset = 0
+        self._partial = b''  # last line, not yet terminated
+        self._fields = None
+
+    def update(self):
+        """
+        :return: (int) number of new episodes
+        """
+        if not os.path.exists(self.path):
+            return 0
+
+        with open(self.path, 'rb') as file_:
+            file_.seek(self._offset)
+            data = file_.read()
+        self._offset += len(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+
+        n_episodes = 0
+        for row in csv.reader(line.decode() for line in lines if line.strip() and not line.startswith(b'#')):
+            if self._fields is None:  # header
+                self._fields = row
+                continue
+            row = dict(zip(self._fields, row))
+            self.metrics.add_step(int(row['l']))
+            self.metrics.end_episode(float(row['r']), int(row['l']), row.get('reset reason', 'unknown'))
+            n_episodes += 1
+
+        return n_episodes
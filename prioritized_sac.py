@@ -0,0 +1,106 @@
+import numpy as np
+import tensorflow as tf
+
+from stable_baselines import SAC
+from stable_baselines.common import tf_util
+
+from replay_buffers import PrioritizedReplayBuffer
+
+
+class PrioritizedSAC(SAC):
+    """
+    SAC with prioritized experience replay. Same arguments as SAC, plus:
+
+    :param prioritized_replay_alpha: (float) how much prioritization is used (0 - uniform, 1 - full)
+    :param prioritized_replay_beta0: (float) initial importance sampling correction, annealed to 1
+    :param prioritized_replay_beta_iters: (int) gradient steps to anneal beta over
+    :param prioritized_replay_eps: (float) added to the TD errors to get the new priorities
+    """
+
+    def __init__(self, *args, prioritized_replay_alpha=0.6, prioritized_replay_beta0=0.4,
+                 prioritized_replay_beta_iters=int(1e6), prioritized_replay_eps=1e-6, **kwargs):
+        # set before SAC.__init__, which calls setup_model
+        self.prioritized_replay_alpha = prioritized_replay_alpha
+        self.prioritized_replay_beta0 = prioritized_replay_beta0
+        self.prioritized_replay_beta_iters = prioritized_replay_beta_iters
+        self.prioritized_replay_eps = prioritized_replay_eps
+        self._n_train_steps = 0
+        super(PrioritizedSAC, self).__init__(*args, **kwargs)
+
+    def setup_model(self):
+        super(PrioritizedSAC, self).setup_model()
+
+        self.replay_buffer = PrioritizedReplayBuffer(self.buffer_size, self.observation_space.shape[0],
+                                                     self.action_space.shape[0], getattr(self.env, 'hist_size', 1),
+                                                     self.prioritized_replay_alpha)
+
+        # critic losses weighted by the importance sampling weights, replacing the unweighted train ops
+        with self.graph.as_default():
+            with tf.variable_scope("prioritized_loss", reuse=False):
+                self.is_weights_ph = tf.placeholder(tf.float32, shape=(None, 1), name="is_weights")
+
+                policy_loss, _, _, value_loss, qf1, qf2 = self.step_ops[:6]
+                policy_train_op = self.step_ops[9]
+
+                q_backup = tf.stop_gradient(self.rewards_ph + (1 - self.terminals_ph) * self.gamma * self.value_target)
+                self.td_error = 0.5 * (tf.abs(q_backup - qf1) + tf.abs(q_backup - qf2))
+                qf1_loss = 0.5 * tf.reduce_mean(self.is_weights_ph * (q_backup - qf1) ** 2)
+                qf2_loss = 0.5 * tf.reduce_mean(self.is_weights_ph * (q_backup - qf2) ** 2)
+                values_losses = qf1_loss + qf2_loss + value_loss
+
+                value_optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_ph)
+                optimizers = [value_optimizer]
+                with tf.control_dependencies([policy_train_op]):
+                    train_values_op = value_optimizer.minimize(values_losses,
+                                                               var_list=tf_util.get_trainable_vars('model/values_fn'))
+
+                step_ops = [policy_loss, qf1_loss, qf2_loss] + self.step_ops[3:10] + [train_values_op]
+                if self.log_ent_coef is not None:
+                    ent_coef_loss = self.step_ops[12]
+                    entropy_optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_ph)
+                    optimizers.append(entropy_optimizer)
+                    with tf.control_dependencies([train_values_op]):
+                        ent_coef_op = entropy_optimizer.minimize(ent_coef_loss, var_list=self.log_ent_coef)
+                    step_ops += [ent_coef_op, ent_coef_loss, self.ent_coef]
+                self.step_ops = step_ops
+
+            self.sess.run(tf.variables_initializer([var for optimizer in optimizers
+                                                    for var in optimizer.variables()]))
+
+    def _train_step(self, step, writer, learning_rate):
+        fraction = min(float(self._n_train_steps) / self.prioritized_replay_beta_iters, 1.0)
+        beta = self.prioritized_replay_beta0 + fraction * (1.0 - self.prioritized_replay_beta0)
+        self._n_train_steps += 1
+
+        batch = self.replay_buffer.sample(self.batch_size, beta=beta, env=self._vec_normalize_env)
+        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones, weights, idxes = batch
+
+        feed_dict = {
+            self.observations_ph: batch_obs,
+            self.actions_ph: batch_actions,
+            self.next_observations_ph: batch_next_obs,
+            self.rewards_ph: batch_rewards.reshape(self.batch_size, -1),
+            self.terminals_ph: batch_dones.reshape(self.batch_size, -1),
+            self.is_weights_ph: weights.reshape(self.batch_size, -1),
+            self.learning_rate_ph: learning_rate
+        }
+
+        if writer is not None:
+            out = self.sess.run([self.summary, self.td_error] + self.step_ops, feed_dict)
+            summary = out.pop(0)
+            writer.add_summary(summary, step)
+        else:
+            out = self.sess.run([self.td_error] + self.step_ops, feed_dict)
+
+        td_error = out.pop(0)
+        self.replay_buffer.update_priorities(idxes, np.abs(td_error).flatten() + self.prioritized_replay_eps)
+
+        # Unpack to monitor losses and entropy
+        policy_loss, qf1_loss, qf2_loss, value_loss, *values = out
+        entropy = values[4]
+
+        if self.log_ent_coef is not None:
+            ent_coef_loss, ent_coef = values[-2:]
+            return policy_loss, qf1_loss, qf2_loss, value_loss, entropy, ent_coef_loss, ent_coef
+
+        return policy_loss, qf1_loss, qf2_loss, value_loss, entropy
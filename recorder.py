@@ -0,0 +1,209 @@
+import os
+import struct
+
+import numpy as np
+
+# fixed size .npy header, leaves room to rewrite the shape in place as the arrays grow
+HEADER_SIZE = 128
+
+KEYS = ['obs', 'actions', 'rewards', 'episode_starts', 'episode_returns']
+
+
+def _write_header(f, shape, dtype):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype),
+                                                                       tuple(shape))
+    header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+    f.seek(0)
+    f.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+def _read_header(f):
+    f.seek(0)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype, f.tell()
+
+
+class NpyAppender:
+    """
+    Append-only .npy file. Rows are written after the data, the header shape is updated last,
+    so the header is the commit point and the file stays loadable with np.load after a crash.
+    """
+
+    def __init__(self, path, row_shape=None, dtype=None):
+        self.path = path
+
+        if os.path.exists(path):
+            self.file = open(path, 'r+b')
+            shape, self.dtype, offset = _read_header(self.file)
+            if offset != HEADER_SIZE:
+                raise ValueError('{} was not written by NpyAppender, can not append to it'.format(path))
+            self.rows = shape[0]
+            self.row_shape = tuple(shape[1:])
+            # drop bytes of rows written but never committed to the header
+            self.file.truncate(HEADER_SIZE + self.rows * self.row_bytes)
+        else:
+            self.file = open(path, 'w+b')
+            self.dtype = np.dtype(dtype)
+            self.row_shape = tuple(row_shape)
+            self.rows = 0
+            _write_header(self.file, self.shape, self.dtype)
+            self.sync()
+
+    @property
+    def shape(self):
+        return (self.rows,) + self.row_shape
+
+    @property
+    def row_bytes(self):
+        return int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self.file.seek(HEADER_SIZE + self.rows * self.row_bytes)
+        self.file.write(rows.tobytes())
+        self.rows += len(rows)
+
+    def commit(self):
+        self.sync()
+        _write_header(self.file, self.shape, self.dtype)
+        self.sync()
+
+    def truncate(self, rows):
+        self.rows = rows
+        self.file.truncate(HEADER_SIZE + rows * self.row_bytes)
+        self.commit()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkedRecorder:
+    """
+    Crash-safe demonstration recorder. Steps are kept in memory only up to chunk_size, then flushed
+    to obs/actions/rewards/episode_starts .npy files, episode_returns is appended at the end of each
+    episode. Opening an existing directory resumes the recording, dropping an unfinished last episode.
+
+    :param path: (str) recording directory, same layout as saved_experts/<name>
+    :param chunk_size: (int) number of steps kept in memory before flushing to disk
+    """
+
+    def __init__(self, path, chunk_size=256):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+
+        self._files = {}
+        self._chunk = {'obs': [], 'actions': [], 'rewards': [], 'episode_starts': []}
+        self._episode_return = 0.
+        self._new_episode = True
+        self._joy = None
+
+        if os.path.exists(self._file_path('episode_returns')):
+            self._resume()
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def _resume(self):
+        for key in KEYS:
+            self._files[key] = NpyAppender(self._file_path(key))
+
+        # steps committed in all files
+        steps = min(self._files[key].rows for key in KEYS[:4])
+        n_episodes = self._files['episode_returns'].rows
+
+        # cut everything recorded after the last finished episode
+        starts = np.load(self._file_path('episode_starts'), mmap_mode='r')[:steps]
+        start_ind = np.flatnonzero(starts)
+        if len(start_ind) > n_episodes:
+            steps = int(start_ind[n_episodes])
+        elif len(start_ind) < n_episodes:
+            n_episodes = len(start_ind)
+        del starts
+
+        for key in KEYS[:4]:
+            self._files[key].truncate(steps)
+        self._files['episode_returns'].truncate(n_episodes)
+
+        if os.path.exists(self._file_path('joy_samples')):
+            self._joy = NpyAppender(self._file_path('joy_samples'))
+            joy_steps = np.load(self._file_path('joy_samples'), mmap_mode='r')[:, 0]
+            self._joy.truncate(int(np.searchsorted(joy_steps, steps)))
+            del joy_steps
+
+    def _open_files(self, obs, action):
+        row_shapes = {'obs': np.shape(obs), 'actions': np.shape(action), 'rewards': (), 'episode_starts': (),
+                      'episode_returns': ()}
+        dtypes = {'obs': np.float64, 'actions': np.float64, 'rewards': np.float64, 'episode_starts': np.bool_,
+                  'episode_returns': np.float64}
+        for key in KEYS:
+            self._files[key] = NpyAppender(self._file_path(key), row_shapes[key], dtypes[key])
+
+    @property
+    def n_steps(self):
+        return self._files['obs'].rows + len(self._chunk['obs']) if self._files else 0
+
+    @property
+    def n_episodes(self):
+        return self._files['episode_returns'].rows if self._files else 0
+
+    def add(self, obs, action, reward, done):
+        if not self._files:
+            self._open_files(obs, action)
+
+        self._chunk['obs'].append(obs)
+        self._chunk['actions'].append(action)
+        self._chunk['rewards'].append(reward)
+        self._chunk['episode_starts'].append(self._new_episode)
+        self._episode_return += reward
+        self._new_episode = False
+
+        if done:
+            self.end_episode()
+        elif len(self._chunk['obs']) >= self.chunk_size:
+            self.flush()
+
+    def add_joy_samples(self, samples):
+        # raw (time, axes) joystick samples received up to the next added step, saved as [step, time, axes...]
+        if not samples:
+            return
+        rows = np.array([[self.n_steps, t] + list(axes) for t, axes in samples])
+        if self._joy is None:
+            self._joy = NpyAppender(self._file_path('joy_samples'), rows.shape[1:], np.float64)
+        self._joy.append(rows)
+
+    def flush(self):
+        if self._joy is not None:
+            self._joy.commit()
+        if not self._chunk['obs']:
+            return
+        for key, rows in self._chunk.items():
+            self._files[key].append(np.array(rows))
+            rows.clear()
+        for key in self._chunk:
+            self._files[key].commit()
+
+    def end_episode(self):
+        # steps first, the episode is complete once its return is committed
+        self.flush()
+        self._files['episode_returns'].append(np.array([self._episode_return]))
+        self._files['episode_returns'].commit()
+        self._episode_return = 0.
+        self._new_episode = True
+
+    def close(self):
+        # an unfinished episode is kept on disk but dropped when the recording is resumed or loaded
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        if self._joy is not None:
+            self._joy.close()
+
@@ -1,25 +1,83 @@
+#!/usr/bin/env python3
+# merge any number of recording directories into one, e.g.
+# python recordings_concat.py saved_experts/merged saved_experts/40_1 saved_experts/40_2 ...
+
+import argparse
+import os
+
 import numpy as np
 
-act1 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_1/actions.npy')
-obs1 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_1/obs.npy')
-rew1 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_1/rewards.npy')
-ep_ret1 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_1/episode_returns.npy')
-ep_str1 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_1/episode_starts.npy')
-
-act2 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_2/actions.npy')
-obs2 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_2/obs.npy')
-rew2 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_2/rewards.npy')
-ep_ret2 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_2/episode_returns.npy')
-ep_str2 = np.load('/home/graphics/git/SmartLoader/saved_ep/40_2/episode_starts.npy')
-
-act = np.concatenate((act1, act2))
-obs = np.concatenate((obs1, obs2))
-rew = np.concatenate((rew1,rew2))
-ep_ret = np.concatenate((ep_ret1,ep_ret2))
-ep_str = np.concatenate((ep_str1,ep_str2))
-
-np.save('/home/graphics/git/SmartLoader/saved_ep/act', act)
-np.save('/home/graphics/git/SmartLoader/saved_ep/obs', obs)
-np.save('/home/graphics/git/SmartLoader/saved_ep/rew', rew)
-np.save('/home/graphics/git/SmartLoader/saved_ep/ep_ret', ep_ret)
-np.save('/home/graphics/git/SmartLoader/saved_ep/ep_str', ep_str)
\ No newline at end of file
+from expert_data import load_trajectories
+from recorder import KEYS
+
+CHUNK_SIZE = 65536  # rows copied at a time
+
+
+def check_recording(path, data, chunk_size=CHUNK_SIZE):
+    # same number of steps in all step arrays and one episode start per episode return
+    n_steps = len(data['obs'])
+    for key in KEYS[1:4]:
+        if len(data[key]) != n_steps:
+            raise ValueError('{}: {} has {} rows, obs has {}'.format(path, key, len(data[key]), n_steps))
+
+    if n_steps and not data['episode_starts'][0]:
+        raise ValueError('{}: first step is not an episode start'.format(path))
+
+    n_starts = 0
+    for start in range(0, n_steps, chunk_size):
+        n_starts += int(np.count_nonzero(data['episode_starts'][start:start + chunk_size]))
+    if n_starts != len(data['episode_returns']):
+        raise ValueError('{}: {} episode starts but {} episode returns'.format(path, n_starts,
+                                                                               len(data['episode_returns'])))
+
+
+def merge_recordings(paths, out_path, chunk_size=CHUNK_SIZE):
+    """
+    Stream recording directories into a single one, in order. The output arrays are preallocated from
+    the input .npy headers and filled chunk by chunk, so memory does not grow with the number of sessions.
+
+    :param paths: ([str]) recording directories
+    :param out_path: (str) output directory
+    :param chunk_size: (int) rows copied at a time
+    """
+    # the output arrays are created before the inputs are read, an input would be truncated
+    if os.path.realpath(out_path) in [os.path.realpath(path) for path in paths]:
+        raise ValueError('output {} is one of the input recordings'.format(out_path))
+    recordings = [load_trajectories(path) for path in paths]
+
+    for key in KEYS:
+        formats = set((data[key].shape[1:], data[key].dtype) for data in recordings)
+        if len(formats) > 1:
+            raise ValueError('{} shape/dtype do not match between recordings: {}'.format(key, formats))
+    for path, data in zip(paths, recordings):
+        check_recording(path, data, chunk_size)
+
+    os.makedirs(out_path, exist_ok=True)
+    for key in KEYS:
+        first = recordings[0][key]
+        total = sum(len(data[key]) for data in recordings)
+        out = np.lib.format.open_memmap(os.path.join(out_path, key + '.npy'), mode='w+', dtype=first.dtype,
+                                        shape=(total,) + first.shape[1:])
+        row = 0
+        for data in recordings:
+            for start in range(0, len(data[key]), chunk_size):
+                chunk = data[key][start:start + chunk_size]
+                out[row:row + len(chunk)] = chunk
+                row += len(chunk)
+        out.flush()
+        del out
+
+    n_episodes = sum(len(data['episode_returns']) for data in recordings)
+    print('merged {} recordings, {} episodes, {} steps to {}'.format(len(paths), n_episodes,
+                                                                     sum(len(data['obs']) for data in recordings),
+                                                                     out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge recording directories into one ExpertDataset recording')
+    parser.add_argument('out_path', help='output directory')
+    parser.add_argument('paths', nargs='+', help='recording directories to merge, in order')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows copied at a time')
+    args = parser.parse_args()
+
+    merge_recordings(args.paths, args.out_path, args.chunk_size)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# rollout workers on other hosts, each stepping its own env (e.g. one Unity instance per machine), stream
+# compressed transition batches to a central learner over TCP and get the actor weights back, e.g.
+# learner:  python remote_rollouts.py learner PushStonesEnv --port 7600 --timesteps 1000000
+# workers:  python remote_rollouts.py worker learner-host:7600 PushStonesEnv
+# or all on localhost with the stand-in env:
+# python remote_rollouts.py learner PushStonesEnv --port 7600 --local-workers 4 --backend standin
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import gym
+import numpy as np
+
+from actor_learner import (ContinuousLearner, EnvActor, SpacesEnv, env_attributes, pack_arrays,
+                           split_transitions, transition_width, unpack_arrays)
+from log_sink import get_sink
+
+# frame: kind, size of the json header, size of the binary payload
+FRAME = struct.Struct('!BII')
+HELLO, BATCH, ACK, WEIGHTS = 1, 2, 3, 4
+
+
+def send_frame(sock, kind, header, payload=b''):
+    header = json.dumps(header).encode()
+    sock.sendall(FRAME.pack(kind, len(header), len(payload)) + header + payload)
+
+
+def _recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    """
+    :return: (int, dict, bytes) kind, json header, payload
+    """
+    kind, header_size, payload_size = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+    header = json.loads(_recv_exactly(sock, header_size).decode())
+    return kind, header, _recv_exactly(sock, payload_size)
+
+
+class RolloutServer(ContinuousLearner):
+    """
+    Central learner for RolloutWorkers connecting over TCP, see ContinuousLearner. A thread per connection
+    receives the worker's transition batches into a bounded queue, acknowledges each batch once it is queued
+    and sends the worker the newest actor weights after the acknowledgement when they changed. A worker has
+    at most max_in_flight unacknowledged batches, so while the learner is behind the queue fills, the
+    acknowledgements stop and the workers wait: backpressure. Workers resend their unacknowledged batches
+    after reconnecting, a batch that was already queued is acknowledged again and not added twice.
+
+    :param host: (str) interface to listen on
+    :param port: (int)
+    :param max_queued: (int) batches received but not yet in the replay buffer
+    :param sync_interval: (int) gradient steps between weight publications
+    :param max_updates_per_step: (float) cap on gradient steps per collected transition, None for no cap
+    :param compress_level: (int) zlib level of the weights sent to the workers
+    """
+
+    def __init__(self, host='0.0.0.0', port=7600, max_queued=64, sync_interval=1000, max_updates_per_step=None,
+                 compress_level=1):
+        super(RolloutServer, self).__init__(sync_interval, max_updates_per_step)
+        self.compress_level = compress_level
+        self._batches = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._last_seq = {}  # (worker, session) -> seq of its last queued batch
+        # (worker, session) -> lock held from the seq check until the batch is queued, so the handler of a
+        # reconnected worker waits for a stale handler still blocked on a full queue
+        self._session_locks = {}
+        self._weights = (0, None, None)  # version, spec, compressed values
+        self._hello = None
+        self._hello_received = threading.Event()
+        self._connections = set()
+        self._closed = False
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen()
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept, name='rollout-server', daemon=True)
+        self._thread.start()
+
+    def start(self, timeout=None):
+        """
+        Wait for the first worker.
+
+        :param timeout: (float) seconds, None to wait forever
+        :return: (SpacesEnv) the spaces of the workers' envs, to build the model with
+        """
+        if not self._hello_received.wait(timeout):
+            raise TimeoutError('no rollout worker connected')
+        hello = self._hello
+        return SpacesEnv(gym.spaces.Box(low=np.array(hello['obs_low']), high=np.array(hello['obs_high'])),
+                         gym.spaces.Box(low=np.array(hello['action_low']), high=np.array(hello['action_high'])),
+                         **hello['env_attributes'])
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self._sock.accept()
+            except OSError:  # closed
+                return
+            threading.Thread(target=self._serve, args=(conn, address), daemon=True).start()
+
+    def _serve(self, conn, address):
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._connections.add(conn)
+        worker = None
+        with conn:
+            try:
+                kind, hello, _ = recv_frame(conn)
+                if kind != HELLO:
+                    raise ConnectionError('expected a hello')
+                worker = hello['worker']
+                session = (worker, hello['session'])
+                with self._lock:
+                    session_lock = self._session_locks.setdefault(session, threading.Lock())
+                    if self._hello is None:
+                        self._hello = hello
+                        self._hello_received.set()
+                    elif (hello['obs_dim'], hello['action_dim']) != (self._hello['obs_dim'], self._hello['action_dim']):
+                        raise ConnectionError('spaces differ from the first worker')
+                self.log.info('train', 'rollout worker %s connected from %s', worker, address[0])
+
+                sent_version = self._send_weights(conn, 0)
+                obs_dim, action_dim = hello['obs_dim'], hello['action_dim']
+                while not self._closed:
+                    kind, header, payload = recv_frame(conn)
+                    if kind != BATCH:
+                        continue
+                    seq = header['seq']
+                    with session_lock:
+                        # batches of a session are queued once and in order, also across reconnections
+                        if seq > self._last_seq.get(session, 0):
+                            rows = np.frombuffer(zlib.decompress(payload), dtype=np.float32)
+                            rows = rows.reshape(header['n'], transition_width(obs_dim, action_dim))
+                            # waits while the learner is behind, the worker waits for the acknowledgement
+                            self._batches.put((session, split_transitions(rows, obs_dim, action_dim),
+                                               header['episodes']))
+                            self._last_seq[session] = seq
+                    send_frame(conn, ACK, {'seq': seq})
+                    sent_version = self._send_weights(conn, sent_version)
+            except (ConnectionError, OSError, ValueError, zlib.error) as error:
+                if not self._closed:
+                    self.log.warn('train', 'rollout worker %s disconnected: %s', worker, error)
+        self._connections.discard(conn)
+
+    def _send_weights(self, conn, sent_version):
+        version, spec, payload = self._weights
+        if version > sent_version:
+            send_frame(conn, WEIGHTS, {'version': version, 'spec': spec}, payload)
+        return version
+
+    def publish(self, model):
+        spec, values = pack_arrays(self.model_arrays(model))
+        self._weights = (self._weights[0] + 1, spec, zlib.compress(values.tobytes(), self.compress_level))
+
+    def collect(self, model, callback=None, metrics=None, max_batches=64):
+        n_added, episodes = 0, []
+        for _ in range(max_batches):
+            try:
+                session, transitions, batch_episodes = self._batches.get_nowait()
+            except queue.Empty:
+                break
+            self.add_transitions(model, session, *transitions)
+            n_added += len(transitions[0])
+            episodes += batch_episodes
+
+        return n_added, self.record(model, n_added, episodes, callback, metrics)
+
+    def close(self):
+        # the workers keep reconnecting until they are stopped
+        self._closed = True
+        self._sock.close()
+        for conn in list(self._connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class RolloutWorker:
+    """
+    Steps an env with the learner's latest weights (EnvActor) and sends its transitions to a RolloutServer
+    in zlib compressed batches of batch_size. Waits for acknowledgements while max_in_flight batches are
+    unacknowledged. When the connection fails it keeps the unacknowledged batches, reconnects with
+    exponential backoff and resends them.
+
+    :param address: (str, int) host and port of the learner
+    :param env: (gym.Env)
+    :param worker: (str) unique name, default host and pid
+    :param batch_size: (int) transitions per batch
+    :param max_in_flight: (int) unacknowledged batches
+    :param seed: (int) of the env and the policy
+    :param compress_level: (int) zlib level
+    :param timeout: (float) seconds without a reply from the learner before reconnecting
+    :param max_backoff: (float) longest wait between connection attempts, in seconds
+    """
+
+    def __init__(self, address, env, worker=None, batch_size=256, max_in_flight=4, seed=None, compress_level=1,
+                 timeout=60., max_backoff=30.):
+        self.address = address
+        self.actor = EnvActor(env, seed)
+        self.worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.compress_level = compress_level
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.log = get_sink()
+
+        space = env.observation_space
+        # a new session restarts the batch numbers
+        self.hello = {'worker': self.worker, 'session': uuid.uuid4().hex, 'obs_dim': space.shape[0], 'action_dim': env.action_space.shape[0],
+                      'obs_low': np.asarray(space.low).tolist(), 'obs_high': np.asarray(space.high).tolist(),
+                      'action_low': np.asarray(env.action_space.low).tolist(),
+                      'action_high': np.asarray(env.action_space.high).tolist(),
+                      'env_attributes': env_attributes(env)}
+        self._sock = None
+        self._unacked = []  # (seq, header, payload)
+        self._seq = 0
+        self.version = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        delay = 0.1
+        while True:
+            try:
+                sock = socket.create_connection(self.address, timeout=self.timeout)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                send_frame(sock, HELLO, self.hello)
+                for _, header, payload in self._unacked:
+                    send_frame(sock, BATCH, header, payload)
+                self._sock = sock
+                return
+            except OSError as error:
+                self.log.warn('train', 'connecting to %s:%d failed (%s), retrying in %.1f s', self.address[0],
+                              self.address[1], error, delay)
+                time.sleep(delay)
+                delay = min(2 * delay, self.max_backoff)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _receive(self):
+        # one acknowledgement or weights update
+        kind, header, payload = recv_frame(self._sock)
+        if kind == ACK:
+            self._unacked = [batch for batch in self._unacked if batch[0] > header['seq']]
+        elif kind == WEIGHTS and header['version'] > self.version:
+            values = np.frombuffer(zlib.decompress(payload), dtype=np.float32)
+            self.actor.set_arrays(unpack_arrays(header['spec'], values))
+            self.version = header['version']
+
+    def _send(self, rows, episodes):
+        self._seq += 1
+        header = {'seq': self._seq, 'n': len(rows), 'episodes': episodes}
+        payload = zlib.compress(np.ascontiguousarray(rows, dtype=np.float32).tobytes(), self.compress_level)
+        self._unacked.append((self._seq, header, payload))
+        while True:
+            try:
+                if self._sock is None:
+                    self._connect()  # resends the unacknowledged batches, this one too
+                else:
+                    send_frame(self._sock, BATCH, header, payload)
+                while len(self._unacked) >= self.max_in_flight:
+                    self._receive()
+                return
+            except (OSError, ValueError, zlib.error) as error:  # ConnectionError and timeouts are OSErrors
+                self.log.warn('train', 'connection to the learner lost (%s), reconnecting', error)
+                self._disconnect()
+                self.reconnects += 1
+
+    def run(self, max_steps=None, stop=None):
+        """
+        :param max_steps: (int) env steps, None to run until stop is set
+        :param stop: (threading.Event or multiprocessing.Event)
+        :return: (int) env steps
+        """
+        obs_dim, action_dim = self.hello['obs_dim'], self.hello['action_dim']
+        rows = np.empty((self.batch_size, transition_width(obs_dim, action_dim)), dtype=np.float32)
+        n, episodes, steps = 0, [], 0
+        self._connect()
+        while (max_steps is None or steps < max_steps) and not (stop is not None and stop.is_set()):
+            (obs, action, reward, next_obs, done), episode = self.actor.step()
+            rows[n] = np.concatenate((obs, action, [reward], next_obs, [done]))
+            n += 1
+            steps += 1
+            if episode is not None:
+                episodes.append([float(episode[0]), int(episode[1]), episode[2]])
+            if n == self.batch_size:
+                self._send(rows, episodes)
+                n, episodes = 0, []
+        self._disconnect()
+
+        return steps
+
+
+def run_worker(address, mission, backend, num_stones, seed, batch_size, max_steps=None, stop=None):
+    from standin_env import make_env
+
+    worker = RolloutWorker(address, make_env(mission, backend, num_stones), batch_size=batch_size, seed=seed)
+    worker.run(max_steps, stop)
+    get_sink().flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remote rollout workers and their central SAC learner')
+    subparsers = parser.add_subparsers(dest='command')
+    learner_parser = subparsers.add_parser('learner')
+    learner_parser.add_argument('mission', help="env name without '-v0', e.g. PushStonesEnv")
+    learner_parser.add_argument('--port', type=int, default=7600)
+    learner_parser.add_argument('--timesteps', type=int, default=100000)
+    learner_parser.add_argument('--sync-interval', type=int, default=1000)
+    learner_parser.add_argument('--max-updates-per-step', type=float, default=None)
+    learner_parser.add_argument('--local-workers', type=int, default=0, help='also start workers on this host')
+    learner_parser.add_argument('--backend', choices=['sim', 'standin'], default='standin', help='of local workers')
+    learner_parser.add_argument('--save', help='model file written at the end')
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('address', help='learner host:port')
+    worker_parser.add_argument('mission', help="env name without '-v0', e.g. PushStonesEnv")
+    worker_parser.add_argument('--backend', choices=['sim', 'standin'], default='sim')
+    worker_parser.add_argument('--seed', type=int, default=None)
+    for subparser in [learner_parser, worker_parser]:
+        subparser.add_argument('--num-stones', type=int, default=1)
+        subparser.add_argument('--batch-size', type=int, default=256, help='transitions per batch sent')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        host, port = args.address.rsplit(':', 1)
+        run_worker((host, int(port)), args.mission, args.backend, args.num_stones, args.seed, args.batch_size)
+    elif args.command == 'learner':
+        from stable_baselines import SAC
+        from stable_baselines.sac.policies import MlpPolicy
+
+        from metrics import TrainingMetrics
+        from replay_buffers import FrameReplayBuffer
+
+        server = RolloutServer(port=args.port, sync_interval=args.sync_interval,
+                               max_updates_per_step=args.max_updates_per_step)
+        context = multiprocessing.get_context('spawn')
+        stop = context.Event()
+        workers = [context.Process(target=run_worker, daemon=True,
+                                   args=(('127.0.0.1', server.port), args.mission, args.backend, args.num_stones,
+                                         k, args.batch_size, None, stop))
+                   for k in range(args.local_workers)]
+        for process in workers:
+            process.start()
+
+        env = server.start()
+        env.metrics = TrainingMetrics(window=100)
+        model = SAC(MlpPolicy, env, learning_rate=1e-4, buffer_size=50000, learning_starts=3000, batch_size=64,
+                    tau=0.01, policy_kwargs=dict(layers=[64, 64, 64]), verbose=1)
+        model.replay_buffer = FrameReplayBuffer.from_env(env, size=model.buffer_size)
+        try:
+            server.learn(model, args.timesteps, metrics=env.metrics)
+        finally:
+            stop.set()
+            server.close()
+            for process in workers:
+                process.join(1)
+                if process.is_alive():  # waiting for the closed learner
+                    process.terminate()
+        print(env.metrics.summary())
+        if args.save:
+            model.save(args.save)
+        get_sink().flush()
+    else:
+        parser.print_help()
@@ -0,0 +1,765 @@
+import os
+import shutil
+
+import numpy as np
+
+TRANSITION_KEYS = ['obs', 'actions', 'rewards', 'next_obs', 'dones']
+
+
+def expert_transitions(traj_data):
+    """
+    Vectorized (obs, actions, rewards, next_obs, dones) of a whole dataset. A transition is done when the
+    next step starts a new episode, the last step of the dataset ends the last episode.
+
+    :param traj_data: (dict) ExpertDataset style dict, in memory or memory-mapped
+    :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+    """
+    obs = np.array(traj_data['obs'])
+    actions = np.array(traj_data['actions'])
+    rewards = np.array(traj_data['rewards'])
+    starts = np.asarray(traj_data['episode_starts'], dtype=np.bool_)
+
+    next_obs = np.empty_like(obs)
+    next_obs[:-1] = obs[1:]
+    next_obs[-1] = obs[-1]  # masked by done
+    dones = np.append(starts[1:], True).astype(np.float32)
+
+    return obs, actions, rewards, next_obs, dones
+
+
+def fill_replay_buffer(replay_buffer, traj_data):
+    """
+    Write a whole expert dataset into a stable_baselines ReplayBuffer in one go, continuing from its
+    current position and wrapping around like ReplayBuffer.add. If the dataset is larger than the buffer
+    only its last buffer_size transitions are kept.
+
+    :param replay_buffer: (ReplayBuffer) e.g. model.replay_buffer of SAC
+    :param traj_data: (dict) ExpertDataset style dict
+    :return: (int) number of transitions written
+    """
+    obs, actions, rewards, next_obs, dones = expert_transitions(traj_data)
+    # agent partition of an ExpertReplayBuffer
+    replay_buffer = getattr(replay_buffer, 'agent_buffer', replay_buffer)
+    if hasattr(replay_buffer, 'add_batch'):
+        return replay_buffer.add_batch(obs, actions, rewards, next_obs, dones)
+
+    size = replay_buffer.buffer_size
+    n_transitions = min(len(obs), size)
+    first = len(obs) - n_transitions
+    transitions = list(zip(obs[first:], actions[first:], rewards[first:], next_obs[first:], dones[first:]))
+
+    storage = replay_buffer.storage
+    # same ring position as adding all transitions one by one
+    next_idx = (replay_buffer._next_idx + first) % size
+    if n_transitions == size:
+        # whole ring rewritten, transition j at (next_idx + j) % size
+        storage[:] = transitions[size - next_idx:] + transitions[:size - next_idx]
+    else:
+        # up to the end of the ring (appends while the buffer is not full), then from its start
+        n_end = min(n_transitions, size - next_idx)
+        storage[next_idx:next_idx + n_end] = transitions[:n_end]
+        storage[:n_transitions - n_end] = transitions[n_end:]
+    replay_buffer._next_idx = (next_idx + n_transitions) % size
+
+    return n_transitions
+
+
+def replay_buffer_arrays(replay_buffer, copy=False):
+    """
+    Arrays of a replay buffer snapshot, by file name (without .npy).
+
+    :param replay_buffer: (ReplayBuffer)
+    :param copy: (bool) copies of the buffer arrays, which can be written while training goes on
+    :return: (dict)
+    """
+    # only the agent partition of an ExpertReplayBuffer, the expert data stays in its recording
+    replay_buffer = getattr(replay_buffer, 'agent_buffer', replay_buffer)
+
+    if hasattr(replay_buffer, 'state_arrays'):
+        arrays = replay_buffer.state_arrays()
+        if copy:
+            arrays = {key: np.array(array) for key, array in arrays.items()}
+    else:
+        arrays = {key: np.array([transition[i] for transition in replay_buffer.storage])
+                  for i, key in enumerate(TRANSITION_KEYS)}
+        arrays['next_idx'] = np.array(replay_buffer._next_idx)
+
+    return arrays
+
+
+def write_replay_buffer(arrays, path):
+    """
+    Write replay_buffer_arrays to a snapshot directory. The previous snapshot at path is replaced only once
+    the new one is complete.
+
+    :param arrays: (dict) from replay_buffer_arrays
+    :param path: (str) snapshot directory
+    """
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_path, key + '.npy'), array)
+
+    # a stale .old of an interrupted save would make the rename fail
+    shutil.rmtree(path + '.old', ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, path + '.old')
+    os.rename(tmp_path, path)
+    shutil.rmtree(path + '.old', ignore_errors=True)
+
+
+def save_replay_buffer(replay_buffer, path):
+    """
+    Snapshot a replay buffer to a directory of .npy files (one per transition field, in storage order)
+    that load_replay_buffer can memory-map. The previous snapshot at path is replaced only once the new
+    one is complete.
+
+    :param replay_buffer: (ReplayBuffer)
+    :param path: (str) snapshot directory
+    """
+    write_replay_buffer(replay_buffer_arrays(replay_buffer), path)
+
+
+def load_replay_buffer(replay_buffer, path):
+    """
+    Reattach a snapshot saved by save_replay_buffer. Transitions are memory-mapped views, read from disk
+    only when sampled.
+
+    :param replay_buffer: (ReplayBuffer) e.g. model.replay_buffer of a loaded SAC model
+    :param path: (str) snapshot directory
+    :return: (int) number of transitions loaded
+    """
+    replay_buffer = getattr(replay_buffer, 'agent_buffer', replay_buffer)
+    if hasattr(replay_buffer, 'load_state_arrays'):
+        # copy-on-write maps, pages are read when sampled and copied when overwritten
+        replay_buffer.load_state_arrays({key: np.load(os.path.join(path, key + '.npy'), mmap_mode='c')
+                                         for key in replay_buffer.STATE_KEYS})
+        return len(replay_buffer)
+
+    arrays = [np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in TRANSITION_KEYS]
+    n_transitions = len(arrays[0])
+    if n_transitions > replay_buffer.buffer_size:
+        raise ValueError('snapshot has {} transitions, buffer size is {}'.format(n_transitions,
+                                                                                 replay_buffer.buffer_size))
+
+    replay_buffer.storage[:] = list(zip(*arrays))
+    replay_buffer._next_idx = int(np.load(os.path.join(path, 'next_idx.npy'))) % replay_buffer.buffer_size
+
+    return n_transitions
+
+
+class FrameReplayBuffer:
+    """
+    Replay buffer for the SmartLoader envs, where obs and next_obs are hist_size frame stacks sharing all
+    but one frame. Every frame is stored once in a float32 ring and the stacks are gathered at sample time.
+    A transition lives in the slot of the newest frame of its next_obs, so obs = frames[slot - hist_size:slot]
+    and next_obs = frames[slot - hist_size + 1:slot + 1]. The first hist_size frames of each episode take
+    slots without a transition. Drop-in for the stable_baselines ReplayBuffer of SAC.
+
+    :param size: (int) number of frame slots (transitions + hist_size per episode)
+    :param obs_dim: (int) observation size, hist_size * frame size
+    :param action_dim: (int)
+    :param hist_size: (int) frames per observation, BaseEnv.hist_size
+    """
+
+    STATE_KEYS = ['frames', 'actions', 'rewards', 'dones', 'valid', 'state']
+
+    def __init__(self, size, obs_dim, action_dim, hist_size=3):
+        if obs_dim % hist_size:
+            raise ValueError('observation size {} is not a multiple of hist_size {}'.format(obs_dim, hist_size))
+        self._maxsize = size
+        self.hist_size = hist_size
+        self.frame_dim = obs_dim // hist_size
+
+        self.frames = np.zeros((size, self.frame_dim), dtype=np.float32)
+        self.actions = np.zeros((size, action_dim), dtype=np.float32)
+        self.rewards = np.zeros(size, dtype=np.float32)
+        self.dones = np.zeros(size, dtype=np.float32)
+        self.valid = np.zeros(size, dtype=np.bool_)  # slot holds a sampleable transition
+
+        self._next_idx = 0
+        self._n_valid = 0
+        self._full = False
+        self._continues = False  # last transition was not done, next obs_t should be its obs_tp1
+
+    @classmethod
+    def from_env(cls, env, size):
+        return cls(size, env.observation_space.shape[0], env.action_space.shape[0], getattr(env, 'hist_size', 1))
+
+    def __len__(self):
+        return self._n_valid
+
+    @property
+    def buffer_size(self):
+        return self._maxsize
+
+    def can_sample(self, n_samples):
+        return len(self) >= n_samples
+
+    def is_full(self):
+        return self._full
+
+    def _write(self, frames, actions, rewards, dones, valid):
+        # write a run of slots at the ring position, returns the slots whose transitions changed
+        size = self._maxsize
+        n_slots = len(frames)
+        if n_slots > size:
+            # keep the newest slots, at the ring position they would have had
+            skip = n_slots - size
+            frames, actions, rewards, dones = frames[skip:], actions[skip:], rewards[skip:], dones[skip:]
+            valid = np.array(valid[skip:])
+            valid[:self.hist_size] = False  # their first frames were dropped
+            self._next_idx = (self._next_idx + skip) % size
+            self._full = True
+            n_slots = size
+
+        # old transitions in these slots, and those right after whose stacks reach into them
+        if n_slots + self.hist_size >= size:
+            stale = np.arange(size)
+        else:
+            stale = (self._next_idx + np.arange(n_slots + self.hist_size)) % size
+        self._n_valid -= int(np.count_nonzero(self.valid[stale]))
+        self.valid[stale] = False
+
+        slots = (self._next_idx + np.arange(n_slots)) % size
+        self.frames[slots] = frames
+        self.actions[slots] = actions
+        self.rewards[slots] = rewards
+        self.dones[slots] = dones
+        self.valid[slots] = valid
+        self._n_valid += int(np.count_nonzero(valid))
+
+        if self._next_idx + n_slots >= size:
+            self._full = True
+        self._next_idx = (self._next_idx + n_slots) % size
+
+        return stale
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add a new transition to the buffer
+
+        :param obs_t: (np.ndarray) the last observation
+        :param action: ([float]) the action
+        :param reward: (float) the reward of the transition
+        :param obs_tp1: (np.ndarray) the current observation
+        :param done: (bool) is the episode done
+        """
+        obs_t = np.asarray(obs_t, dtype=np.float32).reshape(self.hist_size, self.frame_dim)
+        new_frame = np.asarray(obs_tp1, dtype=np.float32).reshape(self.hist_size, self.frame_dim)[-1:]
+
+        last = (self._next_idx - 1) % self._maxsize
+        if self._continues and np.array_equal(self.frames[last], obs_t[-1]):
+            frames = new_frame
+        else:
+            frames = np.concatenate((obs_t, new_frame))
+        n_slots = len(frames)
+
+        actions = np.zeros((n_slots,) + self.actions.shape[1:], dtype=np.float32)
+        actions[-1] = action
+        rewards = np.zeros(n_slots, dtype=np.float32)
+        rewards[-1] = reward
+        dones = np.zeros(n_slots, dtype=np.float32)
+        dones[-1] = done
+        valid = np.zeros(n_slots, dtype=np.bool_)
+        valid[-1] = True
+
+        self._write(frames, actions, rewards, dones, valid)
+        self._continues = not done
+
+    def add_batch(self, obs, actions, rewards, next_obs, dones):
+        """
+        Add consecutive transitions at once (see expert_transitions), with array ops only. Within an episode
+        obs[i + 1] must equal next_obs[i]. As in add, the first transition continues the last episode in the
+        buffer when that did not end and its newest frame is the newest frame of obs[0].
+
+        :return: (int) number of transitions added
+        """
+        n_transitions = len(obs)
+        hist_size = self.hist_size
+        dones = np.asarray(dones, dtype=np.float32)
+
+        last = (self._next_idx - 1) % self._maxsize
+        continues = self._continues and np.array_equal(
+            self.frames[last], np.asarray(obs[0], dtype=np.float32).reshape(hist_size, self.frame_dim)[-1])
+        is_start = np.concatenate(([not continues], dones[:-1] > 0))
+        episode = np.cumsum(is_start) - 1
+        starts = np.flatnonzero(is_start)
+
+        # slot stream: hist_size frames of each episode's first obs, then one slot per transition
+        n_slots = n_transitions + hist_size * len(starts)
+        pos = np.arange(n_transitions) + hist_size * (episode + 1)
+
+        frames = np.empty((n_slots, self.frame_dim), dtype=np.float32)
+        frames[pos] = np.asarray(next_obs).reshape(n_transitions, hist_size, self.frame_dim)[:, -1]
+        frames[(pos[starts] - hist_size)[:, None] + np.arange(hist_size)] = \
+            np.asarray(obs)[starts].reshape(len(starts), hist_size, self.frame_dim)
+
+        slot_actions = np.zeros((n_slots,) + self.actions.shape[1:], dtype=np.float32)
+        slot_actions[pos] = actions
+        slot_rewards = np.zeros(n_slots, dtype=np.float32)
+        slot_rewards[pos] = rewards
+        slot_dones = np.zeros(n_slots, dtype=np.float32)
+        slot_dones[pos] = dones
+        valid = np.zeros(n_slots, dtype=np.bool_)
+        valid[pos] = True
+
+        self._write(frames, slot_actions, slot_rewards, slot_dones, valid)
+        self._continues = not dones[-1]
+
+        return n_transitions
+
+    def _sample_idxes(self, batch_size):
+        # uniform over valid slots, by rejection (most slots are valid)
+        upper = self._maxsize if self._full else self._next_idx
+        idxes = np.empty(0, dtype=np.int64)
+        while len(idxes) < batch_size:
+            draw = np.random.randint(upper, size=2 * batch_size)
+            idxes = np.concatenate((idxes, draw[self.valid[draw]]))
+
+        return idxes[:batch_size]
+
+    def _encode_sample(self, idxes, env=None):
+        # one gather for both stacks
+        stacks = self.frames[(idxes[:, None] + np.arange(-self.hist_size, 1)) % self._maxsize]
+        obs = stacks[:, :-1].reshape(len(idxes), -1)
+        next_obs = stacks[:, 1:].reshape(len(idxes), -1)
+        rewards = self.rewards[idxes]
+
+        if env is not None:
+            obs = env.normalize_obs(obs)
+            next_obs = env.normalize_obs(next_obs)
+            rewards = env.normalize_reward(rewards)
+
+        return obs, self.actions[idxes], rewards, next_obs, self.dones[idxes]
+
+    def sample(self, batch_size, env=None, **_kwargs):
+        """
+        Sample a batch of experiences.
+
+        :param batch_size: (int) How many transitions to sample.
+        :param env: (Optional[VecNormalize]) associated gym VecEnv to normalize the observations/rewards
+        :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) obs, actions, rewards, next_obs, dones
+        """
+        return self._encode_sample(self._sample_idxes(batch_size), env)
+
+    def state_arrays(self):
+        state = np.array([self._next_idx, self._n_valid, self._full, self._continues], dtype=np.int64)
+        return {'frames': self.frames, 'actions': self.actions, 'rewards': self.rewards, 'dones': self.dones,
+                'valid': self.valid, 'state': state}
+
+    def load_state_arrays(self, arrays):
+        if arrays['frames'].shape != self.frames.shape or arrays['actions'].shape != self.actions.shape:
+            raise ValueError('snapshot shapes {} {} do not match the buffer'.format(arrays['frames'].shape,
+                                                                                   arrays['actions'].shape))
+        self.frames = arrays['frames']
+        self.actions = arrays['actions']
+        self.rewards = arrays['rewards']
+        self.dones = arrays['dones']
+        self.valid = arrays['valid']
+        self._next_idx, self._n_valid, full, continues = (int(value) for value in arrays['state'])
+        self._full, self._continues = bool(full), bool(continues)
+
+
+class ExpertReplayBuffer:
+    """
+    Replay buffer with a protected expert partition: the expert dataset is sampled in place (memory-mapped,
+    never evicted, next_obs and dones by index arithmetic) and agent transitions go to a rolling agent buffer.
+    Each minibatch draws expert_ratio of its transitions from the expert partition.
+
+    :param agent_buffer: (ReplayBuffer or FrameReplayBuffer) buffer for the agent transitions
+    :param traj_data: (dict) ExpertDataset style dict, e.g. expert_data.load_trajectories(path)
+    :param expert_ratio: (float) fraction of each minibatch taken from the expert data
+    """
+
+    def __init__(self, agent_buffer, traj_data, expert_ratio=0.25):
+        self.agent_buffer = agent_buffer
+        self.traj_data = traj_data
+        self.expert_ratio = expert_ratio
+        self._n_expert = len(traj_data['obs'])
+
+    def __len__(self):
+        return len(self.agent_buffer) + self._n_expert
+
+    @property
+    def buffer_size(self):
+        return self.agent_buffer.buffer_size
+
+    def can_sample(self, n_samples):
+        return len(self) >= n_samples
+
+    def is_full(self):
+        return self.agent_buffer.is_full()
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        self.agent_buffer.add(obs_t, action, reward, obs_tp1, done)
+
+    def _expert_sample(self, n_samples):
+        data = self.traj_data
+        idxes = np.sort(np.random.randint(self._n_expert, size=n_samples))
+        next_idxes = np.minimum(idxes + 1, self._n_expert - 1)
+        # done when the next step starts an episode, or at the end of the data
+        dones = np.asarray(data['episode_starts'][next_idxes], dtype=np.float32)
+        dones[idxes == self._n_expert - 1] = 1.
+
+        return (np.asarray(data['obs'][idxes], dtype=np.float32), np.asarray(data['actions'][idxes], dtype=np.float32),
+                np.asarray(data['rewards'][idxes], dtype=np.float32),
+                np.asarray(data['obs'][next_idxes], dtype=np.float32), dones)
+
+    def sample(self, batch_size, env=None, **_kwargs):
+        n_agent = batch_size - int(round(self.expert_ratio * batch_size)) if len(self.agent_buffer) else 0
+        expert = self._expert_sample(batch_size - n_agent)
+        if env is not None:
+            expert = (env.normalize_obs(expert[0]), expert[1], env.normalize_reward(expert[2]),
+                      env.normalize_obs(expert[3]), expert[4])
+        if not n_agent:
+            return expert
+
+        agent = self.agent_buffer.sample(n_agent, env=env)
+        return tuple(np.concatenate((np.asarray(agent_part, dtype=np.float32), expert_part))
+                     for agent_part, expert_part in zip(agent, expert))
+
+
+class HindsightReplayBuffer(FrameReplayBuffer):
+    """
+    FrameReplayBuffer for PushStonesEnv with hindsight goal relabeling (HER, 'future' strategy). The goal is
+    the marker position ref_pos and observations hold vehicle and stone positions relative to it, so a
+    relabeled goal is an offset: at sample time relabel_fraction of the transitions get as goal the stones'
+    (centroid) position at a later step of the same episode, their observations are shifted to the new goal
+    and the PushStonesEnv.reward_func terms are recomputed over the batch. The success reward depends, as in
+    PushStonesEnv.end_of_episode, on the step of the transition and the initial distance to the new goal;
+    done transitions that did not succeed keep their final reward (out of boarders, time limit).
+
+    :param size: (int) number of frame slots
+    :param obs_dim: (int) observation size
+    :param action_dim: (int)
+    :param hist_size: (int) frames per observation
+    :param num_stones: (int) stones in the observation (the last 3 * num_stones values of a frame)
+    :param reduced_state_space: (bool) frame starts with [x, y, yaw, arm height], else with [x, y, z, ...]
+    :param relabel_fraction: (float) fraction of each minibatch with a relabeled goal
+    :param stone_closer: (float) STONE_CLOSER weight of PushStonesEnv.reward_func
+    :param success_reward: (float) FINAL_REWARD, success reward is FINAL_REWARD * MAX_STEPS / steps
+    :param tolerance: (float) success distance of the stones from the goal
+    :param max_steps_per_meter: (float) MAX_STEPS per meter of initial vehicle distance from the goal
+    """
+
+    STATE_KEYS = FrameReplayBuffer.STATE_KEYS + ['episode_ids', 'write_idx', 'episode_last', 'episode_first',
+                                                  'episode_origin', 'episode_state']
+
+    def __init__(self, size, obs_dim, action_dim, hist_size=3, num_stones=1, reduced_state_space=True,
+                 relabel_fraction=0.8, stone_closer=1., success_reward=5000., tolerance=0.75,
+                 max_steps_per_meter=250.):
+        super(HindsightReplayBuffer, self).__init__(size, obs_dim, action_dim, hist_size)
+        self.num_stones = num_stones
+        self.vehicle_dims = 2 if reduced_state_space else 3
+        self.yaw_index = 2 if reduced_state_space else None
+        self.relabel_fraction = relabel_fraction
+        self.stone_closer = stone_closer
+        self.success_reward = success_reward
+        self.tolerance = tolerance
+        self.max_steps_per_meter = max_steps_per_meter
+
+        # episode of each slot and its position in the stream of written slots, to find future steps
+        self.episode_ids = np.zeros(size, dtype=np.int64)
+        self.write_idx = np.zeros(size, dtype=np.int64)
+        self._episode_last = np.zeros(size, dtype=np.int64)  # last written slot of episode id % size
+        self._episode_first = np.zeros(size, dtype=np.int64)  # first written slot of episode id % size
+        self._episode_origin = np.zeros((size, 2), dtype=np.float32)  # vehicle x, y of its first obs
+        self._episode = -1
+        self._n_written = 0
+
+    @classmethod
+    def from_env(cls, env, size, **kwargs):
+        return cls(size, env.observation_space.shape[0], env.action_space.shape[0], env.hist_size,
+                   env.numStones, env.reduced_state_space, **kwargs)
+
+    def _write(self, frames, actions, rewards, dones, valid):
+        valid = np.asarray(valid, dtype=np.bool_)
+        n_slots = len(valid)
+        # an episode starts with a run of slots without a transition
+        new_episode = ~valid & np.concatenate(([True], valid[:-1]))
+        episodes = self._episode + np.cumsum(new_episode)
+        write_idx = self._n_written + np.arange(n_slots)
+
+        start = self._next_idx
+        changed = super(HindsightReplayBuffer, self)._write(frames, actions, rewards, dones, valid)
+
+        keep = slice(max(n_slots - self._maxsize, 0), n_slots)
+        slots = (start + np.arange(n_slots)[keep]) % self._maxsize
+        self.episode_ids[slots] = episodes[keep]
+        self.write_idx[slots] = write_idx[keep]
+        np.maximum.at(self._episode_last, episodes[keep] % self._maxsize, write_idx[keep])
+        # the first obs stack of an episode is always written in one run
+        starts = np.flatnonzero(new_episode)
+        self._episode_first[episodes[starts] % self._maxsize] = write_idx[starts]
+        self._episode_origin[episodes[starts] % self._maxsize] = \
+            np.asarray(frames, dtype=np.float32)[starts + self.hist_size - 1, :2]
+        self._episode = int(episodes[-1])
+        self._n_written += n_slots
+
+        return changed
+
+    def state_arrays(self):
+        arrays = super(HindsightReplayBuffer, self).state_arrays()
+        arrays.update(episode_ids=self.episode_ids, write_idx=self.write_idx, episode_last=self._episode_last,
+                      episode_first=self._episode_first, episode_origin=self._episode_origin,
+                      episode_state=np.array([self._episode, self._n_written], dtype=np.int64))
+        return arrays
+
+    def load_state_arrays(self, arrays):
+        super(HindsightReplayBuffer, self).load_state_arrays(arrays)
+        self.episode_ids = arrays['episode_ids']
+        self.write_idx = arrays['write_idx']
+        self._episode_last = arrays['episode_last']
+        self._episode_first = arrays['episode_first']
+        self._episode_origin = arrays['episode_origin']
+        self._episode, self._n_written = (int(value) for value in arrays['episode_state'])
+
+    def _stones(self, obs):
+        # (batch, hist_size, num_stones, 3) view of the stone positions
+        frames = obs.reshape(len(obs), self.hist_size, self.frame_dim)
+        return frames[:, :, self.frame_dim - 3 * self.num_stones:].reshape(len(obs), self.hist_size,
+                                                                            self.num_stones, 3)
+
+    def relabel(self, obs, offset):
+        """
+        Observations relative to a new goal, goal_new = goal + offset.
+
+        :param obs: (np.ndarray) (batch, obs_dim) stacked observations
+        :param offset: (np.ndarray) (batch, 3) new goal relative to the old one
+        :return: (np.ndarray)
+        """
+        frames = obs.reshape(len(obs), self.hist_size, self.frame_dim).copy()
+        old_vehicle = frames[:, :, :2].copy()
+        frames[:, :, :self.vehicle_dims] -= offset[:, None, :self.vehicle_dims]
+        stones = self._stones(frames.reshape(len(obs), -1))
+        frames[:, :, self.frame_dim - 3 * self.num_stones:] = \
+            (stones - offset[:, None, None, :]).reshape(len(obs), self.hist_size, -1)
+
+        if self.yaw_index is not None:
+            # yaw is normalized by the direction from the vehicle to the goal (BaseEnv.normalize_orientation)
+            old_angle = np.degrees(np.arctan2(-old_vehicle[..., 1], -old_vehicle[..., 0]))
+            new_angle = np.degrees(np.arctan2(-frames[:, :, 1], -frames[:, :, 0]))
+            frames[:, :, self.yaw_index] += old_angle - new_angle
+
+        return frames.reshape(len(obs), -1)
+
+    def _step_reward(self, obs, next_obs):
+        # PushStonesEnv.reward_func and success, for observations relative to the goal
+        prev_dis = np.sum(self._stones(obs)[:, -1, :, :2] ** 2, axis=-1)
+        dis = np.sum(self._stones(next_obs)[:, -1, :, :2] ** 2, axis=-1)
+        rewards = self.stone_closer * (np.mean(prev_dis, axis=1) - np.mean(dis, axis=1))
+        success = np.all(dis < self.tolerance ** 2, axis=1)
+
+        return rewards, success
+
+    def compute_reward(self, obs, next_obs, steps, init_dis):
+        """
+        PushStonesEnv.reward_func and its success reward over a batch, for observations relative to the goal.
+
+        :param steps: (np.ndarray) env steps counter of each transition, from 0 at the first one
+        :param init_dis: (np.ndarray) initial vehicle distance from the goal of each episode
+        :return: (np.ndarray, np.ndarray) rewards, success
+        """
+        rewards, success = self._step_reward(obs, next_obs)
+        max_steps = self.max_steps_per_meter * init_dis
+        # steps is 0 only at the first transition, where the env would divide by zero
+        bonus = self.success_reward * max_steps / np.maximum(steps, 1)
+
+        return rewards + np.where(success, bonus, 0.), success
+
+    def episode_steps(self, slots):
+        """
+        Env steps counter and initial vehicle x, y of the transitions in slots.
+
+        :param slots: (np.ndarray) slots with a transition
+        :return: (np.ndarray, np.ndarray) steps, (batch, 2) initial vehicle position relative to the goal
+        """
+        episodes = self.episode_ids[slots] % self._maxsize
+        steps = self.write_idx[slots] - (self._episode_first[episodes] + self.hist_size)
+        return steps, self._episode_origin[episodes]
+
+    def sample(self, batch_size, env=None, **_kwargs):
+        idxes = self._sample_idxes(batch_size)
+        obs, actions, rewards, next_obs, dones = self._encode_sample(idxes)
+
+        relabel = np.flatnonzero(np.random.random_sample(batch_size) < self.relabel_fraction)
+        if len(relabel):
+            slots = idxes[relabel]
+            # a slot between this one and the last written slot of its episode
+            first = self.write_idx[slots]
+            last = self._episode_last[self.episode_ids[slots] % self._maxsize]
+            future = (first + (np.random.random_sample(len(slots)) * (last - first + 1)).astype(np.int64)) \
+                % self._maxsize
+            achieved = self.frames[future, self.frame_dim - 3 * self.num_stones:]
+            offset = achieved.reshape(len(slots), self.num_stones, 3).mean(axis=1)
+
+            # final reward of stored done transitions, without their step term and success bonus
+            step_rewards, stored_success = self._step_reward(obs[relabel], next_obs[relabel])
+            final_rewards = np.where(dones[relabel] > 0, rewards[relabel] - step_rewards, 0.)
+            final_rewards[stored_success] = 0.
+
+            steps, origin = self.episode_steps(slots)
+            obs[relabel] = self.relabel(obs[relabel], offset)
+            next_obs[relabel] = self.relabel(next_obs[relabel], offset)
+            relabeled, success = self.compute_reward(obs[relabel], next_obs[relabel], steps,
+                                                     np.linalg.norm(origin - offset[:, :2], axis=1))
+            # a success overrides the final reward, as in PushStonesEnv.end_of_episode
+            rewards[relabel] = relabeled + np.where(success, 0., final_rewards)
+            dones[relabel] = np.maximum(dones[relabel], success)
+
+        if env is not None:
+            obs = env.normalize_obs(obs)
+            next_obs = env.normalize_obs(next_obs)
+            rewards = env.normalize_reward(rewards)
+
+        return obs, actions, rewards, next_obs, dones
+
+
+class SumTree:
+    """
+    Array-based sum tree over capacity leaves: node i has children 2i and 2i + 1, the root is node 1.
+    Batched updates and stratified sampling are vectorized, O(log n) per element.
+
+    :param capacity: (int) number of leaves
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = max(int(np.ceil(np.log2(capacity))), 1)
+        self._n_leaves = 1 << self.depth
+        self.tree = np.zeros(2 * self._n_leaves)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    @property
+    def leaves(self):
+        return self.tree[self._n_leaves:self._n_leaves + self.capacity]
+
+    def update(self, idxes, values):
+        nodes = np.asarray(idxes) + self._n_leaves
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def set_all(self, values):
+        # rebuild the whole tree level by level
+        self.tree[:] = 0.
+        self.tree[self._n_leaves:self._n_leaves + self.capacity] = values
+        start = self._n_leaves
+        while start > 1:
+            start //= 2
+            self.tree[start:2 * start] = self.tree[2 * start:4 * start:2] + self.tree[2 * start + 1:4 * start:2]
+
+    def sample(self, n_samples):
+        # one draw in each of n_samples equal strata of the total
+        mass = (np.arange(n_samples) + np.random.random_sample(n_samples)) * (self.total / n_samples)
+        nodes = np.ones(n_samples, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = mass >= self.tree[left]
+            mass = np.where(go_right, mass - self.tree[left], mass)
+            nodes = left + go_right
+
+        return np.minimum(nodes - self._n_leaves, self.capacity - 1)
+
+
+class PrioritizedReplayBuffer(FrameReplayBuffer):
+    """
+    FrameReplayBuffer with proportional prioritized sampling (Schaul et al. 2015) backed by a SumTree over
+    the slots. New transitions get the highest priority seen so far, slots without a transition get 0.
+
+    :param size: (int) number of frame slots
+    :param obs_dim: (int) observation size
+    :param action_dim: (int)
+    :param hist_size: (int) frames per observation
+    :param alpha: (float) how much prioritization is used (0 - uniform, 1 - full prioritization)
+    """
+
+    STATE_KEYS = FrameReplayBuffer.STATE_KEYS + ['priorities']
+
+    def __init__(self, size, obs_dim, action_dim, hist_size=3, alpha=0.6):
+        super(PrioritizedReplayBuffer, self).__init__(size, obs_dim, action_dim, hist_size)
+        self.alpha = alpha
+        self._tree = SumTree(size)
+        self._max_priority = 1.0
+
+    @classmethod
+    def from_env(cls, env, size, alpha=0.6):
+        return cls(size, env.observation_space.shape[0], env.action_space.shape[0], getattr(env, 'hist_size', 1),
+                   alpha)
+
+    def _write(self, frames, actions, rewards, dones, valid):
+        changed = super(PrioritizedReplayBuffer, self)._write(frames, actions, rewards, dones, valid)
+        self._tree.update(changed, np.where(self.valid[changed], self._max_priority ** self.alpha, 0.))
+        return changed
+
+    def sample(self, batch_size, beta=0.4, env=None, **_kwargs):
+        """
+        Sample a batch of experiences, with importance sampling weights.
+
+        :param batch_size: (int) How many transitions to sample.
+        :param beta: (float) To what degree to use importance weights (0 - no corrections, 1 - full correction)
+        :param env: (Optional[VecNormalize]) associated gym VecEnv to normalize the observations/rewards
+        :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+            obs, actions, rewards, next_obs, dones, weights, slot indexes for update_priorities
+        """
+        idxes = self._tree.sample(batch_size)
+        # floating point edge cases can land on an empty slot
+        empty = ~self.valid[idxes]
+        if empty.any():
+            idxes[empty] = self._sample_idxes(int(empty.sum()))
+
+        probs = self._tree.leaves[idxes] / self._tree.total
+        weights = (len(self) * probs) ** (-beta)
+        weights /= weights.max()
+
+        return self._encode_sample(idxes, env) + (weights, idxes)
+
+    def update_priorities(self, idxes, priorities):
+        """
+        Update priorities of sampled transitions, e.g. from TD errors.
+
+        :param idxes: ([int]) slot indexes returned by sample
+        :param priorities: ([float]) new priorities, > 0
+        """
+        priorities = np.asarray(priorities, dtype=np.float64)
+        self._max_priority = max(self._max_priority, float(priorities.max()))
+        # slots overwritten since they were sampled keep their priority
+        self._tree.update(idxes, np.where(self.valid[idxes], priorities ** self.alpha, self._tree.leaves[idxes]))
+
+    def state_arrays(self):
+        arrays = super(PrioritizedReplayBuffer, self).state_arrays()
+        arrays['priorities'] = np.append(self._tree.leaves, self._max_priority)
+        return arrays
+
+    def load_state_arrays(self, arrays):
+        super(PrioritizedReplayBuffer, self).load_state_arrays(arrays)
+        self._tree.set_all(arrays['priorities'][:-1])
+        self._max_priority = float(arrays['priorities'][-1])
+
+
+def benchmark_prioritized_sampling(size=1000000, batch_size=64, n_batches=1000):
+    # sample and priority update throughput of a full buffer
+    import time
+
+    buffer = PrioritizedReplayBuffer(size, 39, 3, hist_size=3)
+    n_transitions = size - 3
+    buffer.add_batch(np.random.randn(n_transitions, 39), np.random.randn(n_transitions, 3),
+                     np.random.randn(n_transitions), np.random.randn(n_transitions, 39),
+                     np.zeros(n_transitions))
+
+    start = time.time()
+    for _ in range(n_batches):
+        batch = buffer.sample(batch_size)
+        buffer.update_priorities(batch[-1], np.random.random_sample(batch_size) + 1e-6)
+    duration = time.time() - start
+    print('{} entries, batch {}: {:.0f} batches/s, {:.0f} transitions/s (sample + update)'.format(
+        len(buffer), batch_size, n_batches / duration, n_batches * batch_size / duration))
+
+
+if __name__ == '__main__':
+    benchmark_prioritized_sampling()
@@ -0,0 +1,135 @@
+import numpy as np
+
+# Reward terms are declared once, as lists of Delta / Indicator terms over named features, and evaluated
+# either per step inside the env (StepReward) or vectorized over recorded trajectories (trajectory_rewards).
+
+
+class Delta:
+    """
+    weight * (feature_t - feature_t-1), a negative weight rewards decreasing the feature.
+
+    :param name: (str)
+    :param weight: (float)
+    :param feature: (str) feature name
+    :param initial: (float) previous value at the first step of an episode
+    """
+
+    def __init__(self, name, weight, feature, initial=0.):
+        self.name = name
+        self.weight = weight
+        self.features = [feature]
+        self.feature = feature
+        self.initial = initial
+
+
+class Indicator:
+    """
+    weight when condition(features) holds.
+
+    :param name: (str)
+    :param weight: (float)
+    :param condition: (function) features dict -> bool or bool array
+    :param features: ([str]) feature names used by the condition
+    """
+
+    def __init__(self, name, weight, condition, features):
+        self.name = name
+        self.weight = weight
+        self.condition = condition
+        self.features = features
+
+
+PICK_UP_REWARD = [
+    Delta('blade closer', -0.1, 'blade_stone_sqr_dis'),
+    Delta('orientation closer', -0.1, 'orien'),  # reduced state space only
+    Delta('stone up', 1.0, 'stone_height'),
+    Indicator('blade too high', -1.0, lambda f: f['arm_height'] > 100, ['arm_height']),
+    Indicator('blade over stone', -1.0, lambda f: (f['stone_height'] < 30) & (f['arm_height'] > 50),  # stone scale 0.25
+              ['stone_height', 'arm_height']),
+]
+
+PUSH_STONES_REWARD = [
+    Delta('stone closer', -1.0, 'stone_sqr_dis', initial=16.),
+]
+
+
+def term_values(term, features, prev):
+    if isinstance(term, Delta):
+        return term.weight * (np.asarray(features[term.feature], dtype=np.float64) - prev)
+    return term.weight * np.asarray(term.condition(features), dtype=np.float64)
+
+
+class StepReward:
+    """
+    Per step evaluator of a list of terms, holding the previous feature values of the Delta terms.
+
+    :param terms: ([Delta or Indicator])
+    """
+
+    def __init__(self, terms):
+        self.terms = terms
+        self.values = {}
+        self.reset()
+
+    def reset(self):
+        # at the start of every episode
+        self._prev = {term.name: term.initial for term in self.terms if isinstance(term, Delta)}
+
+    def __call__(self, features):
+        reward = 0.
+        for term in self.terms:
+            self.values[term.name] = float(term_values(term, features, self._prev.get(term.name)))
+            reward += self.values[term.name]
+            if isinstance(term, Delta):
+                self._prev[term.name] = features[term.feature]
+
+        return reward
+
+
+def trajectory_rewards(terms, features, episode_starts):
+    """
+    Vectorized evaluation of a list of terms over whole trajectories.
+
+    :param terms: ([Delta or Indicator])
+    :param features: (dict) feature name -> (n_steps,) array, the features after each step
+    :param episode_starts: (np.ndarray) (n_steps,) bool
+    :return: (np.ndarray, dict) (n_steps,) rewards, term name -> (n_steps,) values
+    """
+    episode_starts = np.asarray(episode_starts, dtype=np.bool_)
+    values = {}
+    for term in terms:
+        prev = None
+        if isinstance(term, Delta):
+            feature = np.asarray(features[term.feature], dtype=np.float64)
+            prev = np.empty_like(feature)
+            prev[1:] = feature[:-1]
+            prev[episode_starts] = term.initial
+        values[term.name] = term_values(term, features, prev)
+
+    return sum(values.values()), values
+
+
+def _features_after_step(obs, episode_starts, hist_size):
+    # newest frame of the observation after each step: obs[t + 1] inside an episode, obs[t] at its last step
+    obs = np.asarray(obs)
+    frames = obs[:, obs.shape[1] - obs.shape[1] // hist_size:]
+    after = np.empty_like(frames)
+    after[:-1] = frames[1:]
+    after[-1] = frames[-1]
+    last = np.append(np.asarray(episode_starts[1:], dtype=np.bool_), True)
+    after[last] = frames[last]
+    return after
+
+
+def push_stones_features(obs, episode_starts, num_stones=1, hist_size=3):
+    # stones are the last 3 * num_stones values of a frame, relative to the marker
+    frames = _features_after_step(obs, episode_starts, hist_size)
+    stones = frames[:, frames.shape[1] - 3 * num_stones:].reshape(len(frames), num_stones, 3)
+    return {'stone_sqr_dis': np.mean(np.sum(stones[:, :, :2] ** 2, axis=-1), axis=1)}
+
+
+def pick_up_features(obs, episode_starts, hist_size=3):
+    # reduced state space frame: [x, y, yaw, arm height, blade pitch, stone height],
+    # the blade pose is not observed so 'blade_stone_sqr_dis' can not be scored offline
+    frames = _features_after_step(obs, episode_starts, hist_size)
+    return {'orien': np.abs(frames[:, 2]), 'arm_height': frames[:, 3], 'stone_height': frames[:, 5]}
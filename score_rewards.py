@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# score recorded trajectories with the reward terms of rewards.py, without running the simulation, e.g.
+# python score_rewards.py push_stones saved_experts/3_rocks_40_episodes --num-stones 3
+
+import argparse
+
+import numpy as np
+
+from expert_data import EpisodeIndex, load_trajectories
+from rewards import PICK_UP_REWARD, PUSH_STONES_REWARD, pick_up_features, push_stones_features, trajectory_rewards
+
+
+def score_rewards(traj_data, terms, features):
+    """
+    Per episode returns of each reward term over recorded trajectories.
+
+    :param traj_data: (dict) loaded by expert_data.load_trajectories
+    :param terms: ([Delta or Indicator]) reward terms, see rewards.py
+    :param features: (dict) feature name -> (n_steps,) array, e.g. from rewards.push_stones_features
+    :return: (np.ndarray, dict) (n_episodes,) returns, term name -> (n_episodes,) returns
+    """
+    episode_starts = np.asarray(traj_data['episode_starts'])
+    rewards, values = trajectory_rewards(terms, features, episode_starts)
+
+    starts = EpisodeIndex.build(traj_data).starts
+    returns = np.add.reduceat(rewards, starts) if len(starts) else np.zeros(0)
+    term_returns = {name: np.add.reduceat(value, starts) for name, value in values.items()} if len(starts) else {}
+
+    return returns, term_returns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score recorded trajectories with the declared reward terms')
+    parser.add_argument('env', choices=['pick_up', 'push_stones'], help='reward terms of PickUpEnv or PushStonesEnv')
+    parser.add_argument('paths', nargs='+', help='recording directories')
+    parser.add_argument('--num-stones', type=int, default=1, help='stones in the observation, push_stones only')
+    parser.add_argument('--hist-size', type=int, default=1, help='frames per observation in the recording')
+    args = parser.parse_args()
+
+    data = load_trajectories(args.paths)
+    if args.env == 'pick_up':
+        features = pick_up_features(data['obs'], data['episode_starts'], args.hist_size)
+        # the blade pose is not recorded
+        terms = [term for term in PICK_UP_REWARD if all(name in features for name in term.features)]
+    else:
+        features = push_stones_features(data['obs'], data['episode_starts'], args.num_stones, args.hist_size)
+        terms = PUSH_STONES_REWARD
+
+    returns, term_returns = score_rewards(data, terms, features)
+
+    print('{} episodes, {} steps'.format(len(returns), len(data['obs'])))
+    print('{:<24}{:>12}{:>12}{:>12}'.format('term', 'mean', 'std', 'min'))
+    for name, value in list(term_returns.items()) + [('total', returns)]:
+        print('{:<24}{:>12.2f}{:>12.2f}{:>12.2f}'.format(name, np.mean(value), np.std(value), np.min(value)))
+    print('{:<24}{:>12.2f}{:>12.2f}{:>12.2f}'.format('recorded', np.mean(data['episode_returns']),
+                                                    np.std(data['episode_returns']),
+                                                    np.min(data['episode_returns'])))
@@ -0,0 +1,174 @@
+import math
+
+import gym
+import numpy as np
+from gym import spaces
+
+from rewards import PUSH_STONES_REWARD, StepReward
+
+
+class PushStonesStandInEnv(gym.Env):
+    """
+    Local stand-in for PushStonesEnv without ROS or Unity: a planar kinematic loader whose blade pushes
+    the stones it drives into. Same action space, reduced state space observations, reward terms,
+    end of episode conditions and info as PushStonesEnv, seeded for reproducible episodes.
+    Good for exercising the training, recording and evaluation tools, not for judging a policy.
+
+    :param numStones: (int)
+    :param hist_size: (int) frames per observation
+    """
+
+    TIME_STEP = 0.1  # [s]
+    MAX_SPEED = 1.0  # [m/s]
+    MAX_TURN = 45.  # [deg/s]
+    ARM_RATE = 100.  # arm height units per second
+    BLADE_OFFSET = 0.75  # distance from center of vehicle to blade [m]
+    BLADE_HALF_WIDTH = 0.6  # [m]
+    BLADE_PUSH_HEIGHT = 50  # stones pass under a higher blade
+    STONE_RADIUS = 0.2  # [m]
+    DESIRED_ARM_HEIGHT = 28
+    FINAL_REWARD = 5000
+    TOLERANCE = 0.75
+
+    def __init__(self, numStones=1, hist_size=3):
+        self.numStones = numStones
+        self.hist_size = hist_size
+        self.reduced_state_space = True
+        self.marker = True
+        self.metrics = None
+
+        self.min_action = np.array(3*[-1.])
+        self.max_action = np.array(3*[ 1.])
+        self.action_space = spaces.Box(low=self.min_action, high=self.max_action)
+
+        # vehicle [x,y] pose, orientation yaw [deg] normalized by ref, arm height, stones' positions
+        low = np.concatenate(([-500., -500., -180., 0.], numStones * [-500., -500., -500.]))
+        high = np.concatenate(([500., 500., 180., 300.], numStones * [500., 500., 500.]))
+        self.observation_space = spaces.Box(low=np.array([low] * hist_size).flatten(),
+                                            high=np.array([high] * hist_size).flatten())
+
+        self.reward_evaluator = StepReward(PUSH_STONES_REWARD)
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        return [seed]
+
+    def reset(self):
+        rng = self.np_random
+        self.steps = 0
+        self.total_reward = 0
+
+        self.vehicle = np.zeros(2)
+        self.yaw = math.radians(rng.uniform(-30., 30.))
+        self.arm = float(self.DESIRED_ARM_HEIGHT)
+        self.stones = np.column_stack((rng.uniform(2., 4., self.numStones), rng.uniform(-1., 1., self.numStones),
+                                       np.zeros(self.numStones)))
+        self.ref_pos = np.array([rng.uniform(6., 9.), rng.uniform(-2., 2.), 0.])
+
+        # scene boarders: 5 m around the vehicle and the stones, 1 m around the target
+        xs = np.concatenate(([self.vehicle[0]], self.stones[:, 0]))
+        ys = np.concatenate(([self.vehicle[1]], self.stones[:, 1]))
+        self.boarders = [min(xs.min() - 5, self.ref_pos[0] - 1), max(xs.max() + 5, self.ref_pos[0] + 1),
+                         min(ys.min() - 5, self.ref_pos[1] - 1), max(ys.max() + 5, self.ref_pos[1] + 1)]
+
+        self.obs = [self.current_obs()] * self.hist_size
+        self.init_dis = np.linalg.norm(self.obs[-1][0:2])
+        self.reward_evaluator.reset()
+
+        return np.array(self.obs).flatten()
+
+    def current_obs(self):
+        vec = self.ref_pos[0:2] - self.vehicle
+        norm_yaw = math.degrees(self.yaw) - math.degrees(math.atan2(vec[1], vec[0]))
+        vehicle = [self.vehicle[0] - self.ref_pos[0], self.vehicle[1] - self.ref_pos[1], norm_yaw, self.arm]
+
+        return np.concatenate((vehicle, (self.stones - self.ref_pos).flatten()))
+
+    def step(self, action):
+        action = np.clip(action, self.min_action, self.max_action)
+        dt = self.TIME_STEP
+
+        self.yaw += math.radians(action[0] * self.MAX_TURN * dt)
+        heading = np.array([math.cos(self.yaw), math.sin(self.yaw)])
+        left = np.array([-heading[1], heading[0]])
+        move = action[1] * self.MAX_SPEED * dt
+        self.arm = float(np.clip(self.arm + action[2] * self.ARM_RATE * dt, 0., 300.))
+
+        blade = self.vehicle + self.BLADE_OFFSET * heading
+        self.vehicle = self.vehicle + move * heading
+        new_blade = self.vehicle + self.BLADE_OFFSET * heading
+
+        # stones in front of a low blade driving forwards are pushed ahead of it
+        if move > 0 and self.arm < self.BLADE_PUSH_HEIGHT:
+            rel = self.stones[:, 0:2] - blade
+            along, lateral = rel.dot(heading), rel.dot(left)
+            pushed = (np.abs(lateral) < self.BLADE_HALF_WIDTH) & (along > -self.STONE_RADIUS) & \
+                     (along < self.STONE_RADIUS + move)
+            self.stones[pushed, 0:2] = new_blade + np.outer(np.maximum(along[pushed] - move, self.STONE_RADIUS),
+                                                            heading) + np.outer(lateral[pushed], left)
+
+        self.obs.pop(0)
+        self.obs.append(self.current_obs())
+
+        dis = np.linalg.norm(self.stones[:, 0:2] - self.ref_pos[0:2], axis=1)
+        r_t = self.reward_evaluator({'stone_sqr_dis': np.mean(np.power(dis, 2))})
+        done, final_reward, reset = self.end_of_episode(dis)
+
+        step_reward = r_t + final_reward
+        self.total_reward = self.total_reward + step_reward
+
+        if self.metrics is not None:
+            self.metrics.add_step()
+            if done:
+                self.metrics.end_episode(self.total_reward, self.steps, reset)
+
+        info = {"state": self.obs, "action": action, "reward": self.total_reward, "step": self.steps,
+                "reset reason": reset}
+
+        return np.array(self.obs).flatten(), step_reward, done, info
+
+    def end_of_episode(self, dis):
+        # as PushStonesEnv.end_of_episode
+        done = False
+        reset = 'No'
+        final_reward = 0
+
+        x, y = self.vehicle
+        if x < self.boarders[0] or x > self.boarders[1] or y < self.boarders[2] or y > self.boarders[3]:
+            done = True
+            reset = 'out of boarders'
+            final_reward = - self.FINAL_REWARD
+
+        MAX_STEPS = 250*self.init_dis
+        if self.steps > MAX_STEPS:
+            done = True
+            reset = 'limit time steps'
+
+        if all(dis < self.TOLERANCE):
+            done = True
+            reset = 'sim success'
+            final_reward = self.FINAL_REWARD*MAX_STEPS/max(self.steps, 1)
+
+        self.steps += 1
+
+        return done, final_reward, reset
+
+    def render(self, mode='human'):
+        pass
+
+
+def make_env(mission, backend='sim', numStones=1):
+    """
+    :param mission: (str) e.g. 'PushStonesEnv'
+    :param backend: (str) 'sim' for the Unity simulation, 'standin' for the local stand-in
+    :param numStones: (int) stand-in only, the simulation env is created with its registered default
+    :return: (gym.Env)
+    """
+    if backend == 'sim':
+        import gym_SmartLoader.envs  # registers the envs
+
+        return gym.make(mission + '-v0').unwrapped
+    if backend == 'standin' and mission == 'PushStonesEnv':
+        return PushStonesStandInEnv(numStones)
+    raise ValueError('no {} backend for {}'.format(backend, mission))
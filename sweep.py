@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# hyperparameter sweep of SAC runs: trials sampled from a search space run concurrently within a budget of
+# env instances, clearly losing trials are stopped early and every trial's config and results go into a
+# sqlite table, e.g.
+# python sweep.py run PushStonesEnv --backend standin --trials 24 --concurrent 4 --timesteps 200000
+# python sweep.py results stable_bl/PushStonesEnv/sweeps/sweeps.sqlite
+# python sweep.py results stable_bl/PushStonesEnv/sweeps/sweeps.sqlite \
+#     --sql "select batch_size, avg(best_mean_return) from trials group by batch_size"
+# The checkpoints of trial k are run k of the sweep directory's manifest:
+# python evaluate_checkpoints.py PushStonesEnv --model-dir stable_bl/PushStonesEnv/sweeps/model_dir --query run:k
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import queue
+import sqlite3
+import time
+import traceback
+
+import numpy as np
+
+# the SAC settings of train_agent.py, the swept ones are replaced by each trial's values
+BASE_CONFIG = dict(gamma=0.99, learning_rate=1e-4, buffer_size=50000, learning_starts=3000, train_freq=1,
+                   batch_size=64, tau=0.01, ent_coef='auto', target_update_interval=1, gradient_steps=1,
+                   target_entropy='auto', layers=[64, 64, 64])
+
+# {'log_uniform': [low, high]}, {'uniform': [low, high]}, {'choice': [values]} or a fixed value
+DEFAULT_SPACE = {
+    'learning_rate': {'log_uniform': [3e-5, 1e-3]},
+    'batch_size': {'choice': [64, 128, 256]},
+    'tau': {'log_uniform': [0.002, 0.05]},
+    'layers': {'choice': [[64, 64], [64, 64, 64], [256, 256]]},
+    'buffer_size': {'choice': [50000, 200000, 1000000]},
+}
+
+SWEPT_COLUMNS = ['learning_rate', 'batch_size', 'tau', 'layers', 'buffer_size']
+
+
+def sample_config(space, rng):
+    """
+    :param space: (dict) parameter -> distribution, see DEFAULT_SPACE
+    :param rng: (np.random.RandomState)
+    :return: (dict) BASE_CONFIG with the sampled values
+    """
+    config = dict(BASE_CONFIG)
+    for key, value in space.items():
+        if isinstance(value, dict) and 'log_uniform' in value:
+            low, high = value['log_uniform']
+            value = float(math.exp(rng.uniform(math.log(low), math.log(high))))
+        elif isinstance(value, dict) and 'uniform' in value:
+            value = float(rng.uniform(*value['uniform']))
+        elif isinstance(value, dict) and 'choice' in value:
+            value = value['choice'][rng.randint(len(value['choice']))]
+        config[key] = value
+    return config
+
+
+class ResultsTable:
+    """
+    Trials and their intermediate results in a sqlite file: the trials table has a column per swept
+    parameter (layers as json), the full config as json, the status ('running', 'completed', 'pruned',
+    'failed', 'interrupted') and the final metrics; the reports table has the mean return of every trial at every report.
+
+    :param path: (str) sqlite file
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            create table if not exists trials (
+                id integer primary key autoincrement, sweep text, status text,
+                learning_rate real, batch_size integer, tau real, layers text, buffer_size integer, config text,
+                steps integer, episodes integer, mean_return real, best_mean_return real, success_rate real,
+                started real, finished real, error text);
+            create table if not exists reports (
+                trial integer, steps integer, mean_return real, success_rate real, wall_time real);
+        ''')
+        self.db.commit()
+
+    def add_trial(self, sweep, config):
+        values = [json.dumps(config[key]) if key == 'layers' else config.get(key) for key in SWEPT_COLUMNS]
+        cursor = self.db.execute(
+            'insert into trials (sweep, status, {}, config, started) values (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                ', '.join(SWEPT_COLUMNS)), [sweep, 'running'] + values + [json.dumps(config), time.time()])
+        self.db.commit()
+        return cursor.lastrowid
+
+    def add_report(self, trial, steps, mean_return, success_rate):
+        self.db.execute('insert into reports values (?, ?, ?, ?, ?)',
+                        (trial, steps, mean_return, success_rate, time.time()))
+        self.db.execute('update trials set steps = ?, mean_return = ?, success_rate = ?, '
+                        'best_mean_return = coalesce(max(coalesce(best_mean_return, ?), ?), best_mean_return) '
+                        'where id = ?',
+                        (steps, mean_return, success_rate, mean_return, mean_return, trial))
+        self.db.commit()
+
+    def finish(self, trial, status, summary=None, error=None):
+        # the final metrics when the trial ended, else those of its last report
+        summary = summary or {}
+        success_rate = summary.get('rate/sim success', 0.) if summary else None
+        self.db.execute('update trials set status = ?, steps = coalesce(?, steps), episodes = ?, '
+                        'mean_return = coalesce(?, mean_return), success_rate = coalesce(?, success_rate), '
+                        'finished = ?, error = ? where id = ?',
+                        (status, summary.get('steps'), summary.get('episodes'), summary.get('mean_return'),
+                         success_rate, time.time(), error, trial))
+        self.db.commit()
+
+    def query(self, sql, args=()):
+        """
+        :return: ([str], [tuple]) column names and rows
+        """
+        cursor = self.db.execute(sql, args)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+class MedianStopping:
+    """
+    Median stopping rule: at a report after grace_steps, a trial whose best mean return so far is below the
+    median of the other trials' best mean returns up to the same step is stopped. Needs min_trials other
+    trials that reached that step.
+
+    :param grace_steps: (int) steps before a trial can be stopped
+    :param min_trials: (int)
+    """
+
+    def __init__(self, grace_steps=50000, min_trials=3):
+        self.grace_steps = grace_steps
+        self.min_trials = min_trials
+        self.history = {}  # trial -> [(steps, mean return)]
+
+    def should_stop(self, trial, steps, mean_return):
+        self.history.setdefault(trial, []).append((steps, mean_return))
+        if steps < self.grace_steps or math.isnan(mean_return):
+            return False
+
+        def best_until(reports, max_steps):
+            values = [value for step, value in reports if step <= max_steps and not math.isnan(value)]
+            return max(values) if values else None
+
+        others = [best_until(reports, steps) for other, reports in self.history.items()
+                  if other != trial and reports[-1][0] >= steps]
+        others = [value for value in others if value is not None]
+        if len(others) < self.min_trials:
+            return False
+        return best_until(self.history[trial], steps) < np.median(others)
+
+
+class TrialCallback:
+    """
+    Reports the trial's mean return every report_interval steps, checkpoints it on a new best, and stops
+    model.learn once the scheduler asks.
+    """
+
+    def __init__(self, trial, metrics, messages, stop, checkpoints, model_path, report_interval):
+        self.trial = trial
+        self.metrics = metrics
+        self.messages = messages
+        self.stop = stop
+        self.checkpoints = checkpoints
+        self.model_path = model_path
+        self.report_interval = report_interval
+        self.n_steps = 0
+        self.best_mean_reward = -np.inf
+
+    def __call__(self, _locals, _globals):
+        self.n_steps += 1
+        if self.n_steps % self.report_interval == 0:
+            summary = self.metrics.summary()
+            self.messages.put(('report', self.trial, self.n_steps, summary['mean_return'],
+                               summary.get('rate/sim success', 0.)))
+            if summary['mean_return'] > self.best_mean_reward:
+                self.best_mean_reward = summary['mean_return']
+                self.checkpoints.save(_locals['self'], self.model_path + '_rew_' + str(round(self.best_mean_reward, 2)),
+                                      reward=self.best_mean_reward, best=True)
+        return not self.stop.is_set()
+
+
+def run_trial(trial, config, mission, backend, num_stones, timesteps, sweep_dir, report_interval, cpus,
+              messages, stop):
+    """
+    Trial process: trains a SAC model with config, checkpoints as run <trial> of the sweep's manifest.
+    Ends with a 'done' or 'failed' message.
+    """
+    try:
+        from stable_baselines import SAC
+        from stable_baselines.sac.policies import MlpPolicy
+
+        from checkpoints import CheckpointManifest, CheckpointWriter
+        from metrics import TrainingMetrics
+        from replay_buffers import FrameReplayBuffer
+        from standin_env import make_env
+
+        env = make_env(mission, backend, num_stones)
+        env.metrics = TrainingMetrics(window=100)
+        sac_config = dict(config)
+        layers = sac_config.pop('layers')
+        model = SAC(MlpPolicy, env, policy_kwargs=dict(layers=layers), verbose=0, seed=trial, n_cpu_tf_sess=cpus,
+                    tensorboard_log=os.path.join(sweep_dir, 'log_dir'), **sac_config)
+        model.replay_buffer = FrameReplayBuffer.from_env(env, size=model.buffer_size)
+
+        model_dir = os.path.join(sweep_dir, 'model_dir')
+        checkpoints = CheckpointWriter(keep_last=1, keep_best=1, manifest=CheckpointManifest(model_dir), run=trial)
+        model_path = os.path.join(model_dir, 'trial_{}'.format(trial))
+        callback = TrialCallback(trial, env.metrics, messages, stop, checkpoints, model_path, report_interval)
+        model.learn(total_timesteps=timesteps, callback=callback, tb_log_name='trial_{}'.format(trial))
+        mean_return = env.metrics.mean_return()
+        checkpoints.save(model, model_path + '_final', reward=None if math.isnan(mean_return) else mean_return)
+        checkpoints.close()
+        messages.put(('done', trial, env.metrics.summary()))
+    except Exception:
+        messages.put(('failed', trial, traceback.format_exc()))
+
+
+def run_sweep(mission, space=None, n_trials=20, max_concurrent=1, cpus=None, timesteps=200000, backend='sim',
+              num_stones=1, sweep_dir=None, name=None, report_interval=10000, grace_steps=50000, min_trials=3,
+              seed=0):
+    """
+    Run n_trials trials sampled from space, max_concurrent at a time, each in its own process. Reported mean
+    returns are checked with MedianStopping and losing trials are stopped.
+
+    :param mission: (str) e.g. 'PushStonesEnv'
+    :param space: (dict) search space, see DEFAULT_SPACE
+    :param n_trials: (int)
+    :param max_concurrent: (int) trials at a time, the number of env instances (one per machine for the
+        simulation)
+    :param cpus: (int) cpus shared by the trials' TF sessions, default all
+    :param timesteps: (int) per trial
+    :param backend: (str) 'sim' or 'standin', see standin_env.make_env
+    :param num_stones: (int)
+    :param sweep_dir: (str) results table, checkpoints and logs, default stable_bl/<mission>/sweeps
+    :param name: (str) sweep name in the results table, default the start time
+    :param report_interval: (int) steps between the trials' reports
+    :param grace_steps: (int) steps before a trial can be stopped early
+    :param min_trials: (int) trials to compare with before stopping one
+    :param seed: (int) of the sampled configs
+    :return: (str) path of the results table
+    """
+    space = DEFAULT_SPACE if space is None else space
+    sweep_dir = sweep_dir or os.path.join('stable_bl', mission, 'sweeps')
+    os.makedirs(os.path.join(sweep_dir, 'model_dir'), exist_ok=True)
+    name = name or time.strftime('%Y%m%d_%H%M%S')
+    cpus_per_trial = max(1, (cpus or os.cpu_count()) // max_concurrent)
+
+    path = os.path.join(sweep_dir, 'sweeps.sqlite')
+    table = ResultsTable(path)
+    stopping = MedianStopping(grace_steps, min_trials)
+    rng = np.random.RandomState(seed)
+
+    context = multiprocessing.get_context('spawn')  # a forked TF session is not usable in the children
+    messages = context.Queue()
+    running = {}  # trial -> (process, stop event)
+    pruned = set()
+    n_started = 0
+
+    def handle(message):
+        kind, trial = message[:2]
+        if kind == 'report':
+            _, _, steps, mean_return, success_rate = message
+            table.add_report(trial, steps, mean_return, success_rate)
+            if trial in running and trial not in pruned and stopping.should_stop(trial, steps, mean_return):
+                pruned.add(trial)
+                running[trial][1].set()
+                print('trial {} stopped at {} steps, mean return {:.1f}'.format(trial, steps, mean_return))
+        elif kind in ['done', 'failed']:
+            process, _ = running.pop(trial, (None, None))
+            if process is not None:
+                process.join()
+            if kind == 'done':
+                table.finish(trial, 'pruned' if trial in pruned else 'completed', summary=message[2])
+                print('trial {} {}: {}'.format(trial, 'pruned' if trial in pruned else 'completed', message[2]))
+            else:
+                table.finish(trial, 'failed', error=message[2])
+                print('trial {} failed:\n{}'.format(trial, message[2]))
+
+    try:
+        while n_started < n_trials or running:
+            while n_started < n_trials and len(running) < max_concurrent:
+                config = sample_config(space, rng)
+                trial = table.add_trial(name, config)
+                stop = context.Event()
+                process = context.Process(target=run_trial, name='trial-{}'.format(trial), daemon=True,
+                                          args=(trial, config, mission, backend, num_stones, timesteps, sweep_dir,
+                                                report_interval, cpus_per_trial, messages, stop))
+                process.start()
+                running[trial] = (process, stop)
+                n_started += 1
+                print('trial {} started: {}'.format(trial, {key: config[key] for key in space}))
+
+            try:
+                message = messages.get(timeout=1.)
+            except queue.Empty:
+                pass
+            else:
+                handle(message)
+                continue
+
+            # a trial process that died without a message, e.g. killed. Its last messages can still be
+            # queued, they are handled first
+            dead = [trial for trial, (process, _) in running.items() if not process.is_alive()]
+            if dead:
+                while True:
+                    try:
+                        handle(messages.get(timeout=0.1))
+                    except queue.Empty:
+                        break
+            for trial in dead:
+                process, _ = running.pop(trial, (None, None))
+                if process is not None:
+                    table.finish(trial, 'failed', error='exit code {}'.format(process.exitcode))
+    finally:
+        # trials still running when the sweep stops, e.g. on KeyboardInterrupt
+        for trial, (process, stop) in running.items():
+            stop.set()
+            process.join(60)
+            if process.is_alive():
+                process.terminate()
+            table.finish(trial, 'interrupted')
+        table.close()
+
+    return path
+
+
+def print_results(path, sql=None):
+    table = ResultsTable(path)
+    columns, rows = table.query(sql or 'select id, sweep, status, {}, steps, best_mean_return, mean_return, '
+                                       'success_rate from trials order by best_mean_return desc'.format(
+                                           ', '.join(SWEPT_COLUMNS)))
+    table.close()
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('{:.4g}'.format(value) if isinstance(value, float) else str(value) for value in row))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel SAC hyperparameter sweep with early stopping')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('mission', help="env name without '-v0', e.g. PushStonesEnv")
+    run_parser.add_argument('--space', help='search space json file, default DEFAULT_SPACE')
+    run_parser.add_argument('--trials', type=int, default=20)
+    run_parser.add_argument('--concurrent', type=int, default=1, help='trials at a time (env instances)')
+    run_parser.add_argument('--cpus', type=int, default=None, help='cpus shared by the trials, default all')
+    run_parser.add_argument('--timesteps', type=int, default=200000, help='per trial')
+    run_parser.add_argument('--backend', choices=['sim', 'standin'], default='sim')
+    run_parser.add_argument('--num-stones', type=int, default=1)
+    run_parser.add_argument('--sweep-dir', default=None)
+    run_parser.add_argument('--name', default=None)
+    run_parser.add_argument('--report-interval', type=int, default=10000)
+    run_parser.add_argument('--grace-steps', type=int, default=50000)
+    run_parser.add_argument('--min-trials', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=0)
+    results_parser = subparsers.add_parser('results')
+    results_parser.add_argument('path', help='sweeps.sqlite')
+    results_parser.add_argument('--sql', help='query instead of the ranking, on tables trials and reports')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        space = None
+        if args.space:
+            with open(args.space) as f:
+                space = json.load(f)
+        path = run_sweep(args.mission, space, args.trials, args.concurrent, args.cpus, args.timesteps, args.backend,
+                         args.num_stones, args.sweep_dir, args.name, args.report_interval, args.grace_steps,
+                         args.min_trials, args.seed)
+        print_results(path)
+    elif args.command == 'results':
+        print_results(args.path, args.sql)
+    else:
+        parser.print_help()
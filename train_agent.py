@@ -19,74 +19,94 @@ import numpy as np
 from typing import Dict
 from tempfile import TemporaryFile
 import csv
-
-n_steps = 0
-save_interval = 2000
-best_mean_reward = -np.inf
-
-def save_fn(_locals, _globals):
-    global model, n_steps, best_mean_reward, best_model_path, last_model_path
-    if (n_steps + 1) % save_interval == 0:
+from recorder import ChunkedRecorder
+from expert_data import MmapExpertDataset, load_trajectories
+from prioritized_sac import PrioritizedSAC
+from checkpoints import CheckpointManifest, CheckpointWriter
+from metrics import TrainingMetrics
+from frozen_policy import NumpyPolicy
+from log_sink import INFO, AsyncOutputFormat, get_sink
+from actor_learner import ActorLearner
+from remote_rollouts import RolloutServer
+from replay_buffers import ExpertReplayBuffer, FrameReplayBuffer, HindsightReplayBuffer, fill_replay_buffer, load_replay_buffer
+
+class SaveCallback:
+    """
+    Training callback: every save_interval steps logs the training metrics and checkpoints the model,
+    as a best model too when the mean return of the last episodes is a new best.
+
+    :param checkpoints: (CheckpointWriter)
+    :param metrics: (TrainingMetrics) filled by the env
+    :param model_path: (str) checkpoint path prefix, e.g. model_dir/sac/test_3
+    :param log_dir: (str) metrics.csv is written there
+    :param save_interval: (int) steps
+    :param save_buffer: (bool) snapshot the replay buffer with the latest model, for resuming
+    """
+
+    def __init__(self, checkpoints, metrics, model_path, log_dir, save_interval=2000, save_buffer=True):
+        self.checkpoints = checkpoints
+        self.metrics = metrics
+        self.model_path = model_path
+        self.log_dir = log_dir
+        self.save_interval = save_interval
+        self.save_buffer = save_buffer
+        self.n_steps = 0
+        self.best_mean_reward = -np.inf
+
+    def __call__(self, _locals, _globals):
+        model = _locals['self']
+        self.n_steps += 1
+        if self.n_steps % self.save_interval:
+            return
 
         # Evaluate policy training performance
-        mean_reward = round(float(np.mean(_locals['episode_rewards'][-101:-1])), 1)
-        print(n_steps + 1, 'timesteps')
-        print("Best mean reward: {:.2f} - Last mean reward: {:.2f}".format(best_mean_reward, mean_reward))
+        mean_reward = round(self.metrics.mean_return(), 1)
+        self.metrics.write_csv(self.log_dir + '/metrics.csv')
+        self.metrics.logkvs(logger)
+        log = get_sink()
+        returns = self.metrics.returns()
+        if returns:
+            log.histogram('train', 'episode_returns', returns, self.n_steps, level=INFO)
+        log.info('train', '%d timesteps', self.n_steps)
+        log.info('train', 'Best mean reward: %.2f - Last mean reward: %.2f', self.best_mean_reward, mean_reward)
         # New best model, save the agent
-        if mean_reward > best_mean_reward:
-            best_mean_reward = mean_reward
-            print("Saving new best model")
-            model.save(best_model_path + '_rew_' + str(np.round(best_mean_reward, 2)))
-        model.save(
-            last_model_path + '_' + str(time.localtime().tm_mday) + '_' + str(time.localtime().tm_hour) + '_' + str(time.localtime().tm_min))
-    n_steps += 1
-    pass
-
-
-def data_saver(obs, act, rew, dones, ep_rew):
-
-    np.save('/home/graphics/git/SmartLoader/saved_ep/obs', obs)
-    np.save('/home/graphics/git/SmartLoader/saved_ep/act', act)
-    np.save('/home/graphics/git/SmartLoader/saved_ep/rew', rew)
-
-    ep_str = [False] * len(dones)
-    ep_str[0] = True
-
-    for i in range(len(dones) - 1):
-        if dones[i]:
-            ep_str[i + 1] = True
-
-    np.save('/home/graphics/git/SmartLoader/saved_ep/ep_str', ep_str)
-    np.save('/home/graphics/git/SmartLoader/saved_ep/ep_ret', ep_rew)
+        if mean_reward > self.best_mean_reward:
+            self.best_mean_reward = mean_reward
+            log.info('train', 'Saving new best model')
+            self.checkpoints.save(model, self.model_path + '_rew_' + str(np.round(self.best_mean_reward, 2)),
+                                  reward=self.best_mean_reward, best=True)
+        self.checkpoints.save(model,
+            self.model_path + '_' + str(time.localtime().tm_mday) + '_' + str(time.localtime().tm_hour) + '_' + str(time.localtime().tm_min),
+            reward=mean_reward)
+        if self.save_buffer:
+            self.checkpoints.save_replay_buffer(model.replay_buffer, self.model_path + '_replay_buffer')
 
 
 def expert_dataset(name):
-    # Benny's recordings to dict
-    path = os.getcwd() + '/' + name
-    numpy_dict = {
-        'actions': np.load(path + '/act.npy'),
-        'obs': np.load(path + '/obs.npy'),
-        'rewards': np.load(path + '/rew.npy'),
-        'episode_returns': np.load(path + '/ep_ret.npy'),
-        'episode_starts': np.load(path + '/ep_str.npy')
-    } # type: Dict[str, np.ndarray]
-
-    # for key, val in numpy_dict.items():
-    #     print(key, val.shape)
-
-    # dataset = TemporaryFile()
-    save_path = os.getcwd() + '/' + name + '_dataset'
-    # os.makedirs(save_path)
-    np.savez(save_path, **numpy_dict)
+    # recordings to dict, memory-mapped in place
+    path = os.getcwd() + '/saved_experts/' + name
+    numpy_dict = load_trajectories(path) # type: Dict[str, np.ndarray]
 
     return numpy_dict
 
 
 def main():
-    global model, best_model_path, last_model_path
     # mission = 'PushStonesEnv' # Change according to algorithm
     mission = 'PickUpEnv'
-    env = gym.make(mission + '-v0').unwrapped
+    # train job: > 0 steps the envs in that many actor processes while the model trains continuously,
+    # see actor_learner.py (the simulation runs one env per machine)
+    n_actors = 0
+    # train job: port to train with the transitions of remote_rollouts.py workers on other machines instead
+    rollout_port = None
+    learner = None
+    if n_actors:
+        learner = ActorLearner(mission, 'sim', n_actors=n_actors)
+        env = learner.start()
+    elif rollout_port:
+        learner = RolloutServer(port=rollout_port)
+        env = learner.start()
+    else:
+        env = gym.make(mission + '-v0').unwrapped
 
     # Create log and model dir
     dir = 'stable_bl/' + mission
@@ -99,37 +119,49 @@ def main():
     name = 'PickUp_40_episodes'
     pretrain = False
     fillBuffer = False
+    expert_partition = True  # with fillBuffer, never evict the recordings (not with prioritized replay)
+
+    # continue learning from a saved model and its replay buffer snapshot,
+    # e.g. 'test_3_26_11_59.zip' and 'test_3_replay_buffer', or 'best' / 'latest' model of the manifest
+    resume_model = None
+    resume_buffer = None
+
+    compact_buffer = True
+    prioritized = False  # prioritized replay, uses its own compact buffer
+    hindsight = False  # PushStonesEnv only, relabel goals to achieved stone positions
+
+    # models are written on a background thread, older checkpoints of the run are deleted
+    keep_last = 5
+    keep_best = 3
+
+    # per subsystem log levels: 'env', 'train' and 'llc', all written on a background thread
+    log_levels = dict(env=INFO, train=INFO)
+    for subsystem, level in log_levels.items():
+        get_sink().set_level(subsystem, level)
 
     if job == 'train':
 
-        # create new folder
-        try:
-            tests = os.listdir(dir + '/model_dir/sac')
-            indexes = []
-            for item in tests:
-                indexes.append(int(item.split('_')[1]))
-            if not bool(indexes):
-                k = 0
-            else:
-                k = max(indexes) + 1
-        except FileNotFoundError:
-            os.makedirs(dir + '/log_dir/sac')
-            k = 0
+        # new run id, the checkpoints of all runs are indexed in model_dir/sac/manifest.jsonl
+        manifest = CheckpointManifest(dir + '/model_dir/sac')
+        k = manifest.next_run()
 
         model_dir = os.getcwd() + '/' + dir + '/model_dir/sac/test_{}'.format(str(k))
 
-        best_model_path = model_dir
-        last_model_path = model_dir
-
         log_dir = dir + '/log_dir/sac/test_{}'.format(str(k))
         logger.configure(folder=log_dir, format_strs=['stdout', 'log', 'csv', 'tensorboard'])
+        # the logger's outputs are written by the log sink thread, dumpkvs only queues the values
+        logger.Logger.CURRENT.output_formats = [AsyncOutputFormat(output_format, get_sink())
+                                                for output_format in logger.Logger.CURRENT.output_formats]
+        # the sink's scalars and histograms (episode statistics) go to the same tensorboard run
+        get_sink().tensorboard_dir = log_dir
 
         num_timesteps = int(1e6)
 
         policy_kwargs = dict(layers=[64, 64, 64])
 
         # SAC - start learning from scratch
-        model = SAC(sac_MlpPolicy, env, gamma=0.99, learning_rate=1e-4, buffer_size=50000,
+        algo = PrioritizedSAC if prioritized else SAC
+        model = algo(sac_MlpPolicy, env, gamma=0.99, learning_rate=1e-4, buffer_size=50000,
              learning_starts=3000, train_freq=1, batch_size=64,
              tau=0.01, ent_coef='auto', target_update_interval=1,
              gradient_steps=1, target_entropy='auto', action_noise=None,
@@ -137,34 +169,23 @@ def main():
              _init_setup_model=True, full_tensorboard_log=True,
              seed=None, n_cpu_tf_sess=None)
 
-        # Load best model and continue learning
-        # models = os.listdir(dir + '/model_dir/sac')
-        # models_rew = (model for model in models if 'rew' in model)
-        # ind, reward = [], []
-        # for model in models_rew:
-        #     ind.append(model.split('_')[1])
-        #     reward.append(model.split('_')[3])
-        # best_reward = max(reward)
-        # best_model_ind = reward.index(best_reward)
-        # k = ind[best_model_ind]
-        # model = SAC.load(dir + '/model_dir/sac/test_' + k + '_rew_' + best_reward, env=env,
-        #                  custom_objects=dict(learning_starts=0))
-        # Load last saved model and continue learning
-        # models = os.listdir(dir + '/model_dir/sac')
-        # models_time = (model for model in models if 'rew' not in model)
-        # ind, hour, min = [], [], []
-        # for model in models_time:
-        #     ind.append(model.split('_')[1])
-        #     hour.append(model.split('_')[3])
-        #     min.append(model.split('_')[4])
-        # date = models_time[0].split('_')[2]
-        # latest_hour = max(hour)
-        # latest_hour_ind = [i for i, n in enumerate(hour) if n == latest_hour]
-        # latest_min = max(min[latest_hour_ind])
-        # latest_min_ind = min(latest_min)
-        # k = ind[latest_min_ind]
-        # model = SAC.load(dir + '/model_dir/sac/test_' + k + '_' + date + '_' + latest_hour[0] + '_' + latest_min + 'zip',
-        #                  env=env, custom_objects=dict(learning_starts=0))
+        if resume_model in ['best', 'latest']:
+            checkpoint = getattr(manifest, resume_model)()
+            if checkpoint is None:  # empty model_dir, or no checkpoint with a reward for 'best'
+                raise FileNotFoundError('no {} checkpoint in manifest {}'.format(resume_model, manifest.path))
+            resume_model = os.path.basename(checkpoint)
+        if resume_model:
+            model = algo.load(dir + '/model_dir/sac/' + resume_model, env=env, tensorboard_log=log_dir,
+                             custom_objects=dict(learning_starts=0))
+
+        # each frame stored once in float32 instead of obs and next_obs stacks in float64
+        if hindsight:
+            model.replay_buffer = HindsightReplayBuffer.from_env(env, size=model.buffer_size)
+        elif compact_buffer and not prioritized:
+            model.replay_buffer = FrameReplayBuffer.from_env(env, size=model.buffer_size)
+
+        if resume_model and resume_buffer:
+            load_replay_buffer(model.replay_buffer, dir + '/model_dir/sac/' + resume_buffer)
 
         # model = SAC.load(dir + '/model_dir/sac/test_0_11_16_2.zip',
         #                  env=env, tensorboard_log=log_dir,
@@ -174,26 +195,17 @@ def main():
 
         # pretrain
         if pretrain:
-            # load dataset only once
-            # expert_dataset(name)
-            dataset = ExpertDataset(expert_path=(os.getcwd() + '/' + name + '_dataset.npz'), traj_limitation=-1)
+            dataset = MmapExpertDataset(os.getcwd() + '/saved_experts/' + name, traj_limitation=-1)
             model.pretrain(dataset, n_epochs=2000)
 
         # fill replay buffer with Benny's recordings
         if fillBuffer:
             traj = expert_dataset(name)
-
-            for i in range(len(traj['obs'])-1):
-                if traj['episode_starts'][i+1]:
-                    done = True
-                else: done = False
-
-                obs = traj['obs'][i]
-                action = traj['actions'][i]
-                reward = traj['rewards'][i]
-                next_obs = traj['obs'][i+1]
-
-                model.replay_buffer.add(obs, action, reward, next_obs, float(done))
+            if expert_partition and not prioritized:
+                # kept for the whole run, expert_ratio of every minibatch
+                model.replay_buffer = ExpertReplayBuffer(model.replay_buffer, traj, expert_ratio=0.25)
+            else:
+                fill_replay_buffer(model.replay_buffer, traj)
 
         # Test the pre-trained model
         # env = model.get_env()
@@ -212,7 +224,21 @@ def main():
         # env.close()
 
         # learn
-        model.learn(total_timesteps=num_timesteps, callback=save_fn)
+        checkpoints = CheckpointWriter(keep_last=keep_last, keep_best=keep_best, manifest=manifest, run=k)
+        env.metrics = TrainingMetrics(window=100)
+        callback = SaveCallback(checkpoints, env.metrics, model_dir, log_dir)
+        try:
+            if learner is not None:
+                try:
+                    learner.learn(model, total_timesteps=num_timesteps, callback=callback, metrics=env.metrics)
+                finally:
+                    learner.close()
+            else:
+                model.learn(total_timesteps=num_timesteps, callback=callback)
+            checkpoints.close()
+        finally:
+            # the sink thread is a daemon, its queued records are lost if the process exits first
+            get_sink().flush()
 
         # PPO1
         # model = PPO1(Common_MlpPolicy, env, gamma=0.99, timesteps_per_actorbatch=256, clip_param=0.2, entcoeff=0.01,
@@ -232,46 +258,37 @@ def main():
         env = gym.make(mission + '-v0').unwrapped
 
         num_episodes = 10
+        record_joy = True  # also save every joystick sample, not only the step aligned action
 
-        obs = []
-        actions = []
-        rewards = []
-        dones = []
-        episode_rewards = []
+        # steps are flushed to disk in chunks, an interrupted session continues where it stopped
+        recorder = ChunkedRecorder(os.getcwd() + '/saved_experts/' + name)
 
-        for episode in range(num_episodes):
+        for episode in range(recorder.n_episodes, num_episodes):
 
             ob = env.reset()
             done = False
             print('Episode number ', episode)
-            episode_reward = 0
 
             while not done:
 
                 act = "recording"
-                new_ob, reward, done, action = env.step(act)
-
-                # ind = [0, 1, 2, 18, 21, 24]
-                ind = [0, 1, 2]
-                # print(ob)
+                new_ob, reward, done, info = env.step(act)
 
-                obs.append(ob)
-                actions.append(action)
-                rewards.append(reward)
-                dones.append(done)
-                episode_reward = episode_reward + reward
+                if record_joy:
+                    recorder.add_joy_samples(info['joy_samples'])
+                recorder.add(ob, info['action'], reward, done)
 
                 ob = new_ob
 
-            episode_rewards.append(episode_reward)
-
-
-
-        data_saver(obs, actions, rewards, dones, episode_rewards)
+        recorder.close()
 
     elif job == 'play':
         # env = gym.make('PickUpEnv-v0')
-        model = SAC.load(dir + '/model_dir/sac/test_0_11_16_2.zip', env=env, custom_objects=dict(learning_starts=0)) ### ADD NUM
+        play_model = 'test_0_11_16_2.zip' ### ADD NUM
+        if play_model.endswith('.npz'):  # exported by frozen_policy.py, numpy only
+            model = NumpyPolicy.load(dir + '/model_dir/sac/' + play_model)
+        else:
+            model = SAC.load(dir + '/model_dir/sac/' + play_model, env=env, custom_objects=dict(learning_starts=0))
 
         for _ in range(2):
 